@@ -1,4 +1,5 @@
 import cv2
+import torch
 import numpy as np
 import random
 
@@ -65,3 +66,201 @@ def random_color(image):
         dest = cv2.cvtColor(dest, cv2.COLOR_HSV2RGB)
 
     return (dest * 255).astype(np.uint8)
+
+
+def rgb_to_hsv(images):
+    '''
+    Args:
+        images: (batch_size, 3, height, width) rgb tensor in range [0, 1]
+
+    Returns:
+        hsv tensor of the same shape, with hue in degrees like cv2.COLOR_RGB2HSV on float images
+    '''
+    red, green, blue = images.unbind(1)
+
+    value = images.max(dim = 1)[0]
+    delta = value - images.min(dim = 1)[0]
+
+    safe_delta = delta.clamp(min = 1e-8)
+
+    hue_r = torch.remainder((green - blue) / safe_delta, 6.0)
+    hue_g = (blue - red) / safe_delta + 2.0
+    hue_b = (red - green) / safe_delta + 4.0
+
+    hue = torch.where(value == red, hue_r, torch.where(value == green, hue_g, hue_b)) * 60.0
+    hue = torch.where(delta > 0, hue, torch.zeros_like(hue))
+
+    saturation = torch.where(value > 0, delta / value.clamp(min = 1e-8), torch.zeros_like(value))
+
+    return torch.stack([hue, saturation, value], dim = 1)
+
+
+def hsv_to_rgb(images):
+    hue, saturation, value = images[:, 0:1], images[:, 1:2], images[:, 2:3]
+
+    offsets = torch.tensor([5.0, 3.0, 1.0], device = images.device, dtype = images.dtype).view(1, 3, 1, 1)
+
+    k = torch.remainder(offsets + hue / 60.0, 6.0)
+
+    return value - value * saturation * torch.clamp(torch.min(k, 4.0 - k), 0.0, 1.0)
+
+
+def random_color_batch(images):
+    '''
+    performs the same random colour augmentation as random_color, independently for each image of a batch
+
+    Args:
+        images: (batch_size, 3, height, width) rgb tensor in range [0, 1]
+    '''
+    def uniform(low, high):
+        return torch.empty((images.size(0), 1, 1, 1), device = images.device, dtype = images.dtype).uniform_(low, high)
+
+    images = torch.clamp(images + uniform(-0.125, 0.125), 0.0, 1.0)
+
+    images = torch.clamp((images - 0.5) * uniform(0.8, 1.25) + 0.5, 0.0, 1.0)
+
+    images = rgb_to_hsv(images)
+
+    hue = torch.remainder(images[:, 0:1] + uniform(-18, 18), 360.0)
+    saturation = torch.clamp(images[:, 1:2] * uniform(0.8, 1.25), 0.0, 1.0)
+
+    return hsv_to_rgb(torch.cat([hue, saturation, images[:, 2:3]], dim = 1))
+
+
+yiq_from_rgb = np.array([[0.299, 0.587, 0.114], [0.596, -0.274, -0.322], [0.211, -0.523, 0.312]], dtype = np.float32)
+rgb_from_yiq = np.linalg.inv(yiq_from_rgb).astype(np.float32)
+
+
+def draw_colour(size):
+    '''
+    draws brightness, contrast, hue and saturation factors from the same ranges as random_color
+    '''
+    brightness = np.random.uniform(-0.125, 0.125, size)
+    contrast = np.random.uniform(0.8, 1.25, size)
+    hue = np.random.uniform(-18, 18, size)
+    saturation = np.random.uniform(0.8, 1.25, size)
+
+    return brightness, contrast, hue, saturation
+
+
+def tone_luts(brightness, contrast):
+    '''
+    brightness and contrast with the clipping of random_color, tabulated over the 256 uint8 levels
+
+    Returns:
+        (N, 256) float32 tables in range [0, 1]
+    '''
+    levels = np.arange(256, dtype = np.float32) / 255.0
+
+    levels = np.clip(levels + np.reshape(brightness, (-1, 1)), 0, 1)
+
+    return np.clip((levels - 0.5) * np.reshape(contrast, (-1, 1)) + 0.5, 0, 1).astype(np.float32)
+
+
+def colour_matrices(hue, saturation):
+    '''
+    hue rotation and saturation scaling as (N, 3, 3) rgb matrices that act on the chroma plane of YIQ
+    a positive hue turns red towards green like the hsv hue shift of random_color
+    '''
+    theta = - np.radians(np.reshape(hue, -1))
+    saturation = np.reshape(saturation, -1)
+
+    chroma = np.zeros((len(theta), 3, 3))
+    chroma[:, 0, 0] = 1
+    chroma[:, 1, 1] = chroma[:, 2, 2] = saturation * np.cos(theta)
+    chroma[:, 1, 2] = - saturation * np.sin(theta)
+    chroma[:, 2, 1] = saturation * np.sin(theta)
+
+    return (rgb_from_yiq @ chroma @ yiq_from_rgb).astype(np.float32)
+
+
+def apply_colour(image, lut, matrix):
+    image = cv2.transform(cv2.LUT(image, lut), matrix * 255.0)
+
+    return np.clip(image, 0, 255, out = image).astype(np.uint8)
+
+
+def random_color_fast(image):
+    '''
+    statistically equivalent counterpart of random_color with one lookup table and one colour matrix
+
+    Args:
+        image: 3-channel rgb uint8 image
+    '''
+    brightness, contrast, hue, saturation = draw_colour(1)
+
+    return apply_colour(image, tone_luts(brightness, contrast)[0], colour_matrices(hue, saturation)[0])
+
+
+def random_color_fast_batch(images):
+    '''
+    random_color_fast for a batch of images, each with its own factors
+
+    Args:
+        images: (batch_size, height, width, 3) rgb uint8 array
+    '''
+    brightness, contrast, hue, saturation = draw_colour(len(images))
+
+    luts = tone_luts(brightness, contrast)
+    matrices = colour_matrices(hue, saturation)
+
+    dest = np.empty_like(images)
+
+    for index, (image, lut, matrix) in enumerate(zip(images, luts, matrices)):
+        dest[index] = apply_colour(image, lut, matrix)
+
+    return dest
+
+
+def random_color_matrix_batch(images):
+    '''
+    torch counterpart of random_color_fast_batch, brightness and contrast are applied directly since the input is not quantized
+
+    Args:
+        images: (batch_size, 3, height, width) rgb tensor in range [0, 1]
+    '''
+    def uniform(low, high):
+        return torch.empty((images.size(0), 1, 1, 1), device = images.device, dtype = images.dtype).uniform_(low, high)
+
+    images = torch.clamp(images + uniform(-0.125, 0.125), 0.0, 1.0)
+
+    images = torch.clamp((images - 0.5) * uniform(0.8, 1.25) + 0.5, 0.0, 1.0)
+
+    hue = torch.empty(images.size(0)).uniform_(-18, 18)
+    saturation = torch.empty(images.size(0)).uniform_(0.8, 1.25)
+
+    matrices = torch.from_numpy(colour_matrices(hue.numpy(), saturation.numpy())).to(images.device, images.dtype)
+
+    return torch.clamp(torch.einsum('nij,njhw->nihw', matrices, images), 0.0, 1.0)
+
+
+def benchmark(num_images = 256, side = 257):
+    '''
+    per-image cost of the hsv and the lookup / matrix colour augmentation
+    '''
+    import time
+
+    images = np.random.randint(0, 256, size = (num_images, side, side, 3), dtype = np.uint8)
+
+    for name, func in [('random_color', random_color), ('random_color_fast', random_color_fast)]:
+        start = time.time()
+
+        for image in images:
+            func(image)
+
+        print('%s: %1.3f ms per image' % (name, (time.time() - start) / num_images * 1e3))
+
+    start = time.time()
+    random_color_fast_batch(images)
+    print('random_color_fast_batch: %1.3f ms per image' % ((time.time() - start) / num_images * 1e3))
+
+    tensors = torch.from_numpy(images).permute(0, 3, 1, 2).float() / 255.0
+
+    for name, func in [('random_color_batch', random_color_batch), ('random_color_matrix_batch', random_color_matrix_batch)]:
+        start = time.time()
+        func(tensors)
+        print('%s: %1.3f ms per image' % (name, (time.time() - start) / num_images * 1e3))
+
+
+if __name__ == '__main__':
+    benchmark()
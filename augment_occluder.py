@@ -1,7 +1,11 @@
 import os
 import cv2
+import mmap
+import glob
+import torch
 import numpy as np
 import random
+import torch.nn.functional as F
 
 
 def paste_over(occluder, image, alpha, center):
@@ -29,7 +33,7 @@ def paste_over(occluder, image, alpha, center):
 
     center = np.round(center).astype(int)
     
-    ideal_start_dst = center - shape_occ / 2
+    ideal_start_dst = center - shape_occ // 2
     ideal_end_dst = ideal_start_dst + shape_occ
 
     start_dst = np.maximum(ideal_start_dst, 0)
@@ -81,6 +85,80 @@ def random_occlu(image, occ_count, occ_path):
     return paste_over(occluder, image, alpha = occ_mask, center = center)
 
 
+def shared_array(shape, dtype):
+    '''
+    numpy array on an anonymous shared mapping, whose pages forked dataloader workers share instead of copying
+    '''
+    num_bytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+
+    return np.frombuffer(mmap.mmap(-1, max(num_bytes, 1)), dtype = dtype, count = int(np.prod(shape))).reshape(shape)
+
+
+class OccluderAtlas:
+    '''
+    every occluder and its mask at every level of a scale pyramid, loaded once and packed into two shared buffers
+    so that an occlusion only costs one alpha-blend
+    '''
+    scales = np.linspace(0.4, 0.8, 9)
+
+    def __init__(self, occ_path):
+        occ_count = len(glob.glob(os.path.join(occ_path, 'occluder_*.npy')))
+
+        assert occ_count, 'no occluders found at ' + str(occ_path)
+
+        patches = []
+
+        for occ_idx in range(occ_count):
+            occluder, occ_mask = fetch_occluders(occ_idx, occ_path)
+
+            for scale in self.scales:
+                dest_shape = tuple(np.round(scale * np.array(occluder.shape[:2])).astype(int))
+
+                patches.append((
+                    cv2.resize(occluder, dest_shape[::-1], interpolation = cv2.INTER_AREA),
+                    cv2.resize(occ_mask, dest_shape[::-1], interpolation = cv2.INTER_AREA)
+                ))
+
+        self.shapes = np.array([mask.shape[:2] for _, mask in patches])
+        self.channels = patches[0][0].shape[2]
+
+        sizes = np.prod(self.shapes, axis = 1)
+
+        self.offsets = np.concatenate([[0], np.cumsum(sizes)])
+
+        self.occluders = shared_array((self.offsets[-1], self.channels), patches[0][0].dtype)
+        self.masks = shared_array((self.offsets[-1],), np.float32)
+
+        for index, (occluder, occ_mask) in enumerate(patches):
+            self.occluders[self.offsets[index]:self.offsets[index + 1]] = occluder.reshape(-1, self.channels)
+            self.masks[self.offsets[index]:self.offsets[index + 1]] = occ_mask.reshape(-1)
+
+        print('=> occluder atlas of', occ_count, 'occluders x', len(self.scales), 'scales,', (self.occluders.nbytes + self.masks.nbytes) // 2 ** 20, 'MB')
+
+
+    def __len__(self):
+        return len(self.shapes)
+
+
+    def patch(self, index):
+        start, stop = self.offsets[index], self.offsets[index + 1]
+
+        height, width = self.shapes[index]
+
+        return self.occluders[start:stop].reshape(height, width, self.channels), self.masks[start:stop].reshape(height, width)
+
+
+    def occlude(self, image):
+        '''
+        pastes a random occluder at a random scale onto a random position of image in place
+        '''
+        occluder, occ_mask = self.patch(np.random.randint(len(self)))
+
+        center = np.array(image.shape[:2]) * np.random.uniform(size = 2)
+
+        return paste_over(occluder, image, alpha = occ_mask, center = center)
+
+
 def random_erase(image):
     rand_color = np.random.randint(0, 256, size = 3)
 
@@ -103,3 +181,122 @@ def random_erase(image):
     image[erase_start[0]:erase_end[0], erase_start[1]:erase_end[1]] = rand_color
 
     return image
+
+
+class BatchOccluder:
+    '''
+    random erasing and alpha-pasted occluders for a collated batch of normalized colour crops
+    boxes, colours and placements are drawn per sample as tensors and the batch is updated in place
+    '''
+    def __init__(self, erase, occ_path, mean, dev):
+        self.erase = erase
+        self.mean = torch.tensor(mean).view(1, 3, 1, 1)
+        self.dev = torch.tensor(dev).view(1, 3, 1, 1)
+
+        self.bank = self.load_bank(occ_path) if occ_path else None
+
+
+    def load_bank(self, occ_path):
+        '''
+        Returns:
+            (occ_count, 4, height, width) normalized rgb plus alpha of every occluder, zero-padded at the bottom right
+        '''
+        occ_count = len(glob.glob(os.path.join(occ_path, 'occluder_*.npy')))
+
+        assert occ_count, 'no occluders found at ' + str(occ_path)
+
+        pairs = [fetch_occluders(occ_idx, occ_path) for occ_idx in range(occ_count)]
+
+        self.sizes = torch.tensor([occ_mask.shape[:2] for _, occ_mask in pairs], dtype = torch.float32)
+
+        height, width = self.sizes.max(dim = 0)[0].int().tolist()
+
+        bank = torch.zeros(occ_count, 4, height, width)
+
+        for index, (occluder, occ_mask) in enumerate(pairs):
+            occ_height, occ_width = occ_mask.shape[:2]
+
+            occluder = torch.from_numpy(np.ascontiguousarray(occluder[:, :, :3])).permute(2, 0, 1).float() / 255.0
+
+            bank[index, :3, :occ_height, :occ_width] = (occluder - self.mean[0]) / self.dev[0]
+            bank[index, 3, :occ_height, :occ_width] = torch.from_numpy(occ_mask).float()
+
+        return bank
+
+
+    def uniform(self, images, low, high):
+        return torch.empty(images.size(0), device = images.device).uniform_(low, high)
+
+
+    def erase_(self, images):
+        '''
+        batched random_erase, every sample gets one box of 10 - 25 percent of its area filled with a random colour
+        '''
+        batch, channels, height, width = images.size()
+
+        erase_area = self.uniform(images, 0.1, 0.25) * height * width
+        aspect_ratio = self.uniform(images, 0.4, 2.5)
+
+        erase_height = (erase_area * aspect_ratio).sqrt()
+        erase_width = (erase_area / aspect_ratio).sqrt()
+
+        top = (height - erase_height) * self.uniform(images, 0, 1)
+        left = (width - erase_width) * self.uniform(images, 0, 1)
+
+        rows = torch.arange(height, device = images.device).view(1, 1, -1, 1)
+        cols = torch.arange(width, device = images.device).view(1, 1, 1, -1)
+
+        inside_rows = (top.round().view(-1, 1, 1, 1) <= rows) & (rows < (top + erase_height).round().view(-1, 1, 1, 1))
+        inside_cols = (left.round().view(-1, 1, 1, 1) <= cols) & (cols < (left + erase_width).round().view(-1, 1, 1, 1))
+
+        mask = (inside_rows & inside_cols).to(images.dtype)
+
+        colour = torch.randint(0, 256, (batch, channels, 1, 1), device = images.device).float() / 255.0
+        colour = ((colour - self.mean.to(images.device)) / self.dev.to(images.device)).to(images.dtype)
+
+        return images.mul_(1 - mask).add_(mask * colour)
+
+
+    def occlude_(self, images):
+        '''
+        batched random_occlu, every sample gets one occluder scaled by 0.4 - 0.8 and centred at a random position
+        the scaling is folded into the sampling grid, so no resized copies of the occluders are made
+        '''
+        batch, channels, height, width = images.size()
+
+        if self.bank.device != images.device or self.bank.dtype != images.dtype:
+            self.bank = self.bank.to(images.device, images.dtype)
+            self.sizes = self.sizes.to(images.device)
+
+        bank_height, bank_width = self.bank.size()[2:]
+
+        index = torch.randint(len(self.bank), (batch,), device = images.device)
+
+        scale = self.uniform(images, 0.4, 0.8)
+
+        occ_height, occ_width = self.sizes[index].unbind(1)
+
+        start_y = height * self.uniform(images, 0, 1) - scale * occ_height / 2
+        start_x = width * self.uniform(images, 0, 1) - scale * occ_width / 2
+
+        theta = torch.zeros(batch, 2, 3, device = images.device)
+        theta[:, 0, 0] = width / (scale * bank_width)
+        theta[:, 0, 2] = (width - 2 * start_x) / (scale * bank_width) - 1
+        theta[:, 1, 1] = height / (scale * bank_height)
+        theta[:, 1, 2] = (height - 2 * start_y) / (scale * bank_height) - 1
+
+        grid = F.affine_grid(theta.to(images.dtype), (batch, 4, height, width), align_corners = False)
+
+        patches = F.grid_sample(self.bank[index], grid, align_corners = False)
+
+        return images.add_(patches[:, 3:] * (patches[:, :3] - images))
+
+
+    def __call__(self, images):
+        if self.bank is not None:
+            self.occlude_(images)
+
+        if self.erase:
+            self.erase_(images)
+
+        return images
@@ -0,0 +1,154 @@
+import os
+import torch
+import shutil
+import collections
+import distributed
+import torch.utils.data as data
+
+
+def num_bytes(batch):
+    return sum(item.numel() * item.element_size() for item in batch if torch.is_tensor(item))
+
+
+class CachedLoader:
+    '''
+    keeps the collated batches of a validation loader across epochs
+    batches live in shared memory up to mem_cap bytes, the least recently used ones are demoted to one file each
+    under spill_path up to disk_cap bytes and dropped beyond that
+    a batch that is still due in the current pass is never evicted, so that repeated sequential passes keep
+    a stable part of the set instead of thrashing
+    batches that are not cached are regenerated by the original dataset in the original order
+    '''
+    def __init__(self, data_loader, mem_cap, spill_path = None, disk_cap = 0):
+        batch_sampler = getattr(data_loader.batch_sampler, 'batch_sampler', data_loader.batch_sampler)
+
+        sampler = getattr(batch_sampler, 'sampler', None)
+
+        assert isinstance(batch_sampler, distributed.EvalBatchSampler) or isinstance(sampler, data.SequentialSampler) or (isinstance(sampler, data.DistributedSampler) and not sampler.shuffle)
+        assert data_loader.dataset.at_test
+
+        self.data_loader = data_loader
+        self.dataset = data_loader.dataset
+        self.batches = [list(batch) for batch in data_loader.batch_sampler]
+
+        self.mem_cap = mem_cap
+        self.disk_cap = disk_cap if spill_path else 0
+        self.spill_path = spill_path
+
+        self.entries = collections.OrderedDict()  # batch index -> (tier, batch or spill file, size), least recently used first
+        self.pending = set()
+        self.used = dict(mem = 0, disk = 0)
+        self.hits = 0
+        self.misses = 0
+
+        if spill_path:
+            if os.path.exists(spill_path):
+                shutil.rmtree(spill_path)
+            os.makedirs(spill_path)
+
+
+    def __len__(self):
+        return len(self.data_loader)
+
+
+    def regenerate(self, missing):
+        loader = self.data_loader
+
+        batch_sampler = [self.batches[i_batch] for i_batch in missing]
+
+        return data.DataLoader(self.dataset, batch_sampler = batch_sampler, num_workers = loader.num_workers, pin_memory = loader.pin_memory, collate_fn = loader.collate_fn)
+
+
+    def fetch(self, i_batch):
+        self.entries.move_to_end(i_batch)
+        self.pending.discard(i_batch)
+
+        tier, content, size = self.entries[i_batch]
+
+        return content if tier == 'mem' else torch.load(content)
+
+
+    def victim(self, tier):
+        for i_batch, entry in self.entries.items():
+            if entry[0] == tier and i_batch not in self.pending:
+                return i_batch
+
+        return None
+
+
+    def drop(self, i_batch):
+        tier, content, size = self.entries.pop(i_batch)
+
+        if tier == 'disk':
+            os.remove(content)
+
+        self.used[tier] -= size
+
+        return content, size
+
+
+    def make_room(self, tier, size):
+        cap = self.mem_cap if tier == 'mem' else self.disk_cap
+
+        if size > cap:
+            return False
+
+        while self.used[tier] + size > cap:
+            victim = self.victim(tier)
+
+            if victim is None:
+                return False
+
+            batch, victim_size = self.drop(victim)
+
+            if tier == 'mem':
+                self.spill(victim, batch, victim_size)
+
+        return True
+
+
+    def spill(self, i_batch, batch, size):
+        if not self.make_room('disk', size):
+            return
+
+        spill_file = os.path.join(self.spill_path, 'batch_%d.pth' % i_batch)
+
+        torch.save(batch, spill_file)
+
+        self.entries[i_batch] = ('disk', spill_file, size)
+        self.entries.move_to_end(i_batch, last = False)
+        self.used['disk'] += size
+
+
+    def store(self, i_batch, batch):
+        size = num_bytes(batch)
+
+        if not self.make_room('mem', size):
+            return self.spill(i_batch, batch, size)
+
+        for item in batch:
+            if torch.is_tensor(item):
+                item.share_memory_()
+
+        self.entries[i_batch] = ('mem', batch, size)
+        self.used['mem'] += size
+
+
+    def __iter__(self):
+        self.pending = set(self.entries.keys())
+
+        missing = [i_batch for i_batch in range(len(self)) if i_batch not in self.entries]
+
+        regenerated = iter(self.regenerate(missing)) if missing else None
+
+        for i_batch in range(len(self)):
+            if i_batch in self.pending:
+                self.hits += 1
+                yield self.fetch(i_batch)
+            else:
+                self.misses += 1
+                batch = next(regenerated)
+                self.store(i_batch, batch)
+                yield batch
+
+        print('=> validation cache: %d hits, %d misses, %1.1f MB in memory, %1.1f MB on disk' % (self.hits, self.misses, self.used['mem'] / 2 ** 20, self.used['disk'] / 2 ** 20))
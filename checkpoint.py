@@ -0,0 +1,112 @@
+import os
+import queue
+import torch
+import threading
+
+
+def to_cpu(value):
+    '''
+    a copy of a nested state whose tensors live in host memory, so that training may go on updating the originals
+    '''
+    if torch.is_tensor(value):
+        return value.detach().to('cpu', copy = True)
+
+    if isinstance(value, dict):
+        return type(value)((key, to_cpu(item)) for key, item in value.items())
+
+    if isinstance(value, (list, tuple)):
+        return type(value)(to_cpu(item) for item in value)
+
+    return value
+
+
+class CheckpointWriter:
+    '''
+    writes checkpoints from a background thread, each one to a temporary file that is renamed into place,
+    so that a run killed halfway through a write never leaves a truncated checkpoint behind
+    only the keep_last most recent checkpoints survive, together with the one marked as best
+    kept lists the checkpoints of a resumed run from old to new, so that they fall under the same policy
+    a write that fails is raised on the calling thread by the next save or close
+    '''
+    def __init__(self, save_path, keep_last = 0, kept = (), best = None):
+        self.save_path = save_path
+        self.keep_last = keep_last
+
+        self.kept = list(kept)
+        self.best = best
+
+        self.error = None
+
+        self.pending = queue.Queue()
+        self.worker = threading.Thread(target = self.write, daemon = True)
+        self.worker.start()
+
+
+    def save(self, name, checkpoint, best = False):
+        '''
+        snapshots checkpoint to host memory on the calling thread and queues it for writing
+        '''
+        self.raise_error()
+
+        self.pending.put((name, to_cpu(checkpoint), best))
+
+
+    def write(self):
+        while True:
+            item = self.pending.get()
+
+            if item is None:
+                break
+
+            name, checkpoint, best = item
+
+            path = os.path.join(self.save_path, name)
+
+            try:
+                torch.save(checkpoint, path + '.tmp')
+                os.replace(path + '.tmp', path)
+
+                self.retain(name, best)
+            except Exception as error:
+                self.error = error
+
+                if os.path.exists(path + '.tmp'):
+                    os.remove(path + '.tmp')
+
+
+    def raise_error(self):
+        error, self.error = self.error, None
+
+        if error is not None:
+            raise RuntimeError('checkpoint could not be written') from error
+
+
+    def retain(self, name, best):
+        if best:
+            self.best = name
+
+        if name in self.kept:
+            self.kept.remove(name)
+
+        self.kept.append(name)
+
+        if self.keep_last <= 0:
+            return
+
+        stale = [kept for kept in self.kept[:-self.keep_last] if kept != self.best]
+
+        for kept in stale:
+            self.kept.remove(kept)
+
+            if os.path.exists(os.path.join(self.save_path, kept)):
+                os.remove(os.path.join(self.save_path, kept))
+
+
+    def close(self):
+        '''
+        waits until every queued checkpoint is on disk
+        '''
+        self.pending.put(None)
+        self.worker.join()
+
+        self.raise_error()
@@ -0,0 +1,221 @@
+import cameralib
+import numpy as np
+
+
+def inv_2x2(matrices):
+    '''
+    closed-form inverse of (N, 2, 2) matrices, np.linalg.inv costs more than the arithmetic for such small batches
+    '''
+    a, b, c, d = matrices[:, 0, 0], matrices[:, 0, 1], matrices[:, 1, 0], matrices[:, 1, 1]
+
+    inverse = np.stack([d, -b, -c, a], axis = 1).reshape(-1, 2, 2)
+
+    return inverse / (a * d - b * c)[:, None, None]
+
+
+def cross(a, b):
+    return np.stack([
+        a[:, 1] * b[:, 2] - a[:, 2] * b[:, 1],
+        a[:, 2] * b[:, 0] - a[:, 0] * b[:, 2],
+        a[:, 0] * b[:, 1] - a[:, 1] * b[:, 0]
+    ], axis = 1)
+
+
+def undistort_points(points, intrinsics, distortion, n_iters = 5):
+    '''
+    batched counterpart of cv2.undistortPoints, with the same fixed-point iteration
+
+    Args:
+        points: (N, 2) one image point per camera
+        intrinsics: (N, 3, 3)
+        distortion: (N, 5) k1, k2, p1, p2, k3, zeros for cameras without distortion
+
+    Returns:
+        (N, 2) normalized image coordinates
+    '''
+    origin = np.einsum('nij,nj->ni', inv_2x2(intrinsics[:, :2, :2]), points - intrinsics[:, :2, 2])
+
+    if not distortion.any():
+        return origin
+
+    k1, k2, p1, p2, k3 = [distortion[:, i:i + 1] for i in range(5)]
+
+    coords = origin
+
+    for _ in range(n_iters):
+        x, y = coords[:, :1], coords[:, 1:]
+
+        r2 = x * x + y * y
+
+        icdist = 1 / (1 + ((k3 * r2 + k2) * r2 + k1) * r2)
+
+        delta_x = 2 * p1 * x * y + p2 * (r2 + 2 * x * x)
+        delta_y = p1 * (r2 + 2 * y * y) + 2 * p2 * x * y
+
+        coords = (origin - np.concatenate([delta_x, delta_y], axis = 1)) * icdist
+
+    return coords
+
+
+def unit_vec(vectors):
+    return vectors / np.sqrt(np.sum(vectors ** 2, axis = -1, keepdims = True))
+
+
+def crop_cameras(intrinsics, rotation, world_up, distortion, bbox, side_in, zoom, flip):
+    '''
+    vectorized form of turn_towards, undistort, square_pixels, zoom, center_principal_point and horizontal_flip
+    that Dataset.get_crop_camera used to apply to a deep copy of each camera
+
+    Args:
+        intrinsics, rotation: (N, 3, 3) source cameras
+        world_up: (N, 3)
+        distortion: (N, 5) zeros for cameras without distortion
+        bbox: (N, 4) bboxes of the person in the source images
+        zoom: (N,) extra zoom on top of fitting the longer bbox side into side_in
+        flip: (N,) whether to flip the crop horizontally
+
+    Returns:
+        float32 intrinsics and rotations of the (undistorted) crop cameras, crop pixels per source pixel
+        and homographies that bring crop pixels to source pixels
+    '''
+    intrinsics = np.asarray(intrinsics, np.float32)
+    rotation = np.asarray(rotation, np.float32)
+    distortion = np.asarray(distortion, np.float32)
+    bbox = np.asarray(bbox, np.float32)
+    zoom = np.asarray(zoom, np.float32)
+
+    center = bbox[:, :2] + bbox[:, 2:] / 2
+
+    vertical = bbox[:, 2] < bbox[:, 3]
+
+    half_far = np.stack([~vertical, vertical], axis = 1) * bbox[:, 2:] / 2
+
+    points = np.concatenate([center, center - half_far, center + half_far])
+
+    stacked = lambda array: np.concatenate([array] * 3)
+
+    rays = undistort_points(points, stacked(intrinsics), stacked(distortion))
+    rays = np.concatenate([rays, np.ones_like(rays[:, :1])], axis = 1)
+    rays = np.einsum('nji,nj->ni', stacked(rotation), rays)  # world directions
+
+    num = len(bbox)
+
+    target, far_start, far_end = rays[:num], rays[num:num * 2], rays[num * 2:]
+
+    new_z = unit_vec(target)
+    new_x = unit_vec(cross(new_z, np.asarray(world_up, np.float32)))
+    new_y = cross(new_z, new_x)
+
+    new_rotation = np.stack([new_x, new_y, new_z], axis = 1).astype(np.float32)
+
+    focal = (intrinsics[:, 0, 0] + intrinsics[:, 1, 1]) / 2
+
+    new_intrinsics = intrinsics * np.stack([focal / intrinsics[:, 0, 0], focal / intrinsics[:, 1, 1], np.ones_like(focal)], axis = 1)[:, :, None]
+
+    far_start = np.einsum('nij,nj->ni', new_rotation, far_start)
+    far_end = np.einsum('nij,nj->ni', new_rotation, far_end)
+
+    far_side = far_start[:, :2] / far_start[:, 2:] - far_end[:, :2] / far_end[:, 2:]
+    far_dist = np.sqrt(np.sum(np.einsum('nij,nj->ni', new_intrinsics[:, :2, :2], far_side) ** 2, axis = 1))
+
+    scale = side_in / far_dist * zoom
+
+    new_intrinsics[:, :2, :2] *= scale[:, None, None]
+    new_intrinsics[:, :2, 2] = side_in / 2
+
+    new_rotation[:, 0] *= (1 - 2 * np.asarray(flip, np.float32))[:, None]
+
+    inv_intrinsics = np.zeros_like(new_intrinsics)
+    inv_intrinsics[:, :2, :2] = inv_2x2(new_intrinsics[:, :2, :2])
+    inv_intrinsics[:, :2, 2] = np.einsum('nij,nj->ni', inv_intrinsics[:, :2, :2], - new_intrinsics[:, :2, 2])
+    inv_intrinsics[:, 2, 2] = 1
+
+    homography = intrinsics @ rotation @ np.transpose(new_rotation, (0, 2, 1)) @ inv_intrinsics
+
+    return new_intrinsics, new_rotation, scale, homography.astype(np.float32)
+
+
+def camera_arrays(cameras):
+    '''
+    stacks cameralib.Camera objects into the (intrinsics, rotation, world_up, distortion) arrays of crop_cameras
+    '''
+    return (
+        np.stack([camera.intrinsic_matrix for camera in cameras]),
+        np.stack([camera.R for camera in cameras]),
+        np.stack([camera.world_up for camera in cameras]),
+        np.stack([np.zeros(5) if camera.distortion_coeffs is None else camera.distortion_coeffs for camera in cameras])
+    )
+
+
+def crop_table(intrinsics, rotation, world_up, distortion, bbox, side_in):
+    '''
+    crop cameras of a whole sample store without zoom and flip, computed in one batch
+
+    Returns:
+        dict of the intrinsics, rotation and scale arrays of a CropTable
+    '''
+    num = len(bbox)
+
+    intrinsics, rotation, scale, _ = crop_cameras(intrinsics, rotation, world_up, distortion, bbox, side_in, np.ones(num), np.zeros(num, bool))
+
+    return dict(intrinsics = intrinsics, rotation = rotation, scale = scale)
+
+
+class CropTable:
+    '''
+    crop cameras of every row of a sample store without zoom and flip, as computed by crop_table
+    zoom and flip are the only random parts of a crop, so a sample only has to apply them to its row
+    '''
+    def __init__(self, intrinsics, rotation, scale):
+        self.intrinsics = intrinsics
+        self.rotation = rotation
+        self.scale = scale
+
+
+    def camera(self, index, camera, zoom, do_flip):
+        '''
+        Args:
+            index: row of the sample in the store
+            camera: source camera of the sample, which provides the optical center and the world up vector
+
+        Returns:
+            camera of the crop and the number of crop pixels per source pixel
+        '''
+        intrinsics = self.intrinsics[index].copy()
+        intrinsics[:2, :2] *= zoom
+
+        rotation = self.rotation[index].copy()
+
+        if do_flip:
+            rotation[0] *= -1
+
+        return cameralib.Camera(camera.t, rotation, intrinsics, None, camera.world_up), float(self.scale[index]) * zoom
+
+
+def center_crops(intrinsics, box_center, expand_side, scale_factor):
+    '''
+    vectorized form of shift_to_center followed by scale_output, as used when samples are cut out of full frames
+
+    Args:
+        intrinsics: (N, 3, 3)
+        box_center: (N, 2) source pixels that end up in the middle of the crops
+        expand_side: (N,) side of the crops before scaling
+        scale_factor: (N,)
+
+    Returns:
+        float32 intrinsics of the crops and the affine maps (N, 2, 3) that bring source pixels to crop pixels
+    '''
+    expand_side = np.asarray(expand_side, np.float32)
+    scale_factor = np.asarray(scale_factor, np.float32)
+
+    shift = expand_side[:, None] / 2 - np.asarray(box_center, np.float32)
+
+    new_intrinsics = np.array(intrinsics, np.float32)
+    new_intrinsics[:, :2, 2] += shift
+    new_intrinsics[:, :2] *= scale_factor[:, None, None]
+
+    affine = np.zeros((len(scale_factor), 2, 3), np.float32)
+    affine[:, 0, 0] = affine[:, 1, 1] = scale_factor
+    affine[:, :, 2] = shift * scale_factor[:, None]
+
+    return new_intrinsics, affine
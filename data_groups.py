@@ -11,6 +11,7 @@ import glob
 import pickle5 as pickle
 import numpy as np
 import cameralib
+import crop_geometry
 import transforms3d
 import multiprocessing
 import spacepy.pycdf as pycdf
@@ -50,11 +51,11 @@ def make_sample(sample, camera, image, args):
 
 	dest_side = int(np.round(expand_side * scale_factor))
 
-	new_cam = copy.deepcopy(camera)
-	new_cam.shift_to_center(box_center, (expand_side, expand_side))
-	new_cam.scale_output(scale_factor)
+	intrinsics, affine = crop_geometry.center_crops(camera.intrinsic_matrix[None], box_center[None], [expand_side], [scale_factor])
 
-	new_bbox = cameralib.reproject_points(sample['bbox'][None, :2], camera, new_cam)[0]
+	new_cam = cameralib.Camera(camera.t, camera.R, intrinsics[0], camera.distortion_coeffs, camera.world_up)
+
+	new_bbox = affine[0] @ np.append(sample['bbox'][:2], 1)
 
 	new_bbox = np.concatenate([new_bbox, sample['bbox'][2:] * scale_factor])
 
@@ -8,15 +8,22 @@ import random
 import matplotlib.pyplot as plt
 import matplotlib.patches as patches
 import cameralib
+import crop_geometry
+import decoders
+import device_pipeline
+import distributed
 import torch
 import utils
+import augment_occluder
 import pickle5 as pickle
+import sample_store
 import glob
 import torch.utils.data as data
 
 from torchvision import datasets
 from torchvision import transforms
 from augment_colour import random_color
+from augment_colour import random_color_fast
 
 
 def data_loader(args, phase, data_info):
@@ -24,7 +31,20 @@ def data_loader(args, phase, data_info):
 
     shuffle = args.shuffle if phase == 'train' else False
 
-    return data.DataLoader(dataset, args.batch_size, shuffle, num_workers = args.workers, pin_memory = True)
+    if distributed.enabled() and phase != 'train':
+        batch_sampler = distributed.EvalBatchSampler(len(dataset), args.batch_size)
+    else:
+        sampler = distributed.make_sampler(dataset, shuffle)
+
+        if sampler is None:
+            sampler = data.RandomSampler(dataset) if shuffle else data.SequentialSampler(dataset)
+
+        batch_sampler = data.BatchSampler(sampler, args.batch_size, False)
+
+    if args.device_warp or args.uint8_batches:
+        return device_pipeline.data_loader(dataset, batch_sampler, args)
+
+    return data.DataLoader(dataset, batch_sampler = batch_sampler, num_workers = args.workers, pin_memory = True)
 
 
 def h36m_split(split, phase, sample):
@@ -55,81 +75,89 @@ class Dataset(data.Dataset):
 
         self.nexponent = args.nexponent
         self.colour = args.colour and (not self.at_test)
+        self.random_color = random_color_fast if args.fast_colour else random_color
+        self.occluder = args.occluder and (not self.at_test) and (not args.batch_occluder)
         self.geometry = args.geometry and (not self.at_test)
         self.random_zoom = args.random_zoom
+        self.decoder = args.decoder
+        self.device_warp = args.device_warp
+        self.uint8_batches = args.uint8_batches and (not self.device_warp)
+        self.canvas_side = args.canvas_side
 
         self.transform = transforms.Compose([
             transforms.ToTensor(),
             transforms.Normalize(mean = self.mean, std = self.dev)])
 
+        crops = lambda store: crop_geometry.crop_table(*store.camera_columns(), store.column('bbox'), self.side_in)
 
-    def get_h36m_samples(self, phase, split_by):
-        sample_file = os.path.join(self.root, 'samples.pkl')
+        self.crops = crop_geometry.CropTable(**self.samples.derive('crops_' + str(self.side_in), crops))
+
+        assert not (self.device_warp and self.occluder), 'please paste occluders with -batch_occluder under device warping'
+
+        if self.occluder:
+            self.occluders = augment_occluder.OccluderAtlas(args.occ_path)
 
-        with open(sample_file, 'rb') as file:
-            samples = pickle.load(file)
+
+    def load_h36m_samples(self):
+        with open(os.path.join(self.root, 'samples.pkl'), 'rb') as file:
+            return pickle.load(file)
+
+
+    def get_h36m_samples(self, phase, split_by):
+        store = sample_store.load_or_build(os.path.join(self.root, 'sample_store'), self.load_h36m_samples)
 
         with open(os.path.join(self.root, 'split.json')) as file:
             split = json.load(file)
 
-        return [sample for sample in samples if split_by(split, phase, sample)]
+        return store.select(split_by, split, phase)
 
 
-    def get_input_image(self, image_path, camera, bbox, do_flip, random_zoom):
+    def get_crop_camera(self, camera, crop, do_flip, random_zoom):
         '''
-        Turn towards the center of bbox then crop a square-shaped image aligned with the height of the bbox
+        Turn towards the center of bbox then zoom onto a square-shaped crop aligned with the height of the bbox
         Args:
-            image_path: path to the image that matches the camera's current state
             camera: current state of the camera
-            bbox: bbox of the person that matches the camera's current state
-        '''
-        center = bbox[:2] + bbox[2:] / 2
-        
-        width = np.array([bbox[2] / 2, 0])
-        height = np.array([0, bbox[3] / 2])
-
-        if bbox[2] < bbox[3]:
-            vertical = True
-            near_side = np.stack([center - width, center + width])
-            far_side = np.stack([center - height, center + height])
-        else:
-            vertical = False
-            far_side = np.stack([center - width, center + width])
-            near_side = np.stack([center - height, center + height])
+            crop: (CropTable, row) that holds the crop of the sample up to zoom and flip
 
-        new_cam = copy.deepcopy(camera)
-        new_cam.turn_towards(center)
-        new_cam.undistort()
-        new_cam.square_pixels()
-
-        far_side = new_cam.world_to_image(camera.image_to_world(far_side))
-
-        far_dist = np.linalg.norm(far_side[0] - far_side[1])
+        Returns:
+            camera of the crop and the number of crop pixels per source pixel
+        '''
+        table, index = crop
 
-        new_cam.zoom(self.side_in / far_dist)
-        new_cam.center_principal_point((self.side_in, self.side_in))
+        return table.camera(index, camera, random_zoom if self.geometry else 1.0, do_flip)
 
-        if self.geometry:
-            new_cam.zoom(random_zoom)
 
-        if do_flip:
-            new_cam.horizontal_flip()
+    def get_input_image(self, image_path, camera, crop, do_flip, random_zoom):
+        '''
+        Crops a square-shaped image around the bbox
+        Args:
+            image_path: path to the image that matches the camera's current state
+            camera: current state of the camera
+            crop: (CropTable, row) that holds the crop of the sample up to zoom and flip
+        '''
+        new_cam, zoom = self.get_crop_camera(camera, crop, do_flip, random_zoom)
 
-        image = plt.imread(image_path)
+        image, camera = decoders.read_image(self.decoder, image_path, camera, zoom)
         image = cameralib.reproject_image(image, camera, new_cam, (self.side_in, self.side_in))
 
         return image, new_cam
 
 
-    def parse_sample(self, sample):
-        do_flip = (not self.at_test) and (np.random.rand() < 0.5)
+    def get_input_canvas(self, image_path, camera, crop, do_flip, random_zoom):
+        '''
+        Decodes the image onto a fixed-size canvas and leaves the crop to device_pipeline
+        Returns:
+            canvas, homography from crop pixels to canvas pixels and camera of the crop
+        '''
+        new_cam, zoom = self.get_crop_camera(camera, crop, do_flip, random_zoom)
 
-        random_zoom = np.random.uniform(self.random_zoom, self.random_zoom ** (-1))
+        image, camera = decoders.read_image(self.decoder, image_path, camera, zoom)
+        canvas, homography = device_pipeline.to_canvas(image, camera, new_cam, self.canvas_side)
 
-        color_image, new_color_cam = self.get_input_image(sample['image'], sample['camera'], sample['bbox'], do_flip, random_zoom)
+        return canvas, homography, new_cam
 
-        color_image = self.transform(random_color(color_image) if self.colour else color_image.copy())
 
+    def parse_targets(self, sample, new_color_cam, do_flip):
         world_coords = sample['skeleton']
         camera_coords = new_color_cam.world_to_camera(world_coords)
         valid = sample['valid']
@@ -141,13 +169,62 @@ class Dataset(data.Dataset):
         if self.at_test:
             back_rotate = sample['camera'].R @ new_color_cam.R.T
 
-            return color_image, camera_coords, valid, back_rotate
+            return camera_coords, valid, back_rotate
         else:
-            return color_image, camera_coords, valid
+            return camera_coords, valid
+
+
+    def parse_sample(self, sample):
+        do_flip = (not self.at_test) and (np.random.rand() < 0.5)
+
+        random_zoom = np.random.uniform(self.random_zoom, self.random_zoom ** (-1))
+
+        color_image, new_color_cam = self.get_input_image(sample['image'], sample['camera'], sample['crop'], do_flip, random_zoom)
+
+        if self.occluder:
+            color_image = self.occluders.occlude(color_image)
+
+        color_image = self.random_color(color_image) if self.colour else color_image.copy()
+
+        if not self.uint8_batches:
+            color_image = self.transform(color_image)
+
+        return (color_image,) + self.parse_targets(sample, new_color_cam, do_flip)
+
+
+    def parse_canvas(self, sample):
+        do_flip = (not self.at_test) and (np.random.rand() < 0.5)
+
+        random_zoom = np.random.uniform(self.random_zoom, self.random_zoom ** (-1))
+
+        color_canvas, color_homography, new_color_cam = self.get_input_canvas(sample['image'], sample['camera'], sample['crop'], do_flip, random_zoom)
+
+        return (color_canvas, color_homography) + self.parse_targets(sample, new_color_cam, do_flip)
+
+
+    def get_sample(self, index):
+        sample = self.samples[index]
+        sample['crop'] = (self.crops, self.samples.rows[index])
+
+        return sample
 
 
     def __getitem__(self, index):
-        return self.parse_sample(self.samples[index])
+        if self.device_warp:
+            return self.parse_canvas(self.get_sample(index))
+
+        return self.parse_sample(self.get_sample(index))
+
+
+    def __getitems__(self, indices):
+        return device_pipeline.tagged_samples(self, indices)
+
+
+    def image_keys(self):
+        '''
+        positions of the images that the device pipeline takes over in a sample, the colour canvas under device warping, the colour crop otherwise
+        '''
+        return (0,)
 
 
     def __len__(self):
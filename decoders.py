@@ -0,0 +1,122 @@
+import os
+import cv2
+import copy
+import jpeg4py
+import numpy as np
+import matplotlib.pyplot as plt
+
+
+reduced_flags = {
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8
+}
+
+
+def is_jpeg(image_path):
+    return os.path.splitext(image_path)[1].lower() in ('.jpg', '.jpeg')
+
+
+def reduce_factor(zoom):
+    '''
+    picks the largest DCT reduction that still leaves the decoded image at least as dense as the crop
+
+    Args:
+        zoom: output pixels per source pixel of the crop that is about to be warped
+    '''
+    for factor in (8, 4, 2):
+        if factor * zoom <= 1.0:
+            return factor
+
+    return 1
+
+
+class ReadBuffer:
+    '''
+    a growing byte array that encoded files are read into, reused across calls instead of a fresh bytes object per image
+    a buffer must not be shared between threads
+    '''
+    def __init__(self):
+        self.array = np.empty(0, dtype = np.uint8)
+
+
+    def read(self, image_path):
+        with open(image_path, 'rb', buffering = 0) as file:
+            size = os.fstat(file.fileno()).st_size
+
+            if self.array.size < size:
+                self.array = np.empty(size + size // 4, dtype = np.uint8)
+
+            view = memoryview(self.array)
+            offset = 0
+
+            while offset < size:
+                offset += file.readinto(view[offset:size])
+
+        return self.array[:size]
+
+
+def pyplot_decode(image_path, zoom, buffer = None):
+    return plt.imread(image_path), 1
+
+
+def jpeg4py_decode(image_path, zoom, buffer = None):
+    if not is_jpeg(image_path):
+        return pyplot_decode(image_path, zoom)
+
+    return jpeg4py.JPEG(image_path).decode(), 1
+
+
+def opencv_decode(image_path, zoom, buffer = None):
+    '''
+    decodes jpeg images at 1/2, 1/4 or 1/8 resolution straight from the DCT coefficients
+    16-bit pngs (depth frames) are read from the buffer and brought to the value range of pyplot
+    other formats are left to pyplot
+    '''
+    if not is_jpeg(image_path):
+        if buffer is None or os.path.splitext(image_path)[1].lower() != '.png':
+            return pyplot_decode(image_path, zoom)
+
+        image = cv2.imdecode(buffer.read(image_path), cv2.IMREAD_UNCHANGED)
+
+        if image.dtype != np.uint16 or image.ndim != 2:
+            return pyplot_decode(image_path, zoom)
+
+        return np.divide(image, 2 ** 16 - 1, dtype = np.float32), 1
+
+    factor = reduce_factor(zoom)
+    flag = reduced_flags[factor] if factor != 1 else cv2.IMREAD_COLOR
+
+    image = cv2.imread(image_path, flag) if buffer is None else cv2.imdecode(buffer.read(image_path), flag)
+
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB), factor
+
+
+decoders = dict(
+    pyplot = pyplot_decode,
+    jpeg4py = jpeg4py_decode,
+    opencv = opencv_decode
+)
+
+
+def read_image(decoder, image_path, camera, zoom, buffer = None):
+    '''
+    decodes an image with the given decoder and returns the camera that matches the decoded resolution
+
+    Args:
+        decoder: name of the decoder to use
+        image_path: path to the image that matches the camera's current state
+        camera: current state of the camera
+        zoom: output pixels per source pixel of the crop that is about to be warped
+        buffer: optional ReadBuffer that the encoded bytes are read into
+    '''
+    image, factor = decoders[decoder](image_path, zoom, buffer)
+
+    if factor == 1:
+        return image, camera
+
+    new_cam = copy.deepcopy(camera)
+    new_cam.scale_output(1.0 / factor)
+    new_cam.intrinsic_matrix[:2, 2] += 0.5 / factor - 0.5
+
+    return image, new_cam
@@ -9,15 +9,24 @@ import matplotlib.pyplot as plt
 import matplotlib.patches as patches
 import depth_groups
 import cameralib
+import crop_geometry
+import decoders
+import device_pipeline
+import distributed
 import torch
 import utils
+import augment_occluder
 import pickle5 as pickle
+import sample_store
+import teacher_store
 import glob
+import concurrent.futures
 import torch.utils.data as data
 
 from torchvision import datasets
 from torchvision import transforms
 from augment_colour import random_color
+from augment_colour import random_color_fast
 
 
 def data_loader(args, phase, data_info):
@@ -25,7 +34,89 @@ def data_loader(args, phase, data_info):
 
     shuffle = args.shuffle if phase == 'train' else False
 
-    return data.DataLoader(dataset, args.batch_size, shuffle, num_workers = args.workers, pin_memory = True)
+    if distributed.enabled() and phase != 'train':
+        batch_sampler = distributed.EvalBatchSampler(len(dataset), args.batch_size)
+    else:
+        sampler = distributed.make_sampler(dataset, shuffle)
+
+        if sampler is None:
+            sampler = data.RandomSampler(dataset) if shuffle else data.SequentialSampler(dataset)
+
+        batch_sampler = data.BatchSampler(sampler, args.batch_size, False)
+
+    if args.device_warp or args.uint8_batches:
+        return device_pipeline.data_loader(dataset, batch_sampler, args)
+
+    return data.DataLoader(dataset, batch_sampler = batch_sampler, num_workers = args.workers, pin_memory = True)
+
+
+def bake_shards(args, phase, data_info):
+    '''
+    Writes the deterministic valid / test crops of the given phase into memory-mapped shards,
+    so that later evaluation passes only need to read them back
+    under a distributed launch every rank opens the dataset, but only the main rank writes the shards
+    '''
+    dataset = Dataset(data_info, phase, args)
+
+    assert dataset.at_test
+
+    if not distributed.is_main():
+        return
+
+    bake_path = dataset.bake_path(phase)
+
+    if not os.path.exists(bake_path):
+        os.mkdir(bake_path)
+
+    num_samples = len(dataset)
+    num_joints = len(data_info.short_names)
+    side_in = dataset.side_in
+
+    shapes = dict(
+        color = ((num_samples, side_in, side_in, 3), np.uint8),
+        depth = ((num_samples, 1, side_in, side_in), np.float16),
+        camera_coords = ((num_samples, num_joints, 3), np.float32),
+        valid = ((num_samples, num_joints), np.bool_),
+        back_rotate = ((num_samples, 3, 3), np.float32)
+    )
+    shards = dict()
+
+    for key, (shape, dtype) in shapes.items():
+        shards[key] = np.lib.format.open_memmap(os.path.join(bake_path, key + '.npy'), mode = 'w+', dtype = dtype, shape = shape)
+
+    baker = data.DataLoader(Baker(dataset), args.batch_size, False, num_workers = args.workers)
+
+    start = 0
+
+    for i_batch, batch in enumerate(baker):
+        stop = start + batch[0].size(0)
+
+        for key, array in zip(Baker.keys, batch):
+            shards[key][start:stop] = array.numpy()
+
+        start = stop
+
+        print('=> bakes [', phase, '] batch [', i_batch, '|', len(baker), ']')
+
+    for key in shards:
+        shards[key].flush()
+
+    with open(os.path.join(bake_path, 'meta.json'), 'w') as file:
+        json.dump(dataset.bake_meta(), file)
+
+
+class Baker(data.Dataset):
+
+    keys = ('color', 'depth', 'camera_coords', 'valid', 'back_rotate')
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __getitem__(self, index):
+        return self.dataset.bake_sample(self.dataset.get_sample(index))
+
+    def __len__(self):
+        return len(self.dataset)
 
 
 def ntu_split(split, phase, sample):
@@ -36,24 +127,36 @@ def pku_split(split, phase, sample):
     return sample['video'] in split[phase]
 
 
-def enhance_ntu(image, nexponent):
-    image = image / (10.0 / 255.0)
+def enhance(image, thresh, nexponent, scale):
+    '''
+    converts a raw depth crop into network input within a single float32 buffer
+
+    Args:
+        scale: optional per-pixel factor of utils.to_depth that is folded into the first multiplication
+    '''
+    factor = 255.0 / 10.0 if scale is None else scale * (255.0 / 10.0)
+
+    image = np.multiply(image, factor, dtype = np.float32)
 
-    veil = (0.1 <= image).astype(np.float)
+    if nexponent:
+        veil = (thresh <= image)
 
-    dest = np.multiply(np.exp(-image), veil) if nexponent else (image / 3.0)
+        np.negative(image, out = image)
+        np.exp(image, out = image)
 
-    return dest.astype(np.float32)[np.newaxis, :, :]
+        image *= veil
+    else:
+        image /= 3.0
 
+    return image[np.newaxis, :, :]
 
-def enhance_pku(image, nexponent):
-    image = image / (10.0 / 255.0)
 
-    veil = (0.5 <= image).astype(np.float)
+def enhance_ntu(image, nexponent, scale = None):
+    return enhance(image, 0.1, nexponent, scale)
 
-    dest = np.multiply(np.exp(-image), veil) if nexponent else (image / 3.0)
 
-    return dest.astype(np.float32)[np.newaxis, :, :]
+def enhance_pku(image, nexponent, scale = None):
+    return enhance(image, 0.5, nexponent, scale)
 
 
 class Dataset(data.Dataset):
@@ -80,18 +183,100 @@ class Dataset(data.Dataset):
 
         self.nexponent = args.nexponent
         self.colour = args.colour and (not self.at_test)
+        self.random_color = random_color_fast if args.fast_colour else random_color
+        self.occluder = args.occluder and (not self.at_test) and (not args.batch_occluder)
         self.geometry = args.geometry and (not self.at_test)
         self.random_zoom = args.random_zoom
+        self.decoder = args.decoder
+        self.canvas_side = args.canvas_side
         self.to_depth = args.to_depth
 
+        self.parallel_decode = args.parallel_decode
+        self.buffers = dict(color = decoders.ReadBuffer(), depth = decoders.ReadBuffer())
+        self.pool = None
+        self.pool_pid = None
+
         self.do_teach = args.do_teach
-        self.attention = args.attention
-        self.stride = args.stride
+
+        cached = (args.teach_store or args.bake_teacher) and (not self.at_test)
+
+        # without geometry augmentation the zoom is not applied, so a single bin covers every crop
+        zoom_bins = args.zoom_bins if self.geometry else 1
+
+        self.zoom_levels = teacher_store.zoom_levels(args.random_zoom, zoom_bins) if cached else None
+        self.fixed_state = None
+
+        self.store = None
+
+        if cached and self.do_teach and (not args.bake_teacher):
+            self.store = teacher_store.TeacherStore(teacher_store.store_path(args, self.data_name))
+            self.store.check(self.store_meta())
 
         self.transform = transforms.Compose([
             transforms.ToTensor(),
             transforms.Normalize(mean = self.mean, std = self.dev)])
 
+        self.shards = self.load_shards(phase) if (args.baked and self.at_test) else None
+
+        if self.shards is None:
+            self.init_crops()
+
+        self.device_warp = args.device_warp and (self.shards is None)
+        self.uint8_batches = args.uint8_batches and (not self.device_warp)
+
+        assert not (self.device_warp and self.to_depth)
+        assert not (self.device_warp and self.occluder), 'please paste occluders with -batch_occluder under device warping'
+
+        if self.occluder:
+            self.occluders = augment_occluder.OccluderAtlas(args.occ_path)
+
+
+    def store_meta(self):
+        return dict(num_samples = len(self.samples), zoom_bins = len(self.zoom_levels), random_zoom = self.random_zoom, geometry = self.geometry, side_in = self.side_in, nexponent = self.nexponent, to_depth = self.to_depth)
+
+
+    def bake_path(self, phase):
+        return os.path.join(self.root, 'baked_' + phase + '_' + str(self.side_in))
+
+
+    def bake_meta(self):
+        return dict(num_samples = len(self.samples), side_in = self.side_in, nexponent = self.nexponent, to_depth = self.to_depth, decoder = self.decoder)
+
+
+    def load_shards(self, phase):
+        bake_path = self.bake_path(phase)
+
+        with open(os.path.join(bake_path, 'meta.json')) as file:
+            meta = json.load(file)
+
+        assert meta == self.bake_meta(), 'shards at ' + bake_path + ' are stale, please bake them again'
+
+        return {key: np.load(os.path.join(bake_path, key + '.npy'), mmap_mode = 'r') for key in Baker.keys}
+
+
+    def init_crops(self):
+        '''
+        crop geometry of every row of the sample store up to zoom and flip, for both modalities
+        it is computed in one batch each when the store is first used at side_in and read back from the store afterwards
+        '''
+        color_crops = lambda store: crop_geometry.crop_table(*store.camera_columns(), store.column('bbox'), self.side_in)
+
+        self.crops = crop_geometry.CropTable(**self.samples.derive('crops_' + str(self.side_in), color_crops))
+        self.depth_crops = crop_geometry.CropTable(**self.samples.derive('depth_crops_' + str(self.side_in), self.depth_crop_table))
+
+
+    def depth_crop_table(self, store):
+        '''
+        the depth camera only depends on the video, so it is looked up once per video rather than once per row
+        '''
+        videos, inverse = np.unique(store.column('video'), return_inverse = True)
+
+        depth_cam = getattr(self, 'depth_cam_' + self.data_name)
+
+        depth_cams = crop_geometry.camera_arrays([depth_cam(dict(video = video.decode('utf-8'))) for video in videos])
+
+        return crop_geometry.crop_table(*(array[inverse] for array in depth_cams), store.column('depth_bbox'), self.side_in)
+
 
     def init_ntu(self):
         with open(os.path.join(self.root, 'depth_cameras.pkl'), 'rb') as file:
@@ -123,7 +308,7 @@ class Dataset(data.Dataset):
         return os.path.join(self.root, 'DEPTH_IMAGE', sample['video'] + '.' + str(sample['frame']) + '.png')
 
 
-    def get_ntu_samples(self, phase, split_by):
+    def load_ntu_samples(self):
         sample_files = glob.glob(os.path.join(self.root, 'final_samples', '*.pkl'))
 
         samples = []
@@ -132,90 +317,158 @@ class Dataset(data.Dataset):
             with open(sample_file, 'rb') as file:
                 samples += pickle.load(file)
 
+        return samples
+
+
+    def load_pku_samples(self):
+        with open(os.path.join(self.root, 'final_samples.pkl'), 'rb') as file:
+            return pickle.load(file)
+
+
+    def get_ntu_samples(self, phase, split_by):
+        store = sample_store.load_or_build(os.path.join(self.root, 'sample_store'), self.load_ntu_samples)
+
         with open(os.path.join(self.root, 'split.json')) as file:
             split = json.load(file)
 
-        return [sample for sample in samples if split_by(split, phase, sample)]
+        return store.select(split_by, split, phase)
 
 
     def get_pku_samples(self, phase, split_by):
-        sample_file = os.path.join(self.root, 'final_samples.pkl')
-
-        with open(sample_file, 'rb') as file:
-            samples = pickle.load(file)
+        store = sample_store.load_or_build(os.path.join(self.root, 'sample_store'), self.load_pku_samples)
 
         with open(os.path.join(self.root, 'split.json')) as file:
             split = json.load(file)
 
-        return [sample for sample in samples if split_by(split, phase, sample)]
+        return store.select(split_by, split, phase)
+
+
+    def get_crop_camera(self, camera, crop, do_flip, random_zoom):
+        '''
+        Turn towards the center of bbox then zoom onto a square-shaped crop aligned with the height of the bbox
+        Args:
+            camera: current state of the camera
+            crop: (CropTable, row) that holds the crop of the sample up to zoom and flip
+
+        Returns:
+            camera of the crop and the number of crop pixels per source pixel
+        '''
+        table, index = crop
 
+        return table.camera(index, camera, random_zoom if self.geometry else 1.0, do_flip)
 
-    def get_input_image(self, image_path, camera, bbox, do_flip, random_zoom):
+
+    def get_input_image(self, image_path, camera, crop, do_flip, random_zoom, buffer = None):
         '''
-        Turn towards the center of bbox then crop a square-shaped image aligned with the height of the bbox
+        Crops a square-shaped image around the bbox
         Args:
             image_path: path to the image that matches the camera's current state
             camera: current state of the camera
-            bbox: bbox of the person that matches the camera's current state
+            crop: (CropTable, row) that holds the crop of the sample up to zoom and flip
         '''
-        center = bbox[:2] + bbox[2:] / 2
-        
-        width = np.array([bbox[2] / 2, 0])
-        height = np.array([0, bbox[3] / 2])
-
-        if bbox[2] < bbox[3]:
-            vertical = True
-            near_side = np.stack([center - width, center + width])
-            far_side = np.stack([center - height, center + height])
-        else:
-            vertical = False
-            far_side = np.stack([center - width, center + width])
-            near_side = np.stack([center - height, center + height])
+        new_cam, zoom = self.get_crop_camera(camera, crop, do_flip, random_zoom)
 
-        new_cam = copy.deepcopy(camera)
-        new_cam.turn_towards(center)
-        new_cam.undistort()
-        new_cam.square_pixels()
+        image, camera = decoders.read_image(self.decoder, image_path, camera, zoom, buffer)
+        image = cameralib.reproject_image(image, camera, new_cam, (self.side_in, self.side_in))
 
-        far_side = new_cam.world_to_image(camera.image_to_world(far_side))
+        return image, new_cam
 
-        far_dist = np.linalg.norm(far_side[0] - far_side[1])
 
-        new_cam.zoom(self.side_in / far_dist)
-        new_cam.center_principal_point((self.side_in, self.side_in))
+    def get_input_canvas(self, image_path, camera, crop, do_flip, random_zoom, buffer = None):
+        '''
+        Decodes the image onto a fixed-size canvas and leaves the crop to device_pipeline
+        Returns:
+            canvas, homography from crop pixels to canvas pixels and camera of the crop
+        '''
+        new_cam, zoom = self.get_crop_camera(camera, crop, do_flip, random_zoom)
 
-        if self.geometry:
-            new_cam.zoom(random_zoom)
+        image, camera = decoders.read_image(self.decoder, image_path, camera, zoom, buffer)
+        canvas, homography = device_pipeline.to_canvas(image, camera, new_cam, self.canvas_side)
 
-        if do_flip:
-            new_cam.horizontal_flip()
+        return canvas, homography, new_cam
 
-        image = plt.imread(image_path)
-        image = cameralib.reproject_image(image, camera, new_cam, (self.side_in, self.side_in))
 
-        return image, new_cam
+    def get_pool(self):
+        '''
+        a single helper thread per dataloader worker, created lazily since threads do not survive the fork into workers
+        '''
+        if self.pool_pid != os.getpid():
+            self.pool = concurrent.futures.ThreadPoolExecutor(max_workers = 1)
+            self.pool_pid = os.getpid()
 
+        return self.pool
 
-    def parse_sample(self, sample):
+
+    def run_depth(self, function, *args):
+        '''
+        starts the depth half of a sample on the helper thread under parallel_decode, while the caller goes on with colour
+        cv2 and the image decoders release the GIL, so both halves overlap
+        '''
+        if self.parallel_decode:
+            return self.get_pool().submit(function, *args).result
+
+        result = function(*args)
+
+        return lambda: result
+
+
+    def crop_depth(self, sample, do_flip, random_zoom):
         depth_cam = getattr(self, 'depth_cam_' + self.data_name)(sample)
         depth_image = getattr(self, 'depth_image_' + self.data_name)(sample)
 
-        do_flip = (not self.at_test) and (np.random.rand() < 0.5)
+        depth_image, new_depth_cam = self.get_input_image(depth_image, depth_cam, sample['depth_crop'], do_flip, random_zoom, self.buffers['depth'])
 
-        random_zoom = np.random.uniform(self.random_zoom, self.random_zoom ** (-1))
+        depth_image = depth_image.squeeze()
 
-        color_image, new_color_cam = self.get_input_image(sample['image'], sample['camera'], sample['bbox'], do_flip, random_zoom)
-        depth_image, new_depth_cam = self.get_input_image(depth_image, depth_cam, sample['depth_bbox'], do_flip, random_zoom)
+        scale = utils.ray_scales.get(depth_cam, depth_image.shape) if self.to_depth else None
 
-        color_image = self.transform(random_color(color_image) if self.colour else color_image.copy())
+        return globals()['enhance_' + self.data_name](depth_image, self.nexponent, scale)
+
+
+    def bake_sample(self, sample):
+        color_image, new_color_cam = self.get_input_image(sample['image'], sample['camera'], sample['crop'], False, 1.0, self.buffers['color'])
+
+        depth_image = self.crop_depth(sample, False, 1.0)
+
+        camera_coords = new_color_cam.world_to_camera(sample['skeleton'])
+        back_rotate = sample['camera'].R @ new_color_cam.R.T
+
+        return color_image, depth_image.astype(np.float16), camera_coords, sample['valid'], back_rotate
+
+
+    def read_shards(self, index):
+        color_image = np.array(self.shards['color'][index])
+        depth_image = np.array(self.shards['depth'][index])
+
+        if not self.uint8_batches:
+            color_image = self.transform(color_image)
+            depth_image = depth_image.astype(np.float32)
+
+        camera_coords = np.array(self.shards['camera_coords'][index])
+        valid = np.array(self.shards['valid'][index])
+        back_rotate = np.array(self.shards['back_rotate'][index])
+
+        return color_image, depth_image, camera_coords, valid, back_rotate
 
-        depth_image = depth_image.squeeze()
 
-        if self.to_depth:
-            depth_image = utils.to_depth(depth_image, depth_cam)
+    def draw_augment(self):
+        '''
+        Returns:
+            whether to flip, the zoom and the augmentation state of the teacher store, which is None without one
+        '''
+        if self.zoom_levels is None:
+            do_flip = (not self.at_test) and (np.random.rand() < 0.5)
+
+            return do_flip, np.random.uniform(self.random_zoom, self.random_zoom ** (-1)), None
+
+        state = self.fixed_state if self.fixed_state is not None else np.random.randint(len(self.zoom_levels) * 2)
+
+        do_flip, zoom_bin = divmod(state, len(self.zoom_levels))
 
-        depth_image = globals()['enhance_' + self.data_name](depth_image, self.nexponent)
+        return bool(do_flip), self.zoom_levels[zoom_bin], state
 
+
+    def parse_targets(self, sample, new_color_cam, do_flip, state = None):
         world_coords = sample['skeleton']
         camera_coords = new_color_cam.world_to_camera(world_coords)
         valid = sample['valid']
@@ -226,19 +479,87 @@ class Dataset(data.Dataset):
 
         if self.at_test:
             back_rotate = sample['camera'].R @ new_color_cam.R.T
-            return color_image, depth_image, camera_coords, valid, back_rotate
+            return camera_coords, valid, back_rotate
 
         elif self.do_teach:
-            image_coords = new_color_cam.camera_to_image(camera_coords)
-            atten_map = utils.get_attention(self.side_in, self.stride, image_coords, self.attention)
-            return color_image, depth_image, camera_coords, valid, atten_map
+            image_coords = new_color_cam.camera_to_image(camera_coords).astype(np.float32)
+
+            if self.store is not None:
+                return camera_coords, valid, image_coords, self.store.fetch('last_feat', sample['index'], state)
+
+            return camera_coords, valid, image_coords
 
         else:
-            return color_image, depth_image, camera_coords, valid
+            return camera_coords, valid
+
+
+    def parse_sample(self, sample):
+        do_flip, random_zoom, state = self.draw_augment()
+
+        depth_result = self.run_depth(self.crop_depth, sample, do_flip, random_zoom)
+
+        color_image, new_color_cam = self.get_input_image(sample['image'], sample['camera'], sample['crop'], do_flip, random_zoom, self.buffers['color'])
+
+        if self.occluder:
+            color_image = self.occluders.occlude(color_image)
+
+        color_image = self.random_color(color_image) if self.colour else color_image.copy()
+
+        if not self.uint8_batches:
+            color_image = self.transform(color_image)
+
+        depth_image = depth_result()
+
+        if self.uint8_batches:
+            depth_image = depth_image.astype(np.float16)
+
+        return (color_image, depth_image) + self.parse_targets(sample, new_color_cam, do_flip, state)
+
+
+    def parse_canvas(self, sample):
+        do_flip, random_zoom, state = self.draw_augment()
+
+        depth_cam = getattr(self, 'depth_cam_' + self.data_name)(sample)
+        depth_image = getattr(self, 'depth_image_' + self.data_name)(sample)
+
+        depth_result = self.run_depth(self.get_input_canvas, depth_image, depth_cam, sample['depth_crop'], do_flip, random_zoom, self.buffers['depth'])
+
+        color_canvas, color_homography, new_color_cam = self.get_input_canvas(sample['image'], sample['camera'], sample['crop'], do_flip, random_zoom, self.buffers['color'])
+        depth_canvas, depth_homography, new_depth_cam = depth_result()
+
+        canvases = (color_canvas, color_homography, depth_canvas, depth_homography)
+
+        return canvases + self.parse_targets(sample, new_color_cam, do_flip, state)
+
+
+    def get_sample(self, index):
+        sample = self.samples[index]
+        sample['index'] = index
+        sample['crop'] = (self.crops, self.samples.rows[index])
+        sample['depth_crop'] = (self.depth_crops, self.samples.rows[index])
+
+        return sample
 
 
     def __getitem__(self, index):
-        return self.parse_sample(self.samples[index])
+        if self.shards is not None:
+            return self.read_shards(index)
+
+        if self.device_warp:
+            return self.parse_canvas(self.get_sample(index))
+
+        return self.parse_sample(self.get_sample(index))
+
+
+    def __getitems__(self, indices):
+        return device_pipeline.tagged_samples(self, indices)
+
+
+    def image_keys(self):
+        '''
+        positions of the images that the device pipeline takes over in a sample, colour and depth canvases under device warping, colour and depth crops otherwise
+        '''
+        return (0, 2) if self.device_warp else (0, 1)
 
 
     def __len__(self):
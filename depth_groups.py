@@ -9,6 +9,7 @@ import glob
 import pickle5 as pickle
 import numpy as np
 import cameralib
+import crop_geometry
 import multiprocessing
 import matplotlib.pyplot as plt
 
@@ -35,11 +36,11 @@ def make_sample(sample, cameras, image, args):
 
 	dest_side = int(np.round(expand_side * scale_factor))
 
-	new_cam = copy.deepcopy(color_cam)
-	new_cam.shift_to_center(box_center, (expand_side, expand_side))
-	new_cam.scale_output(scale_factor)
+	intrinsics, affine = crop_geometry.center_crops(color_cam.intrinsic_matrix[None], box_center[None], [expand_side], [scale_factor])
 
-	new_bbox = cameralib.reproject_points(sample['bbox'][None, :2], color_cam, new_cam)[0]
+	new_cam = cameralib.Camera(color_cam.t, color_cam.R, intrinsics[0], color_cam.distortion_coeffs, color_cam.world_up)
+
+	new_bbox = affine[0] @ np.append(sample['bbox'][:2], 1)
 
 	new_bbox = np.concatenate([new_bbox, sample['bbox'][2:] * scale_factor])
 
@@ -1,4 +1,5 @@
 import os
+import copy
 import log
 import torch
 import numpy as np
@@ -6,6 +7,9 @@ import torch.nn as nn
 import torch.backends.cudnn as cudnn
 import importlib
 import depth_train
+import batch_cache
+import distributed
+import multi_source
 
 from opts import args
 from utils import JointInfo
@@ -43,7 +47,7 @@ def create_model(args):
 
     assert hasattr(model_creator, args.model)
     model = getattr(model_creator, args.model)(args, args.pretrain)
-    state = None;
+    resumed = None
 
     if args.test_only or args.val_only:
         save_path = os.path.join(args.save_path, args.model + '-' + args.suffix)
@@ -52,7 +56,7 @@ def create_model(args):
 
         checkpoint = os.path.join(save_path, 'model_{}.pth'.format(args.n_epochs))
         print('=> Loads checkpoint from ' + checkpoint)
-        checkpoint = torch.load(checkpoint)['model']
+        checkpoint = torch.load(checkpoint, map_location = distributed.get_device())['model']
 
         toy_keys = set(checkpoint.keys())
         model_keys = set(model.state_dict().keys())
@@ -63,15 +67,15 @@ def create_model(args):
 
     if args.resume:
         print('=> Loads checkpoint from ' + args.model_path)
-        checkpoint = torch.load(args.model_path)
+        checkpoint = torch.load(args.model_path, map_location = 'cpu')
         
         model.load_state_dict(checkpoint['model'])
-        state = checkpoint['state']
+        resumed = checkpoint
 
     cudnn.benchmark = True
-    model = model.cuda() if args.n_cudas == 1 else nn.DataParallel(model, device_ids = range(args.n_cudas)).cuda()
+    model = distributed.wrap_model(model, args)
 
-    return model, state
+    return model, resumed
 
 
 def create_pair(args):
@@ -85,38 +89,71 @@ def create_pair(args):
     assert hasattr(teacher_creator, args.model)
     teacher = getattr(teacher_creator, args.model)(args, False)
 
-    textbook = torch.load(args.teacher_path)['model']
+    textbook = torch.load(args.teacher_path, map_location = distributed.get_device())['model']
     teacher.load_state_dict(textbook)
 
     model_creator = importlib.import_module('depthnet')
 
     assert hasattr(model_creator, args.model)
     model = getattr(model_creator, args.model)(args, args.pretrain)
-    state = None
+    resumed = None
 
     if args.resume:
         print('=> Loads checkpoint from ' + args.model_path)
-        checkpoint = torch.load(args.model_path)
+        checkpoint = torch.load(args.model_path, map_location = 'cpu')
 
         model.load_state_dict(checkpoint['model'])
-        state = checkpoint['state']
+        resumed = checkpoint
 
     cudnn.benchmark = True
-    model = model.cuda() if args.n_cudas == 1 else nn.DataParallel(model, device_ids = range(args.n_cudas)).cuda()
-    teacher = teacher.cuda() if args.n_cudas == 1 else nn.DataParallel(model, device_ids = range(args.n_cudas)).cuda()
+    model = distributed.wrap_model(model, args)
+    teacher = distributed.wrap_model(teacher, args)
 
-    return model, teacher, state
+    return model, teacher, resumed
 
 
 def main():
+    distributed.init(args)
+
     assert not (args.resume and args.pretrain)
     assert not (args.do_fusion and args.depth_only)
     assert not (args.depth_host and args.depth_only)
+    assert not (args.bake_only and args.baked)
+
+    if args.bake_only:
+        module = depth_train.get_loader(args)
+
+        assert hasattr(module, 'bake_shards')
+
+        for phase in ('valid', 'test'):
+            module.bake_shards(args, phase, get_info())
+
+        distributed.barrier()
+
+        print('=> Shards are baked')
+        return
+
+    if args.bake_teacher:
+        assert args.do_teach and args.store_path
+
+        model, teacher, resumed = create_pair(args)
+
+        data_info = get_info()
+        dataset = depth_train.get_loader(args).Dataset(data_info, 'train', args)
+
+        trainer = depth_train.Trainer(args, model, data_info)
+        trainer.set_teacher(teacher)
+        trainer.bake_teacher(dataset, args)
+
+        distributed.barrier()
+
+        print('=> Teacher features are baked')
+        return
 
     if args.do_teach:
-        model, teacher, state = create_pair(args)
+        model, teacher, resumed = create_pair(args)
     else:
-        model, state = create_model(args)
+        model, resumed = create_model(args)
     print('=> Models are created and filled')
 
     data_info = get_info()
@@ -130,19 +167,33 @@ def main():
     else:
         test_loader = module.data_loader(args, 'valid', data_info)
 
-        data_loader = module.data_loader(args, 'train', data_info)
+        if args.cache_valid:
+            test_loader = batch_cache.CachedLoader(test_loader, args.cache_mem * 2 ** 30, args.cache_path, args.cache_disk * 2 ** 30)
+
+        if args.semi_teach:
+            semi_args = copy.copy(args)
+            semi_args.data_name = 'pku'
+
+            datasets = [module.Dataset(data_info, 'train', args), depth_train.get_loader(semi_args).Dataset(data_info, 'train', semi_args)]
+
+            data_loader = multi_source.data_loader(datasets, [args.batch_size, args.semi_batch], args)
+        else:
+            data_loader = module.data_loader(args, 'train', data_info)
 
     print('=> Dataloaders are ready')
 
-    logger = log.Logger(args, state)
+    logger = log.Logger(args, resumed['state'] if resumed else None)
     print('=> Logger is ready')
 
-    trainer = depth_train.Trainer(args, model, data_info)
+    trainer = depth_train.Trainer(args, model, data_info, logger)
     print('=> Trainer is ready')
 
     if args.do_teach:
         trainer.set_teacher(teacher)
 
+    if resumed:
+        trainer.load_state_dict(resumed)
+
     if args.test_only or args.val_only:
         print('=> Evaluation starts')
         test_rec = trainer.test(0, test_loader)
@@ -156,9 +207,11 @@ def main():
             train_rec = trainer.train(epoch, data_loader)
             test_rec = trainer.test(epoch, test_loader)
 
-            logger.record(epoch, train_rec, test_rec, model) 
+            logger.record(epoch, train_rec, test_rec, trainer)
 
         logger.final_print()
 
+    logger.close()
+
 if __name__ == '__main__':
     main()
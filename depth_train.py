@@ -1,5 +1,6 @@
 import os
 import json
+import functools
 import utils
 import torch
 import torch.nn as nn
@@ -7,6 +8,15 @@ import torch.nn.functional as F
 import numpy as np
 import torch.optim as optim
 import importlib
+import device_pipeline
+import augment_occluder
+import mixed_precision
+import step_engine
+import metrics
+import distributed
+import teacher_store
+import multi_source
+import torch.utils.data as data
 
 
 root_me = os.path.join(os.sep, 'globalwork', 'liu')
@@ -39,9 +49,11 @@ def to_test_worker(test_loader, no_depth, depth_only):
 
 class Trainer:
 
-    def __init__(self, args, model, data_info):
+    def __init__(self, args, model, data_info, logger = None):
         self.model = model
         self.data_info = data_info
+        self.logger = logger
+        self.device = distributed.get_device()
 
         self.list_params = [param for name, param in model.named_parameters()]
         self.list_names = [name for name, param in model.named_parameters()]
@@ -50,6 +62,7 @@ class Trainer:
         self.depth_only = args.depth_only
         self.do_fusion = args.do_fusion
         self.do_teach = args.do_teach
+        self.to_depth = args.to_depth
         self.semi_teach = args.semi_teach
         self.sigmoid = args.sigmoid
         self.bin_dist = args.bin_dist
@@ -64,28 +77,31 @@ class Trainer:
         self.save_last = args.save_last
         self.last_path = os.path.join(root_me, 'last_' + args.data_name, args.suffix)
 
-        if args.semi_teach:
-            args.data_name = 'pku'
-            args.batch_size = args.semi_batch
-            self.semi_loader = get_loader(args).data_loader(args, 'train', data_info)
-            self.semi_worker = iter(self.semi_loader)
+        self.pipeline = device_pipeline.DevicePipeline(args, self.no_depth)
+
+        occ_path = args.occ_path if (args.occluder and args.batch_occluder) else None
+
+        if args.eraser or occ_path:
+            self.occluder = augment_occluder.BatchOccluder(args.eraser, occ_path, [0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
+        else:
+            self.occluder = None
+
+        self.half_type = mixed_precision.half_types[args.half_type]
+
+        self.step = mixed_precision.MixedStep(self.list_params, args.half_acc, args.grad_norm, args.grad_scaling, args.scale_window)
 
         if args.half_acc:
-            self.copy_params = [param.clone().detach() for param in self.list_params]
-            self.model = self.model.half()
+            self.model = self.model.to(self.half_type)
 
-            for param in self.copy_params:
-                param.requires_grad = True
-                param.grad = param.data.new_zeros(param.size())
+        self.model = distributed.wrap_ddp(self.model, args)
 
-            self.optimizer = optim.Adam(wrap_by_name(self.list_names, self.copy_params), args.learn_rate, weight_decay = args.weight_decay)
-        else:
-            self.optimizer = optim.Adam(wrap_by_name(self.list_names, self.list_params), args.learn_rate, weight_decay = args.weight_decay)
+        self.optimizer = optim.Adam(wrap_by_name(self.list_names, self.step.master_params), args.learn_rate, weight_decay = args.weight_decay)
 
         self.depth = args.depth
         self.num_joints = args.num_joints
         self.side_in = args.side_in
         self.stride = args.stride
+        self.attention = args.attention
         self.depth_range = args.depth_range
 
         self.warmup = args.warmup
@@ -97,365 +113,323 @@ class Trainer:
         self.alpha_dest = args.alpha_dest
         self.alpha_init = args.alpha_init
         self.alpha_span = args.alpha_span
-        self.grad_norm = args.grad_norm
-        self.grad_scaling = args.grad_scaling
         self.loss_div = args.loss_div
 
-        self.criterion = nn.__dict__[args.criterion + 'Loss'](reduction = 'mean').cuda()
-
-
-    def set_teacher(self, teacher):
-        self.teacher = teacher.half() if self.half_acc else teacher
-
-
-    def to(self, image, device):
-        return image.half().to(device) if self.half_acc else image.to(device)
-
-
-    def distill(self, batch, teach_last, last_feat, atten_map):
-        if self.bin_dist:
-            diff = F.binary_cross_entropy_with_logits(last_feat, torch.sigmoid(teach_last))  # (batch, 1024, 17, 17)
-
-            diff = torch.mul(diff, atten_map)
-
-            dist_loss = torch.sum(diff.view(batch, -1), dim = -1).mean()
-        else:
-            diff = (torch.sigmoid(teach_last) - torch.sigmoid(last_feat)) if self.sigmoid else (teach_last - last_feat)  # (batch, 1024, 17, 17)
-
-            diff = torch.mul(diff, atten_map)
-
-            dist_loss = torch.linalg.norm(diff.view(batch, -1), dim = -1).mean()
-
-        return dist_loss
-
+        self.criterion = nn.__dict__[args.criterion + 'Loss'](reduction = 'mean').to(self.device)
 
-    def semi_train(self, device, i_batch):
-        try:
-            color_image, depth_image, true_cam, true_val, atten_map = next(self.semi_worker)
-        except:
-            self.semi_worker = iter(self.semi_loader)
+        self.accum_steps = args.accum_steps
+        self.print_freq = args.print_freq
 
-            color_image, depth_image, true_cam, true_val, atten_map = next(self.semi_worker)
+        self.head = step_engine.CamHead(args, data_info.key_index, self.criterion, self.loss_div)
+        self.engine = step_engine.StepEngine(self.step, self.optimizer, args.accum_steps, self.model)
 
-        color_image = self.to(color_image, device)
-        depth_image = self.to(depth_image, device)
-        atten_map = self.to(atten_map, device)
+        self.ckpt_freq = args.ckpt_freq
+        self.resume_steps = 0
 
-        semi_batch = true_cam.size(0)
 
-        with torch.no_grad():
-            teach_cam, teach_last = self.teach_infer(color_image, depth_image)
+    def state_dict(self):
+        '''
+        everything an interrupted run needs to go on, including the optimizer moments and under half_acc the float32 master copies
+        '''
+        model = getattr(self.model, 'module', self.model)
 
-        cam_feat, last_feat = self.vanilla_infer(color_image, i_batch, True)
+        return dict(model = model.state_dict(), optimizer = self.optimizer.state_dict(), mixed = self.step.state_dict())
 
-        dist_loss = self.distill(semi_batch, teach_last, last_feat, atten_map)
 
-        return semi_batch, dist_loss
+    def load_state_dict(self, checkpoint):
+        '''
+        resumes from a checkpoint whose model weights are already loaded, older checkpoints only carry those
+        '''
+        if 'optimizer' in checkpoint:
+            self.optimizer.load_state_dict(checkpoint['optimizer'])
 
+        if 'mixed' in checkpoint:
+            self.step.load_state_dict(checkpoint['mixed'])
 
-    def freeze_batchnorm(self):
-        self.teacher.eval()
-        self.model.freeze_batchnorm()
+        self.resume_steps = checkpoint['state'].get('step', 0)
 
 
-    def distill_train(self, epoch, data_loader, device):
-        n_batches = len(data_loader)
+    def checkpoint(self, epoch, step, n_batches):
+        '''
+        checkpoints every ckpt_freq steps of an epoch, except after its last step which the logger records anyway
+        '''
+        if not self.ckpt_freq or self.logger is None or step == n_batches:
+            return
 
-        cam_loss_sum = 0.0
-        dist_loss_sum = 0.0
+        step += self.resume_steps
 
-        cam_loss_samples = 0
-        dist_loss_samples = 0
+        if step % self.ckpt_freq == 0:
+            self.logger.checkpoint(epoch, step, self)
 
-        side_out = (self.side_in - 1) // self.stride + 1
-
-        if self.do_freeze:
-            self.freeze_batchnorm()
 
-        print('\n=> alpha value: {:.2f}'.format(self.get_dist_weight(epoch)))
-
-        for i_batch, batch_tuple in enumerate(data_loader):
-
-            color_image, depth_image, true_cam, true_val, atten_map = batch_tuple
-
-            color_image = self.to(color_image, device)
-            depth_image = self.to(depth_image, device)
-            atten_map = self.to(atten_map, device)
-
-            true_cam = true_cam.to(device)
-            true_val = true_val.to(device)
+    def set_teacher(self, teacher):
+        self.teacher = teacher.to(self.half_type) if self.half_acc else teacher
 
-            full_batch = true_cam.size(0)
 
-            with torch.no_grad():
-                teach_cam, teach_last = self.teach_infer(color_image, depth_image)
-
-            cam_feat, last_feat = self.vanilla_infer(color_image, i_batch, True)
+    def to(self, image, device):
+        return image.to(device, self.half_type) if self.half_acc else image.to(device)
 
-            dist_loss = self.distill(full_batch, teach_last, last_feat, atten_map)
 
-            heat_cam = utils.to_heatmap(cam_feat, self.depth, self.num_joints, side_out, side_out)
+    def augment(self, color_image):
+        '''
+        erases and occludes a batch of colour crops in place before it enters the forward pass
+        '''
+        return color_image if self.occluder is None else self.occluder(color_image)
 
-            key_index = self.data_info.key_index
 
-            relat_cam = utils.decode(heat_cam, self.depth_range)
+    def get_attention(self, image_coords, device):
+        '''
+        attention maps of a batch from the image coords of its joints, which the loaders return instead of the maps
+        '''
+        return utils.get_attention_batch(self.side_in, self.stride, image_coords.to(device), self.attention, self.half_type if self.half_acc else torch.float32)
 
-            relat_cam = relat_cam - relat_cam[:, key_index:key_index + 1]
 
-            spec_cam = relat_cam + true_cam[:, key_index:key_index + 1]
+    def distill(self, batch, teach_last, last_feat, atten_map):
+        if self.bin_dist:
+            diff = F.binary_cross_entropy_with_logits(last_feat, torch.sigmoid(teach_last))  # (batch, 1024, 17, 17)
 
-            cam_loss = self.criterion(spec_cam.view(-1, 3)[true_val.view(-1)] / self.loss_div, true_cam.view(-1, 3)[true_val.view(-1)] / self.loss_div)
+            diff = torch.mul(diff, atten_map)
 
-            cam_loss_sum += cam_loss.item() * full_batch
-            cam_loss_samples += full_batch
+            dist_loss = torch.sum(diff.view(batch, -1), dim = -1).mean()
+        else:
+            diff = (torch.sigmoid(teach_last) - torch.sigmoid(last_feat)) if self.sigmoid else (teach_last - last_feat)  # (batch, 1024, 17, 17)
 
-            dist_loss_sum += dist_loss.item() * full_batch
-            dist_loss_samples += full_batch
+            diff = torch.mul(diff, atten_map)
 
-            message = '[=] train Epoch[{0}] Batch[{1}|{2}] '.format(epoch, i_batch, n_batches)
-            message += ' Cam Loss {:.4f} '.format(cam_loss.item())
-            message += ' Dist Loss {:.4f} '.format(dist_loss.item())
+            dist_loss = torch.linalg.norm(diff.view(batch, -1), dim = -1).mean()
 
-            loss = dist_loss * self.get_dist_weight(epoch) + cam_loss
+        return dist_loss
 
-            if self.semi_teach:
-                semi_batch, semi_dist_loss = self.semi_train(device, i_batch)
 
-                dist_loss_sum += semi_dist_loss.item() * semi_batch
-                dist_loss_samples += semi_batch
+    def teacher_last(self, color_image, depth_image, stored, device):
+        '''
+        last features of the teacher, read from the batch when the loader serves them from the teacher store
+        '''
+        if stored:
+            return stored[0].to(device).float()
 
-                message += ' Semi Loss {:.4f}'.format(semi_dist_loss.item())
+        with torch.no_grad():
+            teach_cam, teach_last = self.teach_infer(color_image, depth_image)
 
-                loss += semi_dist_loss * self.get_dist_weight(epoch)
+        return teach_last
 
-            print(message)
 
-            if self.half_acc:
-                loss *= self.grad_scaling
+    def semi_forward(self, batch_tuple, i_batch, device):
+        color_image, depth_image, true_cam, true_val, image_coords, *stored = batch_tuple
 
-                for h_param in self.list_params:
+        color_image = self.to(color_image, device)
+        depth_image = self.to(depth_image, device)
+        atten_map = self.get_attention(image_coords, device)
 
-                    if h_param.grad is None:
-                        continue
+        semi_batch = true_cam.size(0)
 
-                    h_param.grad.detach_()
-                    h_param.grad.zero_()
+        teach_last = self.teacher_last(color_image, depth_image, stored, device)
 
-                loss.backward()
+        cam_feat, last_feat = self.vanilla_infer(color_image, i_batch, True)
 
-                self.optimizer.zero_grad()
+        dist_loss = self.distill(semi_batch, teach_last, last_feat, atten_map)
 
-                do_update = True
+        return dict(semi = (dist_loss, semi_batch))
 
-                for c_param, h_param in zip(self.copy_params, self.list_params):
 
-                    if h_param.grad is None:
-                        continue
+    def bake_teacher(self, dataset, args):
+        '''
+        runs the teacher on the unaugmented crops of every train sample under every flip and zoom state of the store
+        the store is written by the main rank alone
+        '''
+        if not distributed.is_main():
+            return
 
-                    if torch.any(torch.isinf(h_param.grad)):
-                        do_update = False
-                        print('update step skipped')
-                        break
+        self.teacher.eval()
 
-                    c_param.grad.copy_(h_param.grad)
-                    c_param.grad /= self.grad_scaling
+        dataset.colour = False
+        dataset.occluder = False
 
-                if do_update:
-                    nn.utils.clip_grad_norm_(self.copy_params, self.grad_norm)
+        path = teacher_store.store_path(args, dataset.data_name)
+        store = None
 
-                    self.optimizer.step()
+        for state in range(len(dataset.zoom_levels) * 2):
+            dataset.fixed_state = state
 
-                    for c_param, h_param in zip(self.copy_params, self.list_params):
-                        h_param.data.copy_(c_param.data)
+            loader = data.DataLoader(dataset, args.batch_size, False, num_workers = args.workers)
+            loader = self.pipeline.wrap(loader, self.device, False)
 
-            else:
-                self.optimizer.zero_grad()
-                loss.backward()
+            start = 0
 
-                nn.utils.clip_grad_norm_(self.list_params, self.grad_norm)
-                self.optimizer.step()
+            for i_batch, batch_tuple in enumerate(loader):
+                color_image = self.to(batch_tuple[0], self.device)
+                depth_image = self.to(batch_tuple[1], self.device)
 
-        cam_loss_sum /= cam_loss_samples
-        dist_loss_sum /= dist_loss_samples
+                with torch.no_grad():
+                    teach_cam, teach_last = self.teach_infer(color_image, depth_image)
 
-        print('\n=> train Epoch[%d]  Cam Loss: %1.4f  Dist Loss: %1.4f\n\n' % (epoch, cam_loss_sum, dist_loss_sum))
+                features = dict(cam_feat = teach_cam.cpu().half().numpy(), last_feat = teach_last.cpu().half().numpy())
 
-        return dict(dist_train_loss = dist_loss_sum, cam_train_loss = cam_loss_sum)
+                if store is None:
+                    store = teacher_store.TeacherStore.create(path, dataset.store_meta(), {key: array.shape[1:] for key, array in features.items()})
 
+                store.write(start, state, features)
 
-    def fusion_train(self, epoch, data_loader, device):
-        n_batches = len(data_loader)
+                start += len(teach_last)
 
-        loss_avg = 0
-        total = 0
+                print('=> bakes teacher state [', state, '] batch [', i_batch, '|', len(loader), ']')
 
-        side_out = (self.side_in - 1) // self.stride + 1
+        store.flush()
 
-        for i_batch, (color_image, depth_image, true_cam, true_val) in enumerate(data_loader):
 
-            color_image = self.to(color_image, device)
-            depth_image = self.to(depth_image, device)
+    def freeze_batchnorm(self):
+        self.teacher.eval()
+        getattr(self.model, 'module', self.model).freeze_batchnorm()
 
-            true_cam = true_cam.to(device)
-            true_val = true_val.to(device)
 
-            batch = true_cam.size(0)
+    def distill_forward(self, batch_tuple, i_infer, device):
+        color_image, depth_image, true_cam, true_val, image_coords, *stored = batch_tuple
 
-            cam_feat = self.fusion_infer(color_image, depth_image, i_batch)
+        color_image = self.augment(self.to(color_image, device))
+        depth_image = self.to(depth_image, device)
+        atten_map = self.get_attention(image_coords, device)
 
-            heat_cam = utils.to_heatmap(cam_feat, self.depth, self.num_joints, side_out, side_out)
+        true_cam = true_cam.to(device)
+        true_val = true_val.to(device)
 
-            key_index = self.data_info.key_index
+        batch = true_cam.size(0)
 
-            relat_cam = utils.decode(heat_cam, self.depth_range)
+        teach_last = self.teacher_last(color_image, depth_image, stored, device)
 
-            relat_cam = relat_cam - relat_cam[:, key_index:key_index + 1]
+        cam_feat, last_feat = self.vanilla_infer(color_image, i_infer, True)
 
-            spec_cam = relat_cam + true_cam[:, key_index:key_index + 1]
+        dist_loss = self.distill(batch, teach_last, last_feat, atten_map)
 
-            loss = self.criterion(spec_cam.view(-1, 3)[true_val.view(-1)] / self.loss_div, true_cam.view(-1, 3)[true_val.view(-1)] / self.loss_div)
+        relat_cam, spec_cam = self.head.decode(cam_feat, true_cam)
 
-            print('| train Epoch[%d] [%d/%d]  Loss %1.4f' % (epoch, i_batch, n_batches, loss.item()))
+        cam_loss = self.head(spec_cam, true_cam, true_val)
 
-            loss_avg += loss.item() * batch
+        return dict(cam = (cam_loss, true_val.sum()), dist = (dist_loss, batch))
 
-            total += batch
 
-            if self.half_acc:
-                loss *= self.grad_scaling
+    def fusion_forward(self, batch_tuple, i_infer, device):
+        color_image, depth_image, true_cam, true_val = batch_tuple
 
-                for h_param in self.list_params:
+        color_image = self.augment(self.to(color_image, device))
+        depth_image = self.to(depth_image, device)
 
-                    if h_param.grad is None:
-                        continue
+        true_cam = true_cam.to(device)
+        true_val = true_val.to(device)
 
-                    h_param.grad.detach_()
-                    h_param.grad.zero_()
+        cam_feat = self.fusion_infer(color_image, depth_image, i_infer)
 
-                loss.backward()
+        relat_cam, spec_cam = self.head.decode(cam_feat, true_cam)
 
-                self.optimizer.zero_grad()
+        return dict(cam = (self.head(spec_cam, true_cam, true_val), true_val.sum()))
 
-                do_update = True
 
-                for c_param, h_param in zip(self.copy_params, self.list_params):
+    def vanilla_forward(self, batch_tuple, i_infer, device):
+        color_image, depth_image, true_cam, true_val = batch_tuple
 
-                    if h_param.grad is None:
-                        continue
+        in_image = self.to(depth_image, device) if self.depth_only else self.augment(self.to(color_image, device))
 
-                    if torch.any(torch.isinf(h_param.grad)):
-                        do_update = False
-                        print('update step skipped')
-                        break
+        true_cam = true_cam.to(device)
+        true_val = true_val.to(device)
 
-                    c_param.grad.copy_(h_param.grad)
-                    c_param.grad /= self.grad_scaling
+        cam_feat = self.vanilla_infer(in_image, i_infer)
 
-                if do_update:
-                    nn.utils.clip_grad_norm_(self.copy_params, self.grad_norm)
+        relat_cam, spec_cam = self.head.decode(cam_feat, true_cam)
 
-                    self.optimizer.step()
+        return dict(cam = (self.head(spec_cam, true_cam, true_val), true_val.sum()))
 
-                    for c_param, h_param in zip(self.copy_params, self.list_params):
-                        h_param.data.copy_(c_param.data)
 
-            else:
-                self.optimizer.zero_grad()
-                loss.backward()
+    def distill_train(self, epoch, data_loader, device):
+        n_batches = (getattr(data_loader.dataset, 'num_steps', None) or len(data_loader)) - self.resume_steps
 
-                nn.utils.clip_grad_norm_(self.list_params, self.grad_norm)
-                self.optimizer.step()
+        meter = metrics.MetricAccumulator('train', epoch, n_batches, self.print_freq, self.logger)
 
-        loss_avg /= total
+        if self.do_freeze:
+            self.freeze_batchnorm()
 
-        print('\n=> train Epoch[%d]  Cam Loss: %1.4f\n' % (epoch, loss_avg))
+        dist_weight = self.get_dist_weight(epoch)
 
-        return dict(cam_train_loss = loss_avg)
+        print('\n=> alpha value: {:.2f}'.format(dist_weight))
 
+        semi_tuples = []
 
-    def vanilla_train(self, epoch, data_loader, device):
-        n_batches = len(data_loader)
+        i_batch = 0
 
-        loss_avg = 0
-        total = 0
+        for batch_tuple in data_loader:
 
-        side_out = (self.side_in - 1) // self.stride + 1
+            if self.semi_teach:
+                *batch_tuple, source = batch_tuple
 
-        for i_batch, (color_image, depth_image, true_cam, true_val) in enumerate(data_loader):
+                if source[0] == multi_source.UNLABELLED:
+                    semi_tuples.append(batch_tuple)
+                    continue
 
-            in_image = self.to(depth_image if self.depth_only else color_image, device)
+            if i_batch == n_batches:
+                break
 
-            true_cam = true_cam.to(device)
-            true_val = true_val.to(device)
+            true_val = batch_tuple[3]
 
-            batch = true_cam.size(0)
+            full_batch = true_val.size(0)
+            semi_batch = sum(semi_tuple[3].size(0) for semi_tuple in semi_tuples)
 
-            cam_feat = self.vanilla_infer(in_image, i_batch)
+            forward = lambda micro_batch, i_micro: self.distill_forward(micro_batch, i_batch * self.accum_steps + i_micro, device)
 
-            heat_cam = utils.to_heatmap(cam_feat, self.depth, self.num_joints, side_out, side_out)
+            extras = [functools.partial(self.semi_forward, semi_tuple, i_batch, device) for semi_tuple in semi_tuples]
 
-            key_index = self.data_info.key_index
+            totals = dict(cam = true_val.sum(), dist = full_batch, semi = semi_batch)
 
-            relat_cam = utils.decode(heat_cam, self.depth_range)
+            losses = self.engine(batch_tuple, forward, totals, dict(dist = dist_weight, semi = dist_weight), extras)
 
-            relat_cam = relat_cam - relat_cam[:, key_index:key_index + 1]
+            meter.add('cam', losses['cam'], full_batch)
+            meter.add('dist', losses['dist'], full_batch)
 
-            spec_cam = relat_cam + true_cam[:, key_index:key_index + 1]
+            if semi_tuples:
+                meter.add('semi', losses['semi'], semi_batch)
 
-            loss = self.criterion(spec_cam.view(-1, 3)[true_val.view(-1)] / self.loss_div, true_cam.view(-1, 3)[true_val.view(-1)] / self.loss_div)
+            meter.step(full_batch)
 
-            print('| train Epoch[%d] [%d/%d]  Loss %1.4f' % (epoch, i_batch, n_batches, loss.item()), flush = True)
+            self.checkpoint(epoch, i_batch + 1, n_batches)
 
-            loss_avg += loss.item() * batch
+            semi_tuples = []
+            i_batch += 1
 
-            total += batch
+        meter.close()
 
-            if self.half_acc:
-                loss *= self.grad_scaling
+        cam_loss_sum = meter.mean('cam')
+        dist_loss_sum = meter.mean('dist', 'semi')
 
-                for h_param in self.list_params:
+        print('\n=> train Epoch[%d]  Cam Loss: %1.4f  Dist Loss: %1.4f\n\n' % (epoch, cam_loss_sum, dist_loss_sum))
 
-                    if h_param.grad is None:
-                        continue
+        return dict(dist_train_loss = dist_loss_sum, cam_train_loss = cam_loss_sum)
 
-                    h_param.grad.detach_()
-                    h_param.grad.zero_()
 
-                loss.backward()
+    def cam_train(self, epoch, data_loader, device):
+        n_batches = len(data_loader) - self.resume_steps
 
-                self.optimizer.zero_grad()
+        meter = metrics.MetricAccumulator('train', epoch, n_batches, self.print_freq, self.logger)
 
-                do_update = True
+        adapter = self.fusion_forward if self.do_fusion else self.vanilla_forward
 
-                for c_param, h_param in zip(self.copy_params, self.list_params):
+        for i_batch, batch_tuple in enumerate(data_loader):
 
-                    if h_param.grad is None:
-                        continue
+            if i_batch == n_batches:
+                break
 
-                    if torch.any(torch.isinf(h_param.grad)):
-                        do_update = False
-                        print('update step skipped')
-                        break
+            true_val = batch_tuple[3]
 
-                    c_param.grad.copy_(h_param.grad)
-                    c_param.grad /= self.grad_scaling
+            batch = true_val.size(0)
 
-                if do_update:
-                    nn.utils.clip_grad_norm_(self.copy_params, self.grad_norm)
+            forward = lambda micro_batch, i_micro: adapter(micro_batch, i_batch * self.accum_steps + i_micro, device)
 
-                    self.optimizer.step()
+            losses = self.engine(batch_tuple, forward, dict(cam = true_val.sum()))
 
-                    for c_param, h_param in zip(self.copy_params, self.list_params):
-                        h_param.data.copy_(c_param.data)
+            meter.add('cam', losses['cam'], batch)
+            meter.step(batch)
 
-            else:
-                self.optimizer.zero_grad()
-                loss.backward()
+            self.checkpoint(epoch, i_batch + 1, n_batches)
 
-                nn.utils.clip_grad_norm_(self.list_params, self.grad_norm)
-                self.optimizer.step()
+        meter.close()
 
-        loss_avg /= total
+        loss_avg = meter.mean('cam')
 
         print('\n=> train Epoch[%d]  Cam Loss: %1.4f\n' % (epoch, loss_avg))
 
@@ -466,19 +440,27 @@ class Trainer:
         self.model.train()
         self.adapt_learn_rate(epoch)
 
+        distributed.set_epoch(data_loader, epoch)
+
+        data_loader = self.pipeline.wrap(data_loader, self.device, True)
+
         if self.do_teach:
-            return self.distill_train(epoch, data_loader, torch.device('cuda'))
-        elif self.do_fusion:
-            return self.fusion_train(epoch, data_loader, torch.device('cuda'))
+            record = self.distill_train(epoch, data_loader, self.device)
         else:
-            return self.vanilla_train(epoch, data_loader, torch.device('cuda'))
+            record = self.cam_train(epoch, data_loader, self.device)
+
+        if self.to_depth and distributed.is_main():
+            print('=> ray scale cache  hits: {hits:d}  misses: {misses:d}  hit rate: {hit_rate:1.3f}\n'.format(**utils.ray_scales.stats()))
+
+        self.resume_steps = 0
+
+        return record
 
 
     def fusion_test(self, epoch, test_loader, device):
         n_batches = len(test_loader)
 
-        loss_avg = 0
-        total = 0
+        meter = metrics.MetricAccumulator('test', epoch, n_batches, self.print_freq, self.logger)
 
         side_out = (self.side_in - 1) // self.stride + 1
 
@@ -497,11 +479,9 @@ class Trainer:
             with torch.no_grad():
                 cam_feat = self.fusion_infer(color_image, depth_image, i_batch)
 
-                heat_cam = utils.to_heatmap(cam_feat, self.depth, self.num_joints, side_out, side_out)
-
                 key_index = self.data_info.key_index
 
-                relat_cam = utils.decode(heat_cam, self.depth_range)
+                relat_cam = utils.soft_argmax(cam_feat, self.depth, self.num_joints, side_out, side_out, self.depth_range)
 
                 relat_cam = relat_cam - relat_cam[:, key_index:key_index + 1]
 
@@ -509,9 +489,7 @@ class Trainer:
 
                 loss = self.criterion(spec_cam.view(-1, 3)[true_val.view(-1)] / self.loss_div, true_cam.view(-1, 3)[true_val.view(-1)] / self.loss_div)
 
-            loss_avg += loss.item() * batch
-
-            total += batch
+            meter.add('cam', loss, batch)
 
             true_val = true_val.cpu().numpy().astype(np.bool)
 
@@ -526,12 +504,14 @@ class Trainer:
 
             cam_stats.append(utils.analyze(spec_cam, true_cam, true_val, self.data_info.mirror, self.thresh))
 
-            print('| test Epoch[%d] [%d/%d]  Cam Loss %1.4f' % (epoch, i_batch, n_batches, loss.item()))
+            meter.step(batch)
 
-        loss_avg /= total
+        meter.close()
+
+        loss_avg = meter.mean('cam')
 
         record = dict(test_loss = loss_avg)
-        record.update(utils.parse_epoch(cam_stats))
+        record.update(utils.parse_epoch(cam_stats, distributed.all_reduce))
 
         print('\n=> test Epoch[%d]  Cam Loss: %1.4f\n' % (epoch, loss_avg))
 
@@ -543,8 +523,7 @@ class Trainer:
     def vanilla_test(self, epoch, test_loader, device):
         n_batches = len(test_loader)
 
-        loss_avg = 0
-        total = 0
+        meter = metrics.MetricAccumulator('test', epoch, n_batches, self.print_freq, self.logger)
 
         side_out = (self.side_in - 1) // self.stride + 1
 
@@ -564,11 +543,9 @@ class Trainer:
             with torch.no_grad():
                 cam_feat = self.vanilla_infer(in_image, i_batch)
 
-                heat_cam = utils.to_heatmap(cam_feat, self.depth, self.num_joints, side_out, side_out)
-
                 key_index = self.data_info.key_index
 
-                relat_cam = utils.decode(heat_cam, self.depth_range)
+                relat_cam = utils.soft_argmax(cam_feat, self.depth, self.num_joints, side_out, side_out, self.depth_range)
 
                 relat_cam = relat_cam - relat_cam[:, key_index:key_index + 1]
 
@@ -576,9 +553,7 @@ class Trainer:
 
                 loss = self.criterion(spec_cam.view(-1, 3)[true_val.view(-1)] / self.loss_div, true_cam.view(-1, 3)[true_val.view(-1)] / self.loss_div)
 
-            loss_avg += loss.item() * batch
-
-            total += batch
+            meter.add('cam', loss, batch)
 
             true_val = true_val.cpu().numpy().astype(np.bool)
 
@@ -593,12 +568,14 @@ class Trainer:
 
             cam_stats.append(utils.analyze(spec_cam, true_cam, true_val, self.data_info.mirror, self.thresh))
 
-            print('| test Epoch[%d] [%d/%d]  Cam Loss %1.4f' % (epoch, i_batch, n_batches, loss.item()))
+            meter.step(batch)
+
+        meter.close()
 
-        loss_avg /= total
+        loss_avg = meter.mean('cam')
 
         record = dict(test_loss = loss_avg)
-        record.update(utils.parse_epoch(cam_stats))
+        record.update(utils.parse_epoch(cam_stats, distributed.all_reduce))
 
         print('\n=> test Epoch[%d]  Cam Loss: %1.4f\n' % (epoch, loss_avg))
 
@@ -610,12 +587,14 @@ class Trainer:
     def test(self, epoch, test_loader):
         self.model.eval()
 
+        test_loader = self.pipeline.wrap(test_loader, self.device, False)
+
         if self.do_teach:
-            return self.vanilla_test(epoch, test_loader, torch.device('cuda'))
+            return self.vanilla_test(epoch, test_loader, self.device)
         elif self.do_fusion:
-            return self.fusion_test(epoch, test_loader, torch.device('cuda'))
+            return self.fusion_test(epoch, test_loader, self.device)
         else:
-            return self.vanilla_test(epoch, test_loader, torch.device('cuda'))
+            return self.vanilla_test(epoch, test_loader, self.device)
 
 
     def adapt_learn_rate(self, epoch):
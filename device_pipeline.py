@@ -0,0 +1,357 @@
+import cv2
+import torch
+import functools
+import collections
+import cameralib
+import numpy as np
+import torch.nn.functional as F
+import torch.utils.data as data
+
+from augment_colour import random_color_batch
+from augment_colour import random_color_matrix_batch
+
+
+veil_thresholds = dict(ntu = 0.1, pku = 0.5)
+
+
+def to_canvas(image, camera, new_cam, canvas_side):
+    '''
+    places a decoded image at the top-left corner of a zero canvas of fixed size so that samples can be collated
+
+    Args:
+        image: decoded image that matches camera
+        camera: camera of the decoded image
+        new_cam: camera of the crop
+
+    Returns:
+        canvas and the homography that brings crop pixels to canvas pixels
+        lens distortion of camera is not modelled by the homography
+    '''
+    homography = cameralib.get_homography(camera, new_cam).astype(np.float32)
+
+    scale = canvas_side / max(image.shape[:2])
+
+    if scale < 1:
+        dest_shape = (int(image.shape[1] * scale), int(image.shape[0] * scale))
+
+        image = cv2.resize(image, dest_shape, interpolation = cv2.INTER_AREA)
+
+        shrink = np.array([[scale, 0, 0.5 * scale - 0.5], [0, scale, 0.5 * scale - 0.5], [0, 0, 1]], np.float32)
+
+        homography = shrink @ homography
+
+    canvas = np.zeros((canvas_side, canvas_side) + image.shape[2:], dtype = image.dtype)
+    canvas[:image.shape[0], :image.shape[1]] = image
+
+    return canvas, homography
+
+
+@functools.lru_cache()
+def get_grid(side_in, device):
+    coord_y, coord_x = torch.meshgrid(torch.arange(side_in, dtype = torch.float32), torch.arange(side_in, dtype = torch.float32), indexing = 'ij')
+
+    return torch.stack([coord_x, coord_y, torch.ones_like(coord_x)], dim = -1).view(-1, 3).to(device)
+
+
+def warp_batch(canvas, homography, side_in):
+    '''
+    batched counterpart of cameralib.reproject_image via bilinear grid sampling
+
+    Args:
+        canvas: (batch_size, channels, canvas_side, canvas_side) float tensor
+        homography: (batch_size, 3, 3) crop pixels to canvas pixels
+    '''
+    batch, channels, height, width = canvas.size()
+
+    coords = torch.einsum('nj,bij->bni', get_grid(side_in, canvas.device), homography)  # (batch_size, side_in x side_in, 3)
+
+    coords = coords[:, :, :2] / coords[:, :, 2:]
+
+    scale = torch.tensor([2.0 / width, 2.0 / height], device = canvas.device)
+
+    coords = (coords + 0.5) * scale - 1.0
+
+    warped = F.grid_sample(canvas, coords.view(batch, side_in, side_in, 2), mode = 'bilinear', padding_mode = 'zeros', align_corners = False)
+
+    return warped
+
+
+class PinnedRing:
+    '''
+    preallocated page-locked buffers that batches are copied into before an asynchronous host-to-device copy
+    a slot is only overwritten once the copy issued from it num_slots batches ago has completed
+    batches that were collated into PinnedSlots are already on the device and pass through
+    '''
+    def __init__(self, num_slots = 3):
+        self.slots = [dict() for _ in range(num_slots)]
+        self.events = [None] * num_slots
+        self.cursor = 0
+
+
+    def buffer(self, slot, key, tensor):
+        buffer = slot.get(key)
+
+        if buffer is None or buffer.dtype != tensor.dtype or buffer.size()[1:] != tensor.size()[1:] or buffer.size(0) < tensor.size(0):
+            buffer = torch.empty(tensor.size(), dtype = tensor.dtype, pin_memory = True)
+            slot[key] = buffer
+
+        return buffer[:tensor.size(0)]
+
+
+    def transfer(self, tensors, device):
+        if device.type != 'cuda' or all(tensor.device == device for tensor in tensors):
+            return [tensor.to(device) for tensor in tensors]
+
+        slot = self.slots[self.cursor]
+
+        if self.events[self.cursor] is not None:
+            self.events[self.cursor].synchronize()
+
+        outputs = []
+
+        for key, tensor in enumerate(tensors):
+            buffer = self.buffer(slot, key, tensor)
+            buffer.copy_(tensor)
+
+            outputs.append(buffer.to(device, non_blocking = True))
+
+        self.events[self.cursor] = torch.cuda.Event()
+        self.events[self.cursor].record()
+
+        self.cursor = (self.cursor + 1) % len(self.slots)
+
+        return outputs
+
+
+class PinnedSlots:
+    '''
+    collate_fn that writes the images of a batch straight into page-locked host buffers shared with the loader workers
+    the i-th batch of a pass goes to slot i % num_slots as tagged by SlotBatchSampler, and the collated batch only
+    carries the slot, so that the main process issues the host-to-device copy from it without any other host copy
+    num_slots covers the batches the workers may prefetch plus depth batches whose copies may still be in flight
+    batches without a slot, e.g. those regenerated by a batch cache, are collated as usual
+    '''
+    def __init__(self, dataset, batch_size, num_workers, prefetch_factor = 2, depth = 3):
+        sample = dataset[0]
+
+        self.keys = dataset.image_keys()
+        self.depth = depth
+        self.num_slots = num_workers * prefetch_factor + depth
+
+        images = [torch.as_tensor(np.asarray(sample[key])) for key in self.keys]
+
+        self.slots = [[torch.empty((batch_size,) + image.size(), dtype = image.dtype).share_memory_() for image in images] for _ in range(self.num_slots)]
+
+        if torch.cuda.is_available():
+            for buffer in (buffer for slot in self.slots for buffer in slot):
+                torch.cuda.check_error(torch.cuda.cudart().cudaHostRegister(buffer.data_ptr(), buffer.numel() * buffer.element_size(), 0))
+
+
+    def __call__(self, samples):
+        slot = getattr(samples, 'slot', None)
+
+        if slot is None:
+            return data.default_collate(list(samples))
+
+        fields = [None if key in self.keys else data.default_collate([sample[key] for sample in samples]) for key in range(len(samples[0]))]
+
+        for key, buffer in zip(self.keys, self.slots[slot]):
+            for i, sample in enumerate(samples):
+                buffer[i].copy_(torch.as_tensor(np.asarray(sample[key])))
+
+        return PinnedBatch(slot, len(samples), fields)
+
+
+    def images(self, batch):
+        return [buffer[:batch.size] for buffer in self.slots[batch.slot]]
+
+
+class PinnedBatch:
+    '''
+    a batch collated by PinnedSlots, whose image fields are None as they wait in the given slot
+    '''
+    def __init__(self, slot, size, fields):
+        self.slot = slot
+        self.size = size
+        self.fields = fields
+
+
+class SlotBatch(list):
+    '''
+    the dataset indices of a batch, or its samples, tagged with the pinned slot the batch is collated into
+    '''
+    def __init__(self, indices, slot):
+        super(SlotBatch, self).__init__(indices)
+
+        self.slot = slot
+
+
+class SlotBatchSampler(data.Sampler):
+
+    def __init__(self, batch_sampler, num_slots):
+        self.batch_sampler = batch_sampler
+        self.sampler = getattr(batch_sampler, 'sampler', None)
+        self.num_slots = num_slots
+
+    def __iter__(self):
+        for i_batch, indices in enumerate(self.batch_sampler):
+            yield SlotBatch(indices, i_batch % self.num_slots)
+
+    def __len__(self):
+        return len(self.batch_sampler)
+
+
+def data_loader(dataset, batch_sampler, args):
+    '''
+    a loader whose batches keep their images in the pinned slots of a PinnedSlots collate_fn
+    '''
+    slots = PinnedSlots(dataset, args.batch_size, args.workers)
+
+    return data.DataLoader(dataset, batch_sampler = SlotBatchSampler(batch_sampler, slots.num_slots), num_workers = args.workers, collate_fn = slots)
+
+
+def tagged_samples(dataset, indices):
+    '''
+    the samples of a batch, which keep the slot of its indices on their way to the collate_fn, see Dataset.__getitems__
+    '''
+    return SlotBatch([dataset[index] for index in indices], getattr(indices, 'slot', None))
+
+
+class DevicePipeline:
+
+    def __init__(self, args, no_depth):
+        self.side_in = args.side_in
+        self.colour = args.colour
+        self.random_color = random_color_matrix_batch if args.fast_colour else random_color_batch
+        self.no_depth = no_depth
+
+        self.nexponent = args.nexponent
+        self.veil = veil_thresholds.get(args.data_name)
+
+        self.mean = torch.tensor([0.485, 0.456, 0.406]).view(1, 3, 1, 1)
+        self.dev = torch.tensor([0.229, 0.224, 0.225]).view(1, 3, 1, 1)
+
+
+    def wrap(self, data_loader, device, train):
+        if not (data_loader.dataset.device_warp or data_loader.dataset.uint8_batches):
+            return data_loader
+
+        return DeviceLoader(data_loader, self, device, train)
+
+
+    def normalize(self, image):
+        return (image - self.mean.to(image.device)) / self.dev.to(image.device)
+
+
+    def color(self, canvas, homography, train):
+        canvas = canvas.permute(0, 3, 1, 2).float()
+
+        image = warp_batch(canvas, homography, self.side_in) / 255.0
+
+        if train and self.colour:
+            image = self.random_color(image)
+
+        return self.normalize(image)
+
+
+    def depth(self, canvas, homography):
+        image = warp_batch(canvas.unsqueeze(1).float(), homography, self.side_in)
+
+        image = image / (10.0 / 255.0)
+
+        veil = (self.veil <= image).float()
+
+        return torch.exp(- image) * veil if self.nexponent else image / 3.0
+
+
+    def warp(self, batch, ring, device, train):
+        if self.no_depth:
+            color_canvas, = ring.transfer(batch[:1], device)
+
+            return (self.color(color_canvas, batch[1].to(device), train),) + tuple(batch[2:])
+
+        color_canvas, depth_canvas = ring.transfer([batch[0], batch[2]], device)
+
+        color_image = self.color(color_canvas, batch[1].to(device), train)
+        depth_image = self.depth(depth_canvas, batch[3].to(device))
+
+        return (color_image, depth_image) + tuple(batch[4:])
+
+
+    def crops(self, batch, ring, device):
+        '''
+        normalizes uint8 colour crops of shape (batch_size, side_in, side_in, 3) and float16 depth crops after transfer
+        '''
+        num_images = 1 if self.no_depth else 2
+
+        images = ring.transfer(batch[:num_images], device)
+
+        color_image = self.normalize(images[0].permute(0, 3, 1, 2).float() / 255.0)
+
+        if self.no_depth:
+            return (color_image,) + tuple(batch[1:])
+
+        return (color_image, images[1].float()) + tuple(batch[2:])
+
+
+class DeviceLoader:
+
+    def __init__(self, data_loader, pipeline, device, train):
+        self.data_loader = data_loader
+        self.dataset = data_loader.dataset
+        self.pipeline = pipeline
+        self.device = device
+        self.train = train
+        self.ring = PinnedRing()
+
+    def __len__(self):
+        return len(self.data_loader)
+
+    def __iter__(self):
+        device_warp = self.data_loader.dataset.device_warp
+
+        for batch in self.batches():
+            if device_warp:
+                yield self.pipeline.warp(batch, self.ring, self.device, self.train)
+            else:
+                yield self.pipeline.crops(batch, self.ring, self.device)
+
+
+    def batches(self):
+        '''
+        batches of the loader, whose pinned images are already on their way to the device
+        a pinned slot is refilled by the workers once the loader hands out num_workers * prefetch_factor more batches,
+        so the copy issued from it depth batches ago is waited for before the next batch is taken
+        '''
+        slots = getattr(self.data_loader, 'collate_fn', None)
+
+        if not isinstance(slots, PinnedSlots):
+            yield from self.data_loader
+            return
+
+        events = collections.deque()
+        batches = iter(self.data_loader)
+
+        while True:
+            if len(events) == slots.depth:
+                events.popleft().synchronize()
+
+            batch = next(batches, None)
+
+            if batch is None:
+                return
+
+            if not isinstance(batch, PinnedBatch):
+                yield batch
+                continue
+
+            fields = list(batch.fields)
+
+            for key, image in zip(slots.keys, slots.images(batch)):
+                fields[key] = image.to(self.device, non_blocking = True) if self.device.type == 'cuda' else image.clone()
+
+            if self.device.type == 'cuda':
+                events.append(torch.cuda.Event())
+                events[-1].record()
+
+            yield fields
@@ -0,0 +1,144 @@
+import os
+import torch
+import numpy as np
+import torch.nn as nn
+import torch.distributed as dist
+import torch.utils.data as data
+
+from torch.nn.parallel import DistributedDataParallel
+
+
+def init(args):
+    '''
+    joins the process group of a launch by torchrun, which exports RANK, WORLD_SIZE and LOCAL_RANK
+    nccl binds every process to the gpu of its local rank, gloo also runs on cpu only boxes
+    '''
+    if not args.distributed:
+        return
+
+    backend = args.dist_backend
+
+    if backend == 'nccl':
+        torch.cuda.set_device(int(os.environ['LOCAL_RANK']))
+
+    dist.init_process_group(backend, init_method = 'env://')
+
+
+def enabled():
+    return dist.is_available() and dist.is_initialized()
+
+
+def rank():
+    return dist.get_rank() if enabled() else 0
+
+
+def world_size():
+    return dist.get_world_size() if enabled() else 1
+
+
+def is_main():
+    return rank() == 0
+
+
+def barrier():
+    '''
+    waits until every rank gets here, e.g. for the main rank to finish a file the others read
+    '''
+    if enabled():
+        dist.barrier()
+
+
+def get_device():
+    if enabled():
+        if dist.get_backend() == 'nccl':
+            return torch.device('cuda', torch.cuda.current_device())
+
+        return torch.device('cpu')
+
+    return torch.device('cuda')
+
+
+def wrap_model(model, args):
+    '''
+    places the model of this rank under a distributed launch, otherwise on n_cudas gpus
+    a trained model is wrapped by wrap_ddp only after the trainer has taken its float32 master copies and cast it
+    '''
+    if enabled():
+        return model.to(get_device())
+
+    return model.cuda() if args.n_cudas == 1 else nn.DataParallel(model, device_ids = range(args.n_cudas)).cuda()
+
+
+def wrap_ddp(model, args):
+    '''
+    DistributedDataParallel under a distributed launch, otherwise the model as it is
+    the unlabelled passes of semi_teach only reach the last feature map and leave the regressor without gradients,
+    which DistributedDataParallel has to look for after every forward
+    '''
+    if not enabled():
+        return model
+
+    device = get_device()
+
+    return DistributedDataParallel(model, device_ids = [device.index] if device.type == 'cuda' else None, find_unused_parameters = args.semi_teach)
+
+
+def make_sampler(dataset, shuffle):
+    '''
+    Returns:
+        a sampler that gives every rank its share of the train set, None outside a distributed launch
+    '''
+    if not enabled():
+        return None
+
+    return data.DistributedSampler(dataset, shuffle = shuffle)
+
+
+class EvalBatchSampler:
+    '''
+    batches of the unpadded share of this rank in evaluation, so that no sample is counted twice by the reduced metrics
+    the share is split into as many batches as the largest share needs, which keeps the number of batches, and with it
+    the collectives of every forward, the same on all ranks
+    '''
+    def __init__(self, num_samples, batch_size):
+        self.indices = np.arange(rank(), num_samples, world_size())
+
+        largest = (num_samples + world_size() - 1) // world_size()
+
+        self.num_batches = (largest + batch_size - 1) // batch_size
+
+        assert len(self.indices) >= self.num_batches, 'the evaluation samples cannot be shared evenly, please raise batch_size'
+
+    def __iter__(self):
+        for chunk in np.array_split(self.indices, self.num_batches):
+            yield chunk.tolist()
+
+    def __len__(self):
+        return self.num_batches
+
+
+def set_epoch(data_loader, epoch):
+    sampler = getattr(data_loader.batch_sampler, 'sampler', None) if hasattr(data_loader, 'batch_sampler') else None
+
+    if isinstance(sampler, data.DistributedSampler):
+        sampler.set_epoch(epoch)
+
+
+def all_reduce(values):
+    '''
+    sums a numpy array or a list of floats over all ranks
+    '''
+    values = np.asarray(values, dtype = np.float64)
+
+    if not enabled():
+        return values
+
+    tensor = torch.from_numpy(values.copy())
+
+    if dist.get_backend() == 'nccl':
+        tensor = tensor.cuda()
+
+    dist.all_reduce(tensor)
+
+    return tensor.cpu().numpy()
+
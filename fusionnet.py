@@ -4,6 +4,8 @@ import torch.nn.functional as F
 import numpy as np
 import torch.utils.model_zoo as model_zoo
 
+from stage_checkpoint import CheckpointedStage
+
 
 __all__ = ['Bottleneck', 'ResNet', 'resnet18', 'resnet50']
 
@@ -169,18 +171,20 @@ class ResNet(nn.Module):
 
         self.maxpool = nn.MaxPool2d(kernel_size = 3, stride = 2, padding = 1)
 
+        segments = args.act_segments
+
         self.inplanes = 64
-        self.layer1 = self._make_layer(block, 64, layers[0])
-        self.layer2 = self._make_layer(block, 128, layers[1], stride = stride2, dilation = dilate2)
+        self.layer1 = self._make_layer(block, 64, layers[0], segments = segments[0])
+        self.layer2 = self._make_layer(block, 128, layers[1], stride = stride2, dilation = dilate2, segments = segments[1])
 
         self.fusion = Fusion(self.inplanes)
 
-        self.layer3 = self._make_layer(block, 256, layers[2], stride = stride3, dilation = dilate3, skip_relu = args.skip_relu)
-        self.layer4 = self._make_layer(block, 512, layers[3], stride = stride4, dilation = dilate4, skip_relu = args.skip_relu)
+        self.layer3 = self._make_layer(block, 256, layers[2], stride = stride3, dilation = dilate3, skip_relu = args.skip_relu, segments = segments[2])
+        self.layer4 = self._make_layer(block, 512, layers[3], stride = stride4, dilation = dilate4, skip_relu = args.skip_relu, segments = segments[3])
 
         self.inplanes = 64
-        self.layer5 = self._make_layer(block, 64, layers[0])
-        self.layer6 = self._make_layer(block, 128, layers[1], stride = stride2, dilation = dilate2)
+        self.layer5 = self._make_layer(block, 64, layers[0], segments = segments[0])
+        self.layer6 = self._make_layer(block, 128, layers[1], stride = stride2, dilation = dilate2, segments = segments[1])
 
         for m in self.modules():
             if isinstance(m, nn.Conv2d):
@@ -193,7 +197,7 @@ class ResNet(nn.Module):
 
         self.regressor = nn.Conv2d(512 * block.expansion, args.depth * args.num_joints, 3, padding = 1)
 
-    def _make_layer(self, block, planes, blocks, stride = 1, dilation = 1, skip_relu = False):
+    def _make_layer(self, block, planes, blocks, stride = 1, dilation = 1, skip_relu = False, segments = 0):
         downsample = None
         if stride != 1 or self.inplanes != planes * block.expansion:
             downsample = nn.Sequential(
@@ -216,7 +220,7 @@ class ResNet(nn.Module):
 
         layers.append(block(self.inplanes, planes, skip_relu = skip_relu))
 
-        return nn.Sequential(*layers)
+        return CheckpointedStage(segments, *layers)
 
     def forward(self, x, y):
         x = self.conv1(x)
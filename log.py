@@ -1,18 +1,26 @@
 import os
 import torch
+import threading
+import checkpoint
+import distributed
 import numpy as np
 
 class Logger:
-
+    '''
+    under a distributed launch every rank keeps the same state, but only the main rank writes files
+    '''
     def __init__(self, args, state):
         self.state = state if state else dict(best_auc = 0, best_pck = 0, best_epoch = 0, epoch = 0)
+        self.state.setdefault('step', 0)
+
+        self.is_main = distributed.is_main()
 
-        if not os.path.exists(args.save_path):
+        if self.is_main and not os.path.exists(args.save_path):
             os.mkdir(args.save_path)
         
         self.save_path = os.path.join(args.save_path, args.model + '-' + args.suffix)
         
-        if not os.path.exists(self.save_path):
+        if self.is_main and not os.path.exists(self.save_path):
             os.mkdir(self.save_path)
         
         assert args.save_record != (args.test_only or args.val_only)
@@ -22,22 +30,30 @@ class Logger:
 
         self.train_record = torch.load(record_path) if args.resume and os.path.exists(record_path) else None
 
+        interval_path = os.path.join(self.save_path, 'interval_record.pth')
+
+        self.intervals = torch.load(interval_path) if args.resume and os.path.exists(interval_path) else []
+        self.lock = threading.Lock()
+
+        if self.is_main:
+            kept = [name for name in os.listdir(self.save_path) if name.startswith('model_') and name.endswith('.pth')] if args.resume else []
+            kept = sorted(kept, key = lambda name: os.path.getmtime(os.path.join(self.save_path, name)))
+
+            best = 'model_%d.pth' % self.state['best_epoch'] if self.state['best_epoch'] else None
 
-    def record(self, epoch, train_recs, test_recs, model):
+            self.writer = checkpoint.CheckpointWriter(self.save_path, args.keep_last, kept, best)
+        else:
+            self.writer = None
 
-        if torch.typename(model).find('DataParallel') != -1:
-            model = model.module
 
+    def record(self, epoch, train_recs, test_recs, trainer):
+        '''
+        checkpoints the model, optimizer and mixed-precision state of trainer after a whole epoch
+        '''
         self.state['epoch'] = epoch
-         
-        if train_recs:
-            model_file = os.path.join(self.save_path, 'model_%d.pth' % epoch);
-            
-            checkpoint = dict()
-            checkpoint['state'] = self.state
-            checkpoint['model'] = model.state_dict()
-            
-            torch.save(checkpoint, model_file)
+        self.state['step'] = 0
+
+        is_best = False
 
         if test_recs:
             score_sum = test_recs['score_auc'] + test_recs['score_pck']
@@ -48,12 +64,18 @@ class Logger:
                 self.state['best_auc'] = test_recs['score_auc']
                 self.state['best_pck'] = test_recs['score_pck']
 
-                best = os.path.join(self.save_path, 'best.pth')
-                torch.save({'best': epoch}, best)
+                is_best = True
+
+                if self.is_main:
+                    best = os.path.join(self.save_path, 'best.pth')
+                    torch.save({'best': epoch}, best)
+
+        if train_recs and self.is_main:
+            self.writer.save('model_%d.pth' % epoch, dict(state = dict(self.state), **trainer.state_dict()), is_best)
 
         train_recs.update(test_recs)
 
-        if self.save_record:
+        if self.save_record and self.is_main:
 
             if self.train_record:
                 keys = [key for key in train_recs]
@@ -70,11 +92,40 @@ class Logger:
 
             torch.save(self.train_record, os.path.join(self.save_path, 'train_record.pth'))
 
+            with self.lock:
+                torch.save(self.intervals, os.path.join(self.save_path, 'interval_record.pth'))
+
             print('- train record saved to', os.path.join(self.save_path, 'train_record.pth'), '\n')
 
 
+    def checkpoint(self, epoch, step, trainer):
+        '''
+        checkpoints trainer after step iterations of epoch, from which a resumed run finishes the epoch
+        '''
+        if not self.is_main:
+            return
+
+        state = dict(self.state, epoch = epoch - 1, step = step)
+
+        self.writer.save('model_%d_%d.pth' % (epoch, step), dict(state = state, **trainer.state_dict()))
+
+
+    def close(self):
+        if self.is_main:
+            self.writer.close()
+
+
+    def log_interval(self, phase, epoch, step, record):
+        '''
+        keeps the running losses and throughput reported by a metric accumulator, called from its reporting thread
+        '''
+        with self.lock:
+            self.intervals.append(dict(phase = phase, epoch = epoch, step = step, **record))
+
+
     def final_print(self):
-        print('[=] Best:  epoch: {:3d}  auc: {:6.3f}  pck: {:6.3f}'.format(self.state['best_epoch'], self.state['best_auc'], self.state['best_pck']))
+        if self.is_main:
+            print('[=] Best:  epoch: {:3d}  auc: {:6.3f}  pck: {:6.3f}'.format(self.state['best_epoch'], self.state['best_auc'], self.state['best_pck']))
 
     def print_rec(self, record):
         for key, value in record.items():
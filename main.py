@@ -3,6 +3,8 @@ import torch
 import torch.nn as nn
 import torch.backends.cudnn as cudnn
 
+import distributed
+
 from opts import args
 from datasets import get_data_loader
 from log import Logger
@@ -25,7 +27,7 @@ def create_model(args):
 
     assert not (args.resume and args.pretrain)
 
-    state = None
+    resumed = None
 
     model_creators = get_catalogue()
 
@@ -39,11 +41,11 @@ def create_model(args):
         print('=> Loading checkpoint from ' + os.path.join(save_path, 'best.pth'))
         assert os.path.exists(save_path)
 
-        best = torch.load(os.path.join(save_path, 'best.pth'))
+        best = torch.load(os.path.join(save_path, 'best.pth'), map_location = 'cpu')
         best = best['best'];
         
         checkpoint = os.path.join(save_path, 'model_%d.pth' % best)
-        checkpoint = torch.load(checkpoint)['model']
+        checkpoint = torch.load(checkpoint, map_location = distributed.get_device())['model']
 
         keys = checkpoint.keys()
         model_dict = model.state_dict()
@@ -57,21 +59,23 @@ def create_model(args):
 
     if args.resume:
         print('=> Loading checkpoint from ' + args.model_path)
-        checkpoint = torch.load(args.model_path)
+        checkpoint = torch.load(args.model_path, map_location = distributed.get_device())
         
         model.load_state_dict(checkpoint['model'])
-        state = checkpoint['state']
+        resumed = checkpoint
 
     cudnn.benchmark = True
-    model = model.cuda() if args.n_cudas == 1 else nn.DataParallel(model, device_ids = range(args.n_cudas)).cuda()
+    model = distributed.wrap_model(model, args)
 
-    return model, state
+    return model, resumed
 
 
 def main():
+    distributed.init(args)
+
     assert args.do_track <= args.joint_space
 
-    model, state = create_model(args)
+    model, resumed = create_model(args)
     print('=> Model and criterion are ready')
 
     if args.test_only:
@@ -85,12 +89,15 @@ def main():
 
     print('=> Dataloaders are ready')
 
-    logger = Logger(args, state)
+    logger = Logger(args, resumed['state'] if resumed else None)
     print('=> Logger is ready')
 
-    trainer = Trainer(args, model, data_info)
+    trainer = Trainer(args, model, data_info, logger)
     print('=> Trainer is ready')
 
+    if resumed:
+        trainer.load_state_dict(resumed)
+
     if args.test_only or args.val_only:
         test_rec = trainer.test(0, test_loader)
 
@@ -102,9 +109,11 @@ def main():
             train_rec = trainer.train(epoch, data_loader)
             test_rec = trainer.test(epoch, test_loader)
 
-            logger.record(epoch, train_rec, test_rec, model) 
+            logger.record(epoch, train_rec, test_rec, trainer)
 
         logger.final_print()
 
+    logger.close()
+
 if __name__ == '__main__':
     main()
@@ -2,6 +2,8 @@ import torch
 import numpy as np
 import cv2
 
+from soft_argmax import SoftArgmax
+
 
 class Mapper:
 
@@ -55,6 +57,18 @@ def decode(heatmap, map_range):
 	return torch.stack((coord_x, coord_y), dim = 2) * map_range  # (batch_size, num_joints, 2)
 
 
+def soft_argmax(ausgabe, num_joints, height, width, map_range):
+	'''
+	fused to_heatmap and decode on the soft-argmax op of the volumetric head, keeping no heatmap for backward
+	'''
+	logits = ausgabe.view(-1, num_joints, height, width)
+
+	grid_x = torch.linspace(0.0, 1.0, width, device = ausgabe.device) * map_range
+	grid_y = torch.linspace(0.0, 1.0, height, device = ausgabe.device) * map_range
+
+	return SoftArgmax.apply(logits, 1, (3, 2), (grid_x, grid_y))  # (batch_size, num_joints, 2)
+
+
 def coord_to_scale(true_mat, valid):
 	'''
 	utilizes true image coords to compute relative scale of a pose instance in terms of its area
@@ -108,13 +122,18 @@ def analyze(spec_mat, true_mat, valid_mask, side_in):
 	)
 
 
-def parse_epoch(scores):
+def parse_epoch(scores, reduce = None):
 
 	keys = ('score_oks', 'mat_mean', 'batch_size')
 
-	values = np.array([[patch[key] for patch in scores] for key in keys])
+	values = np.array([[patch[key] for patch in scores] for key in keys]).reshape(len(keys), -1)
+
+	sums = np.append(np.sum(values[-1] * values[:-1], axis = 1), np.sum(values[-1]))
+
+	if reduce is not None:
+		sums = reduce(sums)
 
-	return dict(zip(keys[:-1], np.sum(values[-1] * values[:-1], axis = 1) / np.sum(values[-1])))
+	return dict(zip(keys[:-1], sums[:-1] / sums[-1]))
 
 
 def rand_rotate(center, image, points, max_radian):
@@ -0,0 +1,133 @@
+import time
+import queue
+import torch
+import threading
+import distributed
+
+
+class MetricAccumulator:
+    '''
+    running sums of named losses kept as tensors on the device, so that an iteration never waits for the device
+    just to report its losses
+    every print_freq steps the sums are copied to the host without blocking, and a background thread waits for
+    the copy, prints the means and the throughput of the interval and hands them to the logger
+    under a distributed launch only the main rank reports its intervals, while epoch means are pooled over all ranks
+    '''
+    def __init__(self, phase, epoch, n_batches, print_freq, logger = None):
+        self.phase = phase
+        self.epoch = epoch
+        self.n_batches = n_batches
+        self.print_freq = max(print_freq, 1)
+        self.logger = logger
+
+        self.sums = dict()  # name -> weighted sum as a tensor
+        self.counts = dict()  # name -> number of items the sum is weighted by
+
+        self.steps = 0
+        self.samples = 0
+
+        self.pending = queue.Queue()
+        self.worker = threading.Thread(target = self.report, args = (time.time(),), daemon = True)
+        self.worker.start()
+
+
+    def add(self, name, value, count):
+        '''
+        Args:
+            value: mean over count items, a tensor that may still be computed on the device
+        '''
+        value = torch.as_tensor(value).detach().float() * count
+
+        self.sums[name] = self.sums[name] + value if name in self.sums else value
+        self.counts[name] = self.counts.get(name, 0) + count
+
+
+    def step(self, num_samples):
+        self.steps += 1
+        self.samples += num_samples
+
+        if self.steps % self.print_freq == 0 or self.steps == self.n_batches:
+            self.flush()
+
+
+    def flush(self):
+        names = list(self.sums.keys())
+
+        if not names:
+            return
+
+        snapshot = torch.stack([self.sums[name] for name in names])
+
+        event = None
+
+        if snapshot.is_cuda:
+            snapshot = snapshot.to('cpu', non_blocking = True)
+
+            event = torch.cuda.Event()
+            event.record()
+
+        self.pending.put((names, snapshot, event, dict(self.counts), self.steps, self.samples, time.time()))
+
+
+    def report(self, start):
+        last_sums = dict()
+        last_counts = dict()
+        last_samples = 0
+        last_stamp = start
+
+        while True:
+            item = self.pending.get()
+
+            if item is None:
+                break
+
+            names, snapshot, event, counts, steps, samples, stamp = item
+
+            if event is not None:
+                event.synchronize()
+
+            sums = dict(zip(names, snapshot.tolist()))
+
+            record = dict()
+
+            for name in names:
+                count = counts[name] - last_counts.get(name, 0)
+
+                if count:
+                    record[name] = (sums[name] - last_sums.get(name, 0.0)) / count
+
+            record['throughput'] = (samples - last_samples) / max(stamp - last_stamp, 1e-6)
+
+            message = '| %s Epoch[%d] [%d/%d]' % (self.phase, self.epoch, steps, self.n_batches)
+            message += ''.join('  %s Loss %1.4f' % (name.capitalize(), record[name]) for name in names if name in record)
+            message += '  %1.1f samples/s' % record['throughput']
+
+            if distributed.is_main():
+                print(message, flush = True)
+
+                if self.logger is not None:
+                    self.logger.log_interval(self.phase, self.epoch, steps, record)
+
+            last_sums, last_counts, last_samples, last_stamp = sums, counts, samples, stamp
+
+
+    def close(self):
+        '''
+        waits for the pending reports, after which mean can be called
+        '''
+        if self.steps % self.print_freq and self.steps != self.n_batches:
+            self.flush()
+
+        self.pending.put(None)
+        self.worker.join()
+
+
+    def mean(self, *names):
+        '''
+        mean over all items of the given names, which may pool several losses of the same kind
+        '''
+        names = [name for name in names if name in self.sums]
+
+        total, count = distributed.all_reduce([sum(self.sums[name].item() for name in names), sum(self.counts[name] for name in names)])
+
+        return total / count if count else 0.0
@@ -0,0 +1,155 @@
+import torch
+import torch.nn as nn
+
+
+half_types = dict(float16 = torch.float16, bfloat16 = torch.bfloat16)
+
+
+class MixedStep:
+    '''
+    backward, clip and update for a model whose parameters are kept in reduced precision
+    the optimizer works on float32 master copies, which are copied back into the model after every update
+    the loss scale halves whenever the gradients are not finite, in which case the update is skipped,
+    and doubles after scale_window consecutive clean steps
+    unscaling, the non-finite check and clipping share one multi-tensor norm and one host sync per step
+    without half_acc the step is the plain backward, clip and update on the parameters themselves
+    backward may be called several times before update to accumulate the gradients of micro-batches
+    '''
+    def __init__(self, params, half_acc, grad_norm, init_scale, scale_window = 1000):
+        self.params = list(params)
+        self.half_acc = half_acc
+        self.grad_norm = grad_norm
+
+        self.scale = float(init_scale) if half_acc else 1.0
+        self.scale_window = scale_window
+        self.clean_steps = 0
+        self.skipped = 0
+
+        if half_acc:
+            self.master_params = [param.detach().clone().float().requires_grad_() for param in self.params]
+        else:
+            self.master_params = self.params
+
+        self.zero_grad()
+
+
+    def state_dict(self):
+        '''
+        the loss scale state, and under half_acc the float32 master copies the optimizer works on
+        '''
+        state = dict(scale = self.scale, clean_steps = self.clean_steps, skipped = self.skipped)
+
+        if self.half_acc:
+            state['masters'] = [master.detach() for master in self.master_params]
+
+        return state
+
+
+    def load_state_dict(self, state):
+        self.scale = state['scale']
+        self.clean_steps = state['clean_steps']
+        self.skipped = state['skipped']
+
+        if self.half_acc and 'masters' in state:
+            with torch.no_grad():
+                torch._foreach_copy_(self.master_params, [master.to(self.master_params[0].device) for master in state['masters']])
+                torch._foreach_copy_(self.params, self.master_params)
+
+
+    def zero_grad(self):
+        for master in self.master_params:
+            master.grad = None
+
+
+    def backward(self, loss):
+        '''
+        adds the gradients of loss to those accumulated since the last update, in float32 under half_acc
+        '''
+        if not self.half_acc:
+            return loss.backward()
+
+        for param in self.params:
+            param.grad = None
+
+        (loss * self.scale).backward()
+
+        half_grads = []
+        master_grads = []
+
+        for master, param in zip(self.master_params, self.params):
+            if param.grad is None:
+                continue
+
+            if master.grad is None:
+                master.grad = torch.zeros_like(master)
+
+            half_grads.append(param.grad)
+            master_grads.append(master.grad)
+
+        torch._foreach_add_(master_grads, half_grads)
+
+
+    def unscale_and_clip(self, master_grads):
+        '''
+        Returns:
+            whether all gradients are finite, the only host sync of the step
+        '''
+        torch._foreach_mul_(master_grads, 1.0 / self.scale)
+
+        total_norm = torch.linalg.vector_norm(torch.stack(torch._foreach_norm(master_grads)))
+
+        if not torch.isfinite(total_norm).item():
+            return False
+
+        torch._foreach_mul_(master_grads, torch.clamp(self.grad_norm / (total_norm + 1e-6), max = 1.0))
+
+        return True
+
+
+    def update_scale(self, finite):
+        if finite:
+            self.clean_steps += 1
+
+            if self.clean_steps == self.scale_window:
+                self.scale *= 2.0
+                self.clean_steps = 0
+        else:
+            self.scale /= 2.0
+            self.clean_steps = 0
+            self.skipped += 1
+
+
+    def update(self, optimizer):
+        '''
+        Returns:
+            whether the optimizer has stepped on the accumulated gradients, which are cleared either way
+        '''
+        if not self.half_acc:
+            nn.utils.clip_grad_norm_(self.params, self.grad_norm)
+            optimizer.step()
+
+            self.zero_grad()
+            return True
+
+        master_grads = [master.grad for master in self.master_params if master.grad is not None]
+
+        finite = self.unscale_and_clip(master_grads) if master_grads else True
+
+        self.update_scale(finite)
+
+        if finite:
+            optimizer.step()
+
+            with torch.no_grad():
+                torch._foreach_copy_(self.params, self.master_params)
+        else:
+            print('update step skipped, loss scale backs off to %g' % self.scale)
+
+        self.zero_grad()
+        return finite
+
+
+    def __call__(self, loss, optimizer):
+        self.backward(loss)
+
+        return self.update(optimizer)
@@ -0,0 +1,110 @@
+import math
+import torch
+import distributed
+import torch.utils.data as data
+
+
+LABELLED = 0
+UNLABELLED = 1
+
+
+class SourceStack(data.Dataset):
+    '''
+    several datasets behind one index space of (source, index) pairs
+    every item gets its source appended, so that the collated batch says which stream it belongs to
+    '''
+    def __init__(self, datasets):
+        self.datasets = datasets
+
+        self.at_test = datasets[0].at_test
+        self.device_warp = datasets[0].device_warp
+        self.uint8_batches = datasets[0].uint8_batches
+
+        assert all(dataset.device_warp == self.device_warp and dataset.uint8_batches == self.uint8_batches for dataset in datasets)
+
+        self.num_steps = None
+
+
+    def __getitem__(self, key):
+        source, index = key
+
+        return tuple(self.datasets[source][index]) + (source,)
+
+
+    def __len__(self):
+        return sum(len(dataset) for dataset in self.datasets)
+
+
+class SourceStream:
+    '''
+    endless shuffled batches of one source, reshuffled whenever the source is exhausted
+    the permutation only depends on the seed and the pass, so that all ranks agree on it and take their own share
+    '''
+    def __init__(self, source, num_samples, batch_size, shuffle, seed):
+        self.source = source
+        self.num_samples = num_samples
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.seed = seed
+
+        self.passes = 0
+        self.indices = []
+
+
+    def refill(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed * 1000003 + self.source * 1009 + self.passes)
+
+        order = torch.randperm(self.num_samples, generator = generator).tolist() if self.shuffle else list(range(self.num_samples))
+
+        self.indices = order[distributed.rank()::distributed.world_size()]
+        self.passes += 1
+
+
+    def next_batch(self):
+        if len(self.indices) < self.batch_size:
+            self.refill()
+
+        batch, self.indices = self.indices[:self.batch_size], self.indices[self.batch_size:]
+
+        return [(self.source, index) for index in batch]
+
+
+class InterleavedBatchSampler(data.Sampler):
+    '''
+    one epoch of the labelled source, with ratio unlabelled batches before every labelled batch on average
+    the unlabelled stream keeps its own position and epoch boundaries across labelled epochs
+    '''
+    def __init__(self, lengths, batch_sizes, ratio, shuffle = True, seed = 0):
+        self.labelled = SourceStream(LABELLED, lengths[LABELLED], batch_sizes[LABELLED], shuffle, seed)
+        self.unlabelled = SourceStream(UNLABELLED, lengths[UNLABELLED], batch_sizes[UNLABELLED], shuffle, seed)
+        self.ratio = ratio
+
+        self.num_steps = (lengths[LABELLED] // distributed.world_size()) // batch_sizes[LABELLED]
+
+
+    def __iter__(self):
+        for step in range(self.num_steps):
+            for _ in range(math.floor((step + 1) * self.ratio) - math.floor(step * self.ratio)):
+                yield self.unlabelled.next_batch()
+
+            yield self.labelled.next_batch()
+
+
+    def __len__(self):
+        return self.num_steps + math.floor(self.num_steps * self.ratio)
+
+
+def data_loader(datasets, batch_sizes, args):
+    '''
+    a single loader over labelled and unlabelled datasets whose worker pool persists across epochs
+    '''
+    dataset = SourceStack(datasets)
+
+    batch_sampler = InterleavedBatchSampler([len(source) for source in datasets], batch_sizes, args.semi_ratio, args.shuffle)
+
+    dataset.num_steps = batch_sampler.num_steps
+
+    pin_memory = not (args.device_warp or args.uint8_batches)
+
+    return data.DataLoader(dataset, batch_sampler = batch_sampler, num_workers = args.workers, pin_memory = pin_memory, persistent_workers = args.workers > 0)
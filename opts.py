@@ -5,6 +5,7 @@ parser = argparse.ArgumentParser(description='Parser for all the training option
 # bool options
 parser.add_argument('-shuffle', action='store_true', help='Reshuffle data at each epoch')
 parser.add_argument('-half_acc', action='store_true', help='whether to use float16 for speed-up')
+parser.add_argument('-distributed', action='store_true', help='whether to run as one process of a torchrun launch with DistributedDataParallel, batch_size is then per process')
 parser.add_argument('-save_record', action='store_true', help='Path to save train record')
 parser.add_argument('-test_only', action='store_true', help='only performs test')
 parser.add_argument('-val_only', action='store_true', help='only performs validation')
@@ -20,6 +21,8 @@ parser.add_argument('-to_depth', action='store_true', help='whether to convert r
 parser.add_argument('-partial_conv', action='store_true', help='whether to replace all convs in Resnet with partial convs')
 parser.add_argument('-do_fusion', action='store_true', help='whether to accept both color and depth input')
 parser.add_argument('-do_teach', action='store_true', help='whether to force a student to mimic its teacher')
+parser.add_argument('-teach_store', action='store_true', help='whether to distill from precomputed teacher features, with augmentation limited to the stored flip and zoom states')
+parser.add_argument('-bake_teacher', action='store_true', help='only bakes the teacher features of every train sample and augmentation state into the store')
 parser.add_argument('-semi_teach', action='store_true', help='whether to force a student to mimic its teacher on additional unlabelled image pairs')
 parser.add_argument('-early_dist', action='store_true', help='whether to impose distillation loss on the third stage feature map')
 parser.add_argument('-skip_relu', action='store_true', help='whether to impose distillation loss on the feature map before relu is applied')
@@ -28,34 +31,52 @@ parser.add_argument('-bin_dist', action='store_true', help='whether to do pixel-
 parser.add_argument('-attention', action='store_true', help='whether to apply attention map on distillation target')
 parser.add_argument('-save_last', action='store_true', help='whether to save the last feature map of the model')
 parser.add_argument('-do_freeze', action='store_true', help='whether to freeze the batchnorm layers of both networks during distillation')
+parser.add_argument('-bake_only', action='store_true', help='only bakes the valid and test crops into memory-mapped shards')
+parser.add_argument('-baked', action='store_true', help='whether to read valid and test crops from pre-baked shards')
+parser.add_argument('-device_warp', action='store_true', help='whether to warp, augment and normalize the crops as batched ops on the training device')
+parser.add_argument('-uint8_batches', action='store_true', help='whether to ship uint8 colour and float16 depth crops through pinned buffers and normalize them on the device')
+parser.add_argument('-parallel_decode', action='store_true', help='whether to decode and crop the depth frame on a helper thread while the colour frame is processed')
+parser.add_argument('-cache_valid', action='store_true', help='whether to keep collated validation batches across epochs')
 
 # augmentation options
 parser.add_argument('-geometry', action='store_true', help='whether to perform geometry augmentation')
 parser.add_argument('-colour', action='store_true', help='whether to perform colour augmentation')
-parser.add_argument('-eraser', action='store_true', help='whether to perform eraser augmentation')
+parser.add_argument('-fast_colour', action='store_true', help='whether to perform colour augmentation with lookup tables and yiq colour matrices instead of hsv conversions')
+parser.add_argument('-eraser', action='store_true', help='whether to perform eraser augmentation on collated batches on the training device')
 parser.add_argument('-occluder', action='store_true', help='whether to perform occluder augmentation')
+parser.add_argument('-batch_occluder', action='store_true', help='whether to paste occluders onto collated batches on the training device instead of in the dataloader workers')
 
 # required options
 parser.add_argument('-model', required=True, help='Backbone architecture')
 parser.add_argument('-model_path', help='Path to an imagenet pre-train or checkpoint')
 parser.add_argument('-teacher_path', help='Path to a checkpoint of the teacher model')
+parser.add_argument('-store_path', help='Path to the precomputed teacher features')
 parser.add_argument('-host_path', help='Path to a checkpoint of the depth-only host model')
 parser.add_argument('-suffix', required=True, help='Model suffix')
 parser.add_argument('-data_name', required=True, help='name of dataset')
 parser.add_argument('-occ_path', help='Root path to occluders')
+parser.add_argument('-cache_path', help='Local directory that validation batches spill to once the memory cap is reached')
 parser.add_argument('-save_path', required=True, help='Path to save train record')
 parser.add_argument('-criterion', required=True, help='criterion function for estimation loss')
+parser.add_argument('-decoder', default='pyplot', choices=['pyplot', 'jpeg4py', 'opencv'], help='image decoder, opencv decodes jpegs at reduced resolution')
 
 # integer options
 parser.add_argument('-warmup', default=1, type=int, help='number of warmup epochs')
 parser.add_argument('-n_epochs', default=20, type=int, help='number of total epochs')
 parser.add_argument('-batch_size', default=64, type=int, help='Size of mini-batches for each iteration')
+parser.add_argument('-print_freq', default=10, type=int, help='number of iterations between the printed running losses')
+parser.add_argument('-ckpt_freq', default=0, type=int, help='number of iterations between mid-epoch checkpoints, 0 for epoch checkpoints only')
+parser.add_argument('-keep_last', default=0, type=int, help='number of most recent checkpoints kept besides the best one, 0 to keep all')
+parser.add_argument('-accum_steps', default=1, type=int, help='number of micro-batches each mini-batch is split into, with their gradients accumulated into one update')
+parser.add_argument('-semi_ratio', default=1.0, type=float, help='Average number of unlabelled mini-batches interleaved with each labelled mini-batch')
 parser.add_argument('-semi_batch', default=16, type=int, help='Size of mini-batches of unlabelled image pairs for each iteration')
 parser.add_argument('-n_cudas', default=2, type=int, help='Number of cuda devices available')
 parser.add_argument('-workers', default=2, type=int, help='Number of subprocesses to load data')
 parser.add_argument('-num_processes', default=6, type=int, help='Number of subprocesses in the process pool')
 parser.add_argument('-side_in', default=257, type=int, help='side of input image')
+parser.add_argument('-canvas_side', default=512, type=int, help='side of the canvas that decoded images are placed on under device warping')
 parser.add_argument('-stride', default=16, type=int, help='stride of network for train')
+parser.add_argument('-act_segments', default=[0, 0, 0, 0], nargs=4, type=int, help='number of activation-checkpointed segments in each of the four resnet stages, 0 keeps all activations of a stage')
 parser.add_argument('-num_joints', default=19, type=int, help='number of joints in the dataset')
 parser.add_argument('-depth', default=16, type=int, help='depth side of volumetric heatmap')
 parser.add_argument('-alpha_span', default=10, type=int, help='warmup span of distillation setup')
@@ -65,14 +86,20 @@ parser.add_argument('-warmup_factor', default=0.2, type=float, help='learn rate
 parser.add_argument('-learn_rate', default=5e-5, type=float, help='base learn rate for train')
 parser.add_argument('-learn_decay', default=0.2, type=float, help='learn rate decay factor')
 parser.add_argument('-grad_norm', default=5.0, type=float, help='norm for gradient clip')
-parser.add_argument('-grad_scaling', default=32.0, type=float, help='magnitude of loss scaling when performing float16 computation')
+parser.add_argument('-grad_scaling', default=32.0, type=float, help='initial magnitude of loss scaling when performing float16 computation')
+parser.add_argument('-scale_window', default=1000, type=int, help='number of clean steps after which the loss scaling doubles')
+parser.add_argument('-dist_backend', default='nccl', type=str, choices=['nccl', 'gloo'], help='backend of the process group under distributed, gloo also runs on cpu')
+parser.add_argument('-half_type', default='float16', type=str, choices=['float16', 'bfloat16'], help='reduced precision type of the model under half_acc')
 parser.add_argument('-momentum', default=0.9, type=float, help='Momentum for training')
 parser.add_argument('-weight_decay', default=4e-5, type=float, help='Weight decay for training')
 parser.add_argument('-box_margin', default=0.6, type=float, help='factor for generating pseudo bbox from image coords')
 parser.add_argument('-alpha_dest', default=0.1, type=float, help='dest value for alpha under distillation setup')
 parser.add_argument('-alpha_init', default=0.1, type=float, help='init value for alpha under distillation setup')
 parser.add_argument('-depth_range', default=1000.0, type=float, help='depth range of prediction')
+parser.add_argument('-cache_mem', default=4.0, type=float, help='GB of shared memory for cached validation batches')
+parser.add_argument('-cache_disk', default=16.0, type=float, help='GB of local disk for spilled validation batches')
 parser.add_argument('-random_zoom', default=0.9, type=float, help='scale for random zoom operation')
+parser.add_argument('-zoom_bins', default=5, type=int, help='number of zoom levels of the teacher store per flip, 1 without -geometry')
 parser.add_argument('-loss_div', default=10.0, type=float, help='divisor applied to both ground-truth and estimation before loss is calculated')
 
 args = parser.parse_args()
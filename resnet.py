@@ -4,6 +4,8 @@ import torch.nn.functional as F
 import numpy as np
 import torch.utils.model_zoo as model_zoo
 
+from stage_checkpoint import CheckpointedStage
+
 
 __all__ = ['Bottleneck', 'ResNet', 'resnet18', 'resnet50']
 
@@ -143,10 +145,12 @@ class ResNet(nn.Module):
         self.bn1 = nn.BatchNorm2d(64)
         self.maxpool = nn.MaxPool2d(kernel_size = 3, stride = 2, padding = 1)
 
-        self.layer1 = self._make_layer(block, 64, layers[0])
-        self.layer2 = self._make_layer(block, 128, layers[1], stride = stride2, dilation = dilate2)
-        self.layer3 = self._make_layer(block, 256, layers[2], stride = stride3, dilation = dilate3)
-        self.layer4 = self._make_layer(block, 512, layers[3], stride = stride4, dilation = dilate4)
+        segments = args.act_segments
+
+        self.layer1 = self._make_layer(block, 64, layers[0], segments = segments[0])
+        self.layer2 = self._make_layer(block, 128, layers[1], stride = stride2, dilation = dilate2, segments = segments[1])
+        self.layer3 = self._make_layer(block, 256, layers[2], stride = stride3, dilation = dilate3, segments = segments[2])
+        self.layer4 = self._make_layer(block, 512, layers[3], stride = stride4, dilation = dilate4, segments = segments[3])
 
         for m in self.modules():
             if isinstance(m, nn.Conv2d):
@@ -171,7 +175,7 @@ class ResNet(nn.Module):
             padding = 1
         ) if args.joint_space else None
 
-    def _make_layer(self, block, planes, blocks, stride = 1, dilation = 1):
+    def _make_layer(self, block, planes, blocks, stride = 1, dilation = 1, segments = 0):
         downsample = None
         if stride != 1 or self.inplanes != planes * block.expansion:
             downsample = nn.Sequential(
@@ -191,7 +195,7 @@ class ResNet(nn.Module):
         for i in range(1, blocks):
             layers.append(block(self.inplanes, planes))
 
-        return nn.Sequential(*layers)
+        return CheckpointedStage(segments, *layers)
 
     def forward(self, x):
         x = self.conv1(x)
@@ -0,0 +1,249 @@
+import os
+import json
+import shutil
+import cameralib
+import distributed
+import numpy as np
+
+
+store_version = 2
+
+
+def encode(strings):
+    return np.array([string.encode('utf-8') for string in strings])
+
+
+def group_of(sample):
+    '''
+    the unit that every split function decides on, videos for ntu / pku and image folders for h36m
+    '''
+    return sample['video'] if 'video' in sample else os.path.dirname(sample['image'])
+
+
+def build_store(samples, store_path):
+    '''
+    converts a list of sample dicts into a columnar store on disk
+    every field lives in its own .npy file which is later opened as a memmap, so that forked
+    dataloader workers share its pages instead of copying a list of python objects
+    samples are sorted by group so that the split index only needs to record a row range per group
+
+    Args:
+        samples: list of dict(skeleton, valid, image, bbox, camera, [depth_bbox, video, frame])
+        store_path: directory that receives one .npy file per column
+    '''
+    samples = sorted(samples, key = group_of)
+
+    groups = [group_of(sample) for sample in samples]
+    starts = [index for index in range(len(groups)) if index == 0 or groups[index] != groups[index - 1]]
+
+    num_joints = len(samples[0]['valid'])
+    cameras = [sample['camera'] for sample in samples]
+
+    columns = dict(
+        skeleton = np.stack([sample['skeleton'] for sample in samples]).astype(np.float32),
+        valid = np.packbits(np.stack([sample['valid'] for sample in samples]).astype(bool), axis = 1),
+        bbox = np.stack([sample['bbox'] for sample in samples]).astype(np.float32),
+        image = encode([sample['image'] for sample in samples]),
+        intrinsics = np.stack([camera.intrinsic_matrix for camera in cameras]).astype(np.float32),
+        rotation = np.stack([camera.R for camera in cameras]).astype(np.float32),
+        optical_center = np.stack([camera.t for camera in cameras]).astype(np.float32),
+        world_up = np.stack([camera.world_up for camera in cameras]).astype(np.float32),
+        distorted = np.array([camera.distortion_coeffs is not None for camera in cameras]),
+        distortion = np.stack([np.zeros(5) if camera.distortion_coeffs is None else camera.distortion_coeffs for camera in cameras]).astype(np.float32)
+    )
+    if 'depth_bbox' in samples[0]:
+        columns['depth_bbox'] = np.stack([sample['depth_bbox'] for sample in samples]).astype(np.float32)
+
+    if 'video' in samples[0]:
+        columns['video'] = encode([sample['video'] for sample in samples])
+        columns['frame'] = np.array([sample['frame'] for sample in samples], dtype = np.int32)
+
+    columns['group_starts'] = np.array(starts, dtype = np.int64)
+    columns['group_stops'] = np.array(starts[1:] + [len(samples)], dtype = np.int64)
+
+    # every builder writes its own temporary tree, so that a concurrent build never deletes a half-written one
+    temp_path = store_path + '.tmp%d' % os.getpid()
+
+    if os.path.exists(temp_path):
+        shutil.rmtree(temp_path)
+
+    os.mkdir(temp_path)
+
+    for key, column in columns.items():
+        np.save(os.path.join(temp_path, key + '.npy'), column)
+
+    with open(os.path.join(temp_path, 'meta.json'), 'w') as file:
+        json.dump(dict(version = store_version, num_samples = len(samples), num_joints = num_joints, columns = list(columns.keys())), file)
+
+    if os.path.exists(store_path) and is_stale(store_path):
+        shutil.rmtree(store_path, ignore_errors = True)
+
+    try:
+        os.rename(temp_path, store_path)
+    except OSError:
+        # another builder got there first, its store is as good as this one
+        if is_stale(store_path):
+            raise
+
+        shutil.rmtree(temp_path)
+
+
+def save_arrays(arrays, path):
+    '''
+    writes one .npy file per array into the directory path, which appears at once or not at all
+    '''
+    temp_path = path + '.tmp%d' % os.getpid()
+
+    if os.path.exists(temp_path):
+        shutil.rmtree(temp_path)
+
+    os.mkdir(temp_path)
+
+    for key, array in arrays.items():
+        np.save(os.path.join(temp_path, key + '.npy'), array)
+
+    try:
+        os.rename(temp_path, path)
+    except OSError:
+        if not os.path.exists(path):
+            raise
+
+        shutil.rmtree(temp_path)
+
+
+def is_stale(store_path):
+    if not os.path.exists(store_path):
+        return True
+
+    with open(os.path.join(store_path, 'meta.json')) as file:
+        meta = json.load(file)
+
+    return meta.get('version') != store_version
+
+
+def load_or_build(store_path, load_samples):
+    '''
+    opens the columnar store at store_path, building it from load_samples() on first use
+    under a distributed launch only the main rank builds it, while the other ranks wait
+    '''
+    if distributed.is_main() and is_stale(store_path):
+        print('=> builds sample store at', store_path)
+        build_store(load_samples(), store_path)
+
+    distributed.barrier()
+
+    return SampleStore(store_path)
+
+
+class SampleStore:
+
+    def __init__(self, store_path, rows = None, columns = None, meta = None):
+        if meta is None:
+            with open(os.path.join(store_path, 'meta.json')) as file:
+                meta = json.load(file)
+
+        if columns is None:
+            columns = {key: np.load(os.path.join(store_path, key + '.npy'), mmap_mode = 'r') for key in meta['columns']}
+
+        self.store_path = store_path
+        self.meta = meta
+        self.columns = columns
+        self.num_joints = meta['num_joints']
+        self.rows = np.arange(meta['num_samples']) if rows is None else np.asarray(rows, dtype = np.int64)
+
+
+    def subset(self, rows):
+        return SampleStore(self.store_path, self.rows[rows], self.columns, self.meta)
+
+
+    def select(self, split_by, split, phase):
+        '''
+        evaluates split_by once per group of the persisted split index and keeps the row ranges of the chosen groups
+        '''
+        assert len(self.rows) == self.meta['num_samples']
+
+        starts = self.columns['group_starts']
+        stops = self.columns['group_stops']
+
+        ranges = [np.arange(start, stop) for start, stop in zip(starts, stops) if split_by(split, phase, self.split_keys(start))]
+
+        return self.subset(np.concatenate(ranges) if ranges else np.zeros(0, dtype = np.int64))
+
+
+    def derive(self, name, compute):
+        '''
+        arrays that compute(store) derives from all rows of the store, e.g. crop geometry, indexed by store row
+        they are saved next to the columns on first use and memory-mapped afterwards, so that a split opens in O(1)
+        under a distributed launch only the main rank computes them, while the other ranks wait
+        '''
+        path = os.path.join(self.store_path, name)
+
+        if distributed.is_main() and not os.path.exists(path):
+            save_arrays(compute(SampleStore(self.store_path, None, self.columns, self.meta)), path)
+
+        distributed.barrier()
+
+        return {key[:-len('.npy')]: np.load(os.path.join(path, key), mmap_mode = 'r') for key in os.listdir(path) if key.endswith('.npy')}
+
+
+    def split_keys(self, row):
+        keys = dict(image = self.text('image', row))
+
+        if 'video' in self.columns:
+            keys['video'] = self.text('video', row)
+
+        return keys
+
+
+    def column(self, key):
+        return np.asarray(self.columns[key][self.rows])
+
+
+    def camera_columns(self):
+        '''
+        cameras of all rows as the (intrinsics, rotation, world_up, distortion) arrays of crop_geometry.crop_cameras
+        '''
+        return tuple(self.column(key) for key in ('intrinsics', 'rotation', 'world_up', 'distortion'))
+
+
+    def text(self, key, row):
+        return self.columns[key][row].decode('utf-8')
+
+
+    def camera(self, row):
+        columns = self.columns
+
+        distortion = np.array(columns['distortion'][row]) if columns['distorted'][row] else None
+
+        return cameralib.Camera(
+            np.array(columns['optical_center'][row]),
+            np.array(columns['rotation'][row]),
+            np.array(columns['intrinsics'][row]),
+            distortion,
+            np.array(columns['world_up'][row])
+        )
+
+
+    def __getitem__(self, index):
+        row = self.rows[index]
+        columns = self.columns
+
+        sample = dict(
+            skeleton = np.array(columns['skeleton'][row]),
+            valid = np.unpackbits(columns['valid'][row], count = self.num_joints).astype(bool),
+            bbox = np.array(columns['bbox'][row]),
+            image = self.text('image', row),
+            camera = self.camera(row)
+        )
+        if 'depth_bbox' in columns:
+            sample['depth_bbox'] = np.array(columns['depth_bbox'][row])
+
+        if 'video' in columns:
+            sample['video'] = self.text('video', row)
+            sample['frame'] = int(columns['frame'][row])
+
+        return sample
+
+
+    def __len__(self):
+        return len(self.rows)
@@ -0,0 +1,88 @@
+import torch
+
+
+class SoftArgmax(torch.autograd.Function):
+    '''
+    expected coordinates under the softmax of every joint's logits, without materializing the softmax for backward
+    logits may keep the channel layout of the regressor, joints along joint_dim and coordinate axes along axes,
+    so that no permuted copy is needed
+    the softmax is taken in the logsumexp form, in float32 for reduced-precision logits, and only the logits,
+    the per-joint logsumexp and the coordinates are saved, the softmax is recomputed in backward
+    the gradient of a coordinate c = sum p * g with respect to the logits is p * (g - c)
+    '''
+    @staticmethod
+    def forward(ctx, logits, joint_dim, axes, grids):
+        '''
+        Args:
+            logits: (batch_size, ...) with num_joints along joint_dim and one coordinate axis along each of axes
+            grids: 1d tensors with the coordinate of every position along each of axes
+        Returns:
+            coordinates of shape (batch_size, num_joints, len(axes)), at least in float32
+        '''
+        dtype = torch.promote_types(logits.dtype, torch.float32)
+
+        views = tuple(grid_view(grid.to(dtype), axis, logits.dim()) for grid, axis in zip(grids, axes))
+
+        probs, log_norm = softmax(logits, axes)
+
+        coords = tuple(expectation(probs, axis, axes, view) for axis, view in zip(axes, views))
+
+        ctx.save_for_backward(logits, log_norm, *coords)
+        ctx.axes = axes
+        ctx.views = views
+
+        batch_size, num_joints = logits.size(0), logits.size(joint_dim)
+
+        return torch.stack([coord.reshape(batch_size, num_joints) for coord in coords], dim = 2)
+
+
+    @staticmethod
+    def backward(ctx, grad_coords):
+        logits, log_norm, *coords = ctx.saved_tensors
+
+        shape = log_norm.shape
+
+        slope = 0.0
+        offset = 0.0
+
+        for i, (coord, view) in enumerate(zip(coords, ctx.views)):
+            grad = grad_coords[:, :, i].reshape(shape).to(log_norm.dtype)
+
+            slope = slope + grad * view
+            offset = offset + grad * coord
+
+        probs = torch.exp(logits.to(log_norm.dtype) - log_norm)
+
+        grad_logits = probs.mul_(slope - offset)
+
+        return grad_logits.to(logits.dtype), None, None, None
+
+
+def grid_view(grid, axis, ndim):
+    shape = [1] * ndim
+    shape[axis] = -1
+
+    return grid.view(shape)
+
+
+def softmax(logits, axes):
+    '''
+    Returns:
+        the softmax over axes, at least in float32, and its log normalizer, which keeps the reduced dimensions
+    '''
+    logits = logits.to(torch.promote_types(logits.dtype, torch.float32))
+
+    log_norm = torch.logsumexp(logits, dim = axes, keepdim = True)
+
+    return torch.exp(logits - log_norm), log_norm
+
+
+def expectation(probs, axis, axes, view):
+    '''
+    the coordinate along axis from the marginal over the other axes, shaped as the log normalizer
+    '''
+    others = tuple(other for other in axes if other != axis)
+
+    marginal = probs.sum(dim = others, keepdim = True) if others else probs
+
+    return (marginal * view).sum(dim = axis, keepdim = True)
@@ -0,0 +1,69 @@
+import torch
+import contextlib
+import numpy as np
+import torch.nn as nn
+import torch.utils.checkpoint as checkpoint
+
+
+class CheckpointedStage(nn.Sequential):
+    '''
+    a stage of residual blocks that keeps only the inputs of its segments during training
+    the activations inside a segment are recomputed in the backward pass, which trades one more forward of the stage
+    for the memory of its intermediate feature maps
+    the recomputation leaves the running statistics of batchnorm alone, so that they are updated once per step as usual
+    with 0 segments, in evaluation or without grad the stage is a plain nn.Sequential
+    '''
+    def __init__(self, segments, *blocks):
+        super(CheckpointedStage, self).__init__(*blocks)
+
+        self.segments = min(segments, len(blocks))
+
+    def forward(self, x):
+        if self.segments <= 0 or not (self.training and torch.is_grad_enabled()):
+            return super(CheckpointedStage, self).forward(x)
+
+        blocks = list(self)
+
+        for chunk in np.array_split(np.arange(len(blocks)), self.segments):
+            x = checkpoint.checkpoint(segment_fn(blocks[chunk[0]:chunk[-1] + 1]), x, use_reentrant = False)
+
+        return x
+
+
+def segment_fn(blocks):
+    '''
+    runs blocks in order, with batchnorm statistics frozen on every call after the first, which is the recomputation
+    '''
+    calls = [0]
+
+    def run(x):
+        context = frozen_batchnorm(blocks) if calls[0] else contextlib.nullcontext()
+        calls[0] += 1
+
+        with context:
+            for block in blocks:
+                x = block(x)
+
+        return x
+
+    return run
+
+
+@contextlib.contextmanager
+def frozen_batchnorm(blocks):
+    norms = [norm for block in blocks for norm in block.modules() if isinstance(norm, nn.modules.batchnorm._BatchNorm) and norm.training]
+
+    momenta = [norm.momentum for norm in norms]
+    tracked = [norm.num_batches_tracked.clone() if norm.num_batches_tracked is not None else None for norm in norms]
+
+    for norm in norms:
+        norm.momentum = 0.0
+
+    try:
+        yield
+    finally:
+        for norm, momentum, count in zip(norms, momenta, tracked):
+            norm.momentum = momentum
+
+            if count is not None:
+                norm.num_batches_tracked.copy_(count)
@@ -0,0 +1,126 @@
+import torch
+import utils
+import contextlib
+import mat_utils
+
+
+def split_batch(batch_tuple, accum_steps):
+    '''
+    splits every tensor of a collated batch along the batch dimension into at most accum_steps micro-batches
+    '''
+    return list(zip(*[item.chunk(accum_steps) for item in batch_tuple]))
+
+
+class CamHead:
+    '''
+    root-relative 3d pose decoded from a volumetric heatmap, and its loss against the valid joints
+    '''
+    def __init__(self, args, key_index, criterion, loss_div = 1.0):
+        self.depth = args.depth
+        self.num_joints = args.num_joints
+        self.depth_range = args.depth_range
+        self.side_out = (args.side_in - 1) // args.stride + 1
+
+        self.key_index = key_index
+        self.criterion = criterion
+        self.loss_div = loss_div
+
+
+    def decode(self, cam_feat, true_cam):
+        '''
+        Returns:
+            pose relative to the key joint and the same pose placed at the true key joint
+        '''
+        relat_cam = utils.soft_argmax(cam_feat, self.depth, self.num_joints, self.side_out, self.side_out, self.depth_range)
+
+        relat_cam = relat_cam - relat_cam[:, self.key_index:self.key_index + 1]
+
+        return relat_cam, relat_cam + true_cam[:, self.key_index:self.key_index + 1]
+
+
+    def __call__(self, spec_cam, true_cam, true_val):
+        return self.criterion(spec_cam.view(-1, 3)[true_val.view(-1)] / self.loss_div, true_cam.view(-1, 3)[true_val.view(-1)] / self.loss_div)
+
+
+class MatHead:
+    '''
+    2d pose in crop pixels decoded from a planar heatmap, and its loss against the valid joints
+    '''
+    def __init__(self, args, criterion):
+        self.num_joints = args.num_joints
+        self.side_in = args.side_in
+        self.side_out = (args.side_in - 1) // args.stride + 1
+
+        self.criterion = criterion
+
+
+    def decode(self, mat_feat):
+        return mat_utils.soft_argmax(mat_feat, self.num_joints, self.side_out, self.side_out, self.side_in)
+
+
+    def __call__(self, spec_mat, true_mat, true_val):
+        return self.criterion(spec_mat.view(-1, 2)[true_val.view(-1)], true_mat.view(-1, 2)[true_val.view(-1)])
+
+
+class StepEngine:
+    '''
+    one optimizer step over a loaded batch, run as accum_steps micro-batches whose gradients are accumulated
+
+    a forward callable maps (micro_batch, i_micro) to a dict of named (loss, count) pairs, each loss being a mean
+    over count items, e.g. valid joints or samples
+    every loss is weighted by the share of its items in the whole batch, given by totals, so that the accumulated
+    gradients equal those of the whole batch as long as the model has no batch statistics
+    counts and totals may be tensors left on the device, so that no step waits on a count
+    coefs weight the named losses in the minimized sum, and extra callables add losses that are not split,
+    such as the semi-supervised distillation batches, each run and backpropagated on its own
+    under DistributedDataParallel the gradients are only all-reduced after the last micro-batch, unless the
+    mixed-precision step moves them out of the model after every backward
+    '''
+    def __init__(self, step, optimizer, accum_steps = 1, model = None):
+        self.step = step
+        self.optimizer = optimizer
+        self.accum_steps = accum_steps
+        self.model = model
+
+
+    def sync_context(self, last):
+        if last or self.step.half_acc or not hasattr(self.model, 'no_sync'):
+            return contextlib.nullcontext()
+
+        return self.model.no_sync()
+
+
+    def __call__(self, batch_tuple, forward, totals, coefs = dict(), extras = ()):
+        '''
+        Returns:
+            the named losses of the whole batch as detached tensors, left on the device
+        '''
+        record = dict()
+
+        micro_batches = split_batch(batch_tuple, self.accum_steps) if self.accum_steps > 1 else [batch_tuple]
+
+        for i_micro, micro_batch in enumerate(micro_batches):
+            with self.sync_context(i_micro == len(micro_batches) - 1):
+                losses = forward(micro_batch, i_micro)
+
+                self.accumulate(losses, totals, coefs, record)
+
+        for extra in extras:
+            self.accumulate(extra(), totals, coefs, record)
+
+        self.step.update(self.optimizer)
+
+        return record
+
+
+    def accumulate(self, losses, totals, coefs, record):
+        loss_sum = 0.0
+
+        for name, (loss, count) in losses.items():
+            share = loss * (count / totals[name])
+
+            loss_sum = loss_sum + share * coefs.get(name, 1.0)
+
+            record[name] = record[name] + share.detach() if name in record else share.detach()
+
+        self.step.backward(loss_sum)
@@ -0,0 +1,74 @@
+import os
+import json
+import numpy as np
+
+
+def zoom_levels(random_zoom, zoom_bins):
+    '''
+    zooms of the augmentation states, evenly spread over the range that is otherwise drawn uniformly
+    '''
+    return np.linspace(random_zoom, random_zoom ** (-1), zoom_bins)
+
+
+def store_path(args, data_name):
+    return os.path.join(args.store_path, data_name + '_' + str(args.side_in))
+
+
+class TeacherStore:
+    '''
+    float16 teacher outputs of every train sample under every augmentation state, memory-mapped from disk
+    a state is a flip and a zoom bin, state = do_flip * zoom_bins + zoom_bin
+    '''
+    keys = ('cam_feat', 'last_feat')
+
+    def __init__(self, path):
+        with open(os.path.join(path, 'meta.json')) as file:
+            self.meta = json.load(file)
+
+        self.arrays = {key: np.load(os.path.join(path, key + '.npy'), mmap_mode = 'r') for key in self.keys}
+
+
+    @classmethod
+    def create(cls, path, meta, shapes):
+        '''
+        Args:
+            meta: dict with num_samples, zoom_bins and the dataset options the teacher inputs depend on
+            shapes: feature shape of each key, without the sample and state dimensions
+        '''
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+        num_states = meta['zoom_bins'] * 2
+
+        for key in cls.keys:
+            np.lib.format.open_memmap(os.path.join(path, key + '.npy'), mode = 'w+', dtype = np.float16, shape = (meta['num_samples'], num_states) + tuple(shapes[key]))
+
+        with open(os.path.join(path, 'meta.json'), 'w') as file:
+            json.dump(meta, file)
+
+        store = cls(path)
+        store.arrays = {key: np.load(os.path.join(path, key + '.npy'), mmap_mode = 'r+') for key in cls.keys}
+
+        return store
+
+
+    def check(self, meta):
+        mismatch = [key for key in meta if self.meta.get(key) != meta[key]]
+
+        assert not mismatch, 'teacher store was baked with other ' + ', '.join(mismatch)
+
+
+    def write(self, start, state, features):
+        stop = start + len(features['last_feat'])
+
+        for key in self.keys:
+            self.arrays[key][start:stop, state] = features[key]
+
+
+    def flush(self):
+        for key in self.keys:
+            self.arrays[key].flush()
+
+
+    def fetch(self, key, index, state):
+        return np.array(self.arrays[key][index, state])
@@ -0,0 +1,123 @@
+import cv2
+import random
+import numpy as np
+import pytest
+import augment_colour
+
+
+NUM_DRAWS = 400
+
+# random_color_fast rotates and scales the YIQ chroma plane, which keeps luma where the hsv path keeps value,
+# so the statistics agree in distribution up to a small bias rather than exactly
+# the tolerances admit that bias, about 3 of 255 levels on the average, while missing or mis-scaled factors fail
+MEAN_TOLERANCE = 0.02  # difference of the average statistic over all draws, in units of the [0, 1] range
+SPREAD_TOLERANCE = 0.4  # relative difference of the standard deviation of the statistic over all draws
+KS_LIMIT = 0.25  # two-sample Kolmogorov-Smirnov distance, the critical value at alpha = 0.001 is 0.14
+
+# colourfulness reacts to the saturation factor alone, and to it differently in both paths, hence the looser bounds
+COLOURFULNESS_SPREAD = (0.5, 2.0)  # ratio of the standard deviations over all draws, the fixed factor gives below 0.3
+COLOURFULNESS_KS_LIMIT = 0.3  # the fixed factor gives above 0.35
+
+
+def make_image(seed, side = 64):
+    '''
+    a smooth colourful image with saturated and dark regions, unlike uniform noise whose statistics barely move
+    '''
+    state = np.random.RandomState(seed)
+
+    coords = np.linspace(0.0, 1.0, side)
+    grid_y, grid_x = np.meshgrid(coords, coords, indexing = 'ij')
+
+    channels = []
+
+    for _ in range(3):
+        phase, freq_x, freq_y = state.uniform(0, 2 * np.pi), state.uniform(1, 4), state.uniform(1, 4)
+        channels.append(0.5 + 0.45 * np.sin(freq_x * grid_x * np.pi + freq_y * grid_y * np.pi + phase))
+
+    image = np.stack(channels, axis = -1) * state.uniform(0.4, 1.0)
+
+    return (image * 255).astype(np.uint8)
+
+
+def image_statistics(image):
+    '''
+    per-channel means and standard deviations, mean saturation and mean value of one image, all in [0, 1]
+    '''
+    image = image.astype(np.float32) / 255.0
+
+    hsv = cv2.cvtColor(image, cv2.COLOR_RGB2HSV)
+
+    return np.concatenate([image.mean(axis = (0, 1)), image.std(axis = (0, 1)), [hsv[:, :, 1].mean(), hsv[:, :, 2].mean()]])
+
+
+def colourfulness(image):
+    '''
+    mean chroma over the spread of luma, which brightness and contrast leave about unchanged
+    '''
+    image = image.astype(np.float32) / 255.0
+
+    chroma = (image.max(axis = -1) - image.min(axis = -1)).mean()
+
+    return chroma / cv2.cvtColor(image, cv2.COLOR_RGB2GRAY).std()
+
+
+def draw_statistics(func, image, seed, statistics = image_statistics):
+    np.random.seed(seed)
+    random.seed(seed)
+
+    return np.stack([statistics(func(image)) for _ in range(NUM_DRAWS)])
+
+
+def ks_statistic(first, second):
+    values = np.sort(np.concatenate([first, second]))
+
+    first_cdf = np.searchsorted(np.sort(first), values, side = 'right') / len(first)
+    second_cdf = np.searchsorted(np.sort(second), values, side = 'right') / len(second)
+
+    return np.abs(first_cdf - second_cdf).max()
+
+
+NAMES = ['mean_r', 'mean_g', 'mean_b', 'std_r', 'std_g', 'std_b', 'saturation', 'value']
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2, 3])
+def test_fast_colour_matches_hsv_colour(seed):
+    image = make_image(seed)
+
+    reference = draw_statistics(augment_colour.random_color, image, seed)
+    fast = draw_statistics(augment_colour.random_color_fast, image, seed + 100)
+
+    for i, name in enumerate(NAMES):
+        assert abs(reference[:, i].mean() - fast[:, i].mean()) < MEAN_TOLERANCE, name
+
+        spread = reference[:, i].std()
+        assert abs(spread - fast[:, i].std()) < SPREAD_TOLERANCE * spread + 1e-3, name
+
+        assert ks_statistic(reference[:, i], fast[:, i]) < KS_LIMIT, name
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2, 3])
+def test_fast_colour_scales_saturation_like_hsv_colour(seed):
+    image = make_image(seed)
+
+    reference = draw_statistics(augment_colour.random_color, image, seed, colourfulness)
+    fast = draw_statistics(augment_colour.random_color_fast, image, seed + 100, colourfulness)
+
+    low, high = COLOURFULNESS_SPREAD
+
+    assert low < fast.std() / reference.std() < high
+    assert ks_statistic(reference, fast) < COLOURFULNESS_KS_LIMIT
+
+
+def test_fast_colour_batch_matches_single():
+    images = np.stack([make_image(seed) for seed in range(NUM_DRAWS // 8)] * 8)
+
+    np.random.seed(0)
+    batch = np.stack([image_statistics(image) for image in augment_colour.random_color_fast_batch(images)])
+
+    np.random.seed(1)
+    single = np.stack([image_statistics(augment_colour.random_color_fast(image)) for image in images])
+
+    for i, name in enumerate(NAMES):
+        assert abs(batch[:, i].mean() - single[:, i].mean()) < MEAN_TOLERANCE, name
+        assert ks_statistic(batch[:, i], single[:, i]) < KS_LIMIT, name
@@ -0,0 +1,88 @@
+import torch
+import utils
+import mat_utils
+
+from soft_argmax import SoftArgmax
+
+
+DEPTH, NUM_JOINTS, HEIGHT, WIDTH = 4, 3, 5, 6
+
+
+def test_volumetric_gradcheck():
+    torch.manual_seed(0)
+
+    logits = torch.randn(2, DEPTH * NUM_JOINTS, HEIGHT, WIDTH, dtype = torch.float64, requires_grad = True)
+
+    assert torch.autograd.gradcheck(lambda logits: utils.soft_argmax(logits, DEPTH, NUM_JOINTS, HEIGHT, WIDTH, 1.7), (logits,))
+
+
+def test_planar_gradcheck():
+    torch.manual_seed(0)
+
+    logits = torch.randn(2, NUM_JOINTS, HEIGHT, WIDTH, dtype = torch.float64, requires_grad = True)
+
+    assert torch.autograd.gradcheck(lambda logits: mat_utils.soft_argmax(logits, NUM_JOINTS, HEIGHT, WIDTH, 3.0), (logits,))
+
+
+def test_volumetric_matches_decode():
+    torch.manual_seed(0)
+
+    logits = torch.randn(4, 8 * 17, 9, 9, dtype = torch.float64, requires_grad = True)
+    grad_out = torch.randn(4, 17, 3, dtype = torch.float64)
+
+    reference = utils.decode(utils.to_heatmap(logits, 8, 17, 9, 9), 2.0)
+    reference.backward(grad_out)
+
+    reference_grad = logits.grad.clone()
+    logits.grad = None
+
+    fused = utils.soft_argmax(logits, 8, 17, 9, 9, 2.0)
+    fused.backward(grad_out)
+
+    # decode builds its grids in float32, hence the tolerance
+    assert torch.allclose(fused, reference, atol = 1e-6)
+    assert torch.allclose(logits.grad, reference_grad, atol = 1e-6)
+
+
+def test_planar_matches_decode():
+    torch.manual_seed(0)
+
+    logits = torch.randn(4, 17, 9, 9, dtype = torch.float64, requires_grad = True)
+    grad_out = torch.randn(4, 17, 2, dtype = torch.float64)
+
+    reference = mat_utils.decode(mat_utils.to_heatmap(logits, 17, 9, 9), 256)
+    reference.backward(grad_out)
+
+    reference_grad = logits.grad.clone()
+    logits.grad = None
+
+    fused = mat_utils.soft_argmax(logits, 17, 9, 9, 256)
+    fused.backward(grad_out)
+
+    assert torch.allclose(fused, reference, atol = 1e-4)
+    assert torch.allclose(logits.grad, reference_grad, atol = 1e-4)
+
+
+def test_half_logits_reduce_in_float32():
+    torch.manual_seed(0)
+
+    logits = torch.randn(2, DEPTH * NUM_JOINTS, HEIGHT, WIDTH)
+    half = logits.to(torch.bfloat16).requires_grad_()
+
+    coords = utils.soft_argmax(half, DEPTH, NUM_JOINTS, HEIGHT, WIDTH, 2.0)
+    coords.sum().backward()
+
+    assert coords.dtype == torch.float32
+    assert half.grad.dtype == torch.bfloat16
+    assert torch.allclose(coords, utils.soft_argmax(half.detach().float(), DEPTH, NUM_JOINTS, HEIGHT, WIDTH, 2.0))
+
+
+def test_only_logits_are_saved_at_full_size():
+    logits = torch.randn(2, DEPTH * NUM_JOINTS, HEIGHT, WIDTH, requires_grad = True)
+
+    sizes = []
+
+    with torch.autograd.graph.saved_tensors_hooks(lambda tensor: sizes.append(tensor.numel()) or tensor, lambda tensor: tensor):
+        SoftArgmax.apply(logits.view(-1, DEPTH, NUM_JOINTS, HEIGHT, WIDTH), 2, (4, 3, 1), tuple(torch.linspace(0, 1, n) for n in (WIDTH, HEIGHT, DEPTH)))
+
+    assert sorted(sizes)[-2] < logits.numel()
@@ -4,6 +4,11 @@ import numpy as np
 import torch.optim as optim
 import mat_utils
 import utils
+import mixed_precision
+import step_engine
+import metrics
+import distributed
+import device_pipeline
 
 from torch.autograd import Variable
 from builtins import zip as xzip
@@ -11,23 +16,24 @@ from builtins import zip as xzip
 
 class Trainer:
 
-    def __init__(self, args, model, data_info):
+    def __init__(self, args, model, data_info, logger = None):
         self.model = model
         self.data_info = data_info
+        self.logger = logger
+        self.device = distributed.get_device()
 
         self.list_params = list(model.parameters())
 
+        self.half_type = mixed_precision.half_types[args.half_type]
+
+        self.step = mixed_precision.MixedStep(self.list_params, args.half_acc, args.grad_norm, args.grad_scaling, args.scale_window)
+
         if args.half_acc:
-            self.copy_params = [param.clone().detach() for param in self.list_params]
-            self.model = self.model.half()
+            self.model = self.model.to(self.half_type)
 
-            for param in self.copy_params:
-                param.requires_grad = True
-                param.grad = param.data.new_zeros(param.size())
+        self.model = distributed.wrap_ddp(self.model, args)
 
-            self.optimizer = optim.Adam(self.copy_params, args.learn_rate, weight_decay = args.weight_decay)
-        else:
-            self.optimizer = optim.Adam(self.list_params, args.learn_rate, weight_decay = args.weight_decay)
+        self.optimizer = optim.Adam(self.step.master_params, args.learn_rate, weight_decay = args.weight_decay)
 
         self.depth = args.depth
         self.num_joints = args.num_joints
@@ -41,151 +47,189 @@ class Trainer:
 
         self.learn_rate = args.learn_rate
         self.num_epochs = args.n_epochs
-        self.grad_norm = args.grad_norm
-        self.grad_scaling = args.grad_scaling
+        self.print_freq = args.print_freq
 
         self.thresh = dict(
             solid = args.thresh_solid,
             close = args.thresh_close,
             rough = args.thresh_rough
         )
-        self.criterion = nn.__dict__[args.criterion + 'Loss'](reduction = 'mean').cuda()
+        self.criterion = nn.__dict__[args.criterion + 'Loss'](reduction = 'mean').to(self.device)
 
+        self.cam_head = step_engine.CamHead(args, data_info.key_index, self.criterion)
+        self.mat_head = step_engine.MatHead(args, self.criterion)
 
-    def joint_train(self, epoch, data_loader, cuda_device):
-        n_batches = len(data_loader)
+        self.engine = step_engine.StepEngine(self.step, self.optimizer, args.accum_steps, self.model)
 
-        cam_loss_avg = 0
-        mat_loss_avg = 0
-        recon_loss_avg = 0
-        total = 0
+        self.pipeline = device_pipeline.DevicePipeline(args, True)
 
-        side_out = (self.side_in - 1) / self.stride + 1
+        self.ckpt_freq = args.ckpt_freq
+        self.resume_steps = 0
 
-        do_track = self.do_track and (epoch != 1)
 
-        for i, (image, true_cam, true_mat, true_val, intrinsics) in enumerate(data_loader):
+    def state_dict(self):
+        '''
+        everything an interrupted run needs to go on, including the optimizer moments and under half_acc the float32 master copies
+        '''
+        model = getattr(self.model, 'module', self.model)
 
-            image = image.to(cuda_device)
+        return dict(model = model.state_dict(), optimizer = self.optimizer.state_dict(), mixed = self.step.state_dict())
 
-            true_cam = true_cam.to(cuda_device)
-            true_mat = true_mat.to(cuda_device)
-            true_val = true_val.to(cuda_device)
 
-            intrinsics = intrinsics.to(cuda_device)
+    def load_state_dict(self, checkpoint):
+        '''
+        resumes from a checkpoint whose model weights are already loaded, older checkpoints only carry those
+        '''
+        if 'optimizer' in checkpoint:
+            self.optimizer.load_state_dict(checkpoint['optimizer'])
 
-            batch = image.size(0)
+        if 'mixed' in checkpoint:
+            self.step.load_state_dict(checkpoint['mixed'])
 
-            cam_feat, mat_feat = self.model(image)
+        self.resume_steps = checkpoint['state'].get('step', 0)
 
-            heat_mat = mat_utils.to_heatmap(mat_feat, self.num_joints, side_out, side_out)
 
-            heat_cam = utils.to_heatmap(cam_feat, self.depth, self.num_joints, side_out, side_out)
+    def checkpoint(self, epoch, step, n_batches):
+        '''
+        checkpoints every ckpt_freq steps of an epoch, except after its last step which the logger records anyway
+        '''
+        if not self.ckpt_freq or self.logger is None or step == n_batches:
+            return
 
-            spec_mat = mat_utils.decode(heat_mat, self.side_in)
+        step += self.resume_steps
 
-            mat_loss = self.criterion(spec_mat.view(-1, 2)[true_val.view(-1)], true_mat.view(-1, 2)[true_val.view(-1)])
+        if step % self.ckpt_freq == 0:
+            self.logger.checkpoint(epoch, step, self)
 
-            mat_loss_avg += mat_loss.item() * batch
 
-            key_index = self.data_info.key_index
+    def to(self, image, device):
+        return image.to(device, self.half_type) if self.half_acc else image.to(device)
 
-            relat_cam = utils.decode(heat_cam, self.depth_range)
 
-            relat_cam = relat_cam - relat_cam[:, key_index:key_index + 1]
+    def joint_forward(self, batch_tuple, do_track, cuda_device):
+        image, true_cam, true_mat, true_val, intrinsics = batch_tuple
 
-            spec_cam = relat_cam + true_cam[:, key_index:key_index + 1]
+        image = self.to(image, cuda_device)
 
-            cam_loss = self.criterion(spec_cam.view(-1, 3)[true_val.view(-1)], true_cam.view(-1, 3)[true_val.view(-1)])
+        true_cam = true_cam.to(cuda_device)
+        true_mat = true_mat.to(cuda_device)
+        true_val = true_val.to(cuda_device)
 
-            cam_loss_avg += cam_loss.item() * batch
+        intrinsics = intrinsics.to(cuda_device)
 
-            loss = cam_loss + mat_loss
+        cam_feat, mat_feat = self.model(image)
 
-            if do_track:
-                recon_cam = utils.get_recon_cam(spec_mat, relat_cam, intrinsics)
+        if self.half_acc:
+            cam_feat = cam_feat.float()
+            mat_feat = mat_feat.float()
 
-                recon_loss = self.criterion(recon_cam.view(-1, 3)[true_val.view(-1)], true_cam.view(-1, 3)[true_val.view(-1)])
+        spec_mat = self.mat_head.decode(mat_feat)
 
-                recon_loss_avg += recon_loss.item() * batch
+        relat_cam, spec_cam = self.cam_head.decode(cam_feat, true_cam)
 
-                loss = loss * 0.5 + recon_loss
+        num_valid = true_val.sum()
 
-            self.optimizer.zero_grad()
-            loss.backward()
+        losses = dict(cam = (self.cam_head(spec_cam, true_cam, true_val), num_valid), mat = (self.mat_head(spec_mat, true_mat, true_val), num_valid))
 
-            nn.utils.clip_grad_norm_(self.list_params, self.grad_norm)
-            self.optimizer.step()
+        if do_track:
+            recon_cam, recon_val = utils.get_recon_cam(spec_mat, relat_cam, intrinsics, true_val)
 
-            total += batch
+            losses['recon'] = (self.cam_head(recon_cam, true_cam, recon_val), recon_val.sum())
 
-            message = '| train Epoch[%d] [%d/%d]' % (epoch, i, n_batches)
-            message += '  Cam Loss: %1.4f' % (cam_loss.item())
-            message += '  Mat Loss: %1.4f' % (mat_loss.item())
+        return losses
 
-            if do_track:
-                message += '  Recon Loss: %1.4f' % (recon_loss.item())
 
-            print(message)
+    def cam_forward(self, batch_tuple, cuda_device):
+        image, true_cam, true_val = batch_tuple
 
-        cam_loss_avg /= total
-        mat_loss_avg /= total
-        recon_loss_avg /= total
+        image = self.to(image, cuda_device)
 
-        message = '=> train Epoch[%d]  Cam Loss: %1.4f  Mat Loss: %1.4f' % (epoch, cam_loss_avg, mat_loss_avg)
+        true_cam = true_cam.to(cuda_device)
+        true_val = true_val.to(cuda_device)
 
-        if do_track:
-            message += '  Recon Loss: %1.4f' % (recon_loss_avg)
+        cam_feat = self.model(image)
 
-        print('\n' + message + '\n')
+        if self.half_acc:
+            cam_feat = cam_feat.float()
 
-        return dict(cam_train_loss = cam_loss_avg, mat_train_loss = mat_loss_avg, recon_train_loss = recon_loss_avg)
+        relat_cam, spec_cam = self.cam_head.decode(cam_feat, true_cam)
 
+        return dict(cam = (self.cam_head(spec_cam, true_cam, true_val), true_val.sum()))
 
-    def cam_train(self, epoch, data_loader, cuda_device):
-        n_batches = len(data_loader)
 
-        loss_avg = 0
-        total = 0
+    def joint_train(self, epoch, data_loader, cuda_device):
+        n_batches = len(data_loader) - self.resume_steps
 
-        side_out = (self.side_in - 1) / self.stride + 1
+        meter = metrics.MetricAccumulator('train', epoch, n_batches, self.print_freq, self.logger)
 
-        for i, (image, true_cam, true_val) in enumerate(data_loader):
+        do_track = self.do_track and (epoch != 1)
 
-            image = image.to(cuda_device)
+        coefs = dict(cam = 0.5, mat = 0.5, recon = 1.0) if do_track else dict()
 
-            true_cam = true_cam.to(cuda_device)
-            true_val = true_val.to(cuda_device)
+        for i, batch_tuple in enumerate(data_loader):
 
-            batch = image.size(0)
+            if i == n_batches:
+                break
 
-            cam_feat = self.model(image)
+            true_val = batch_tuple[3]
 
-            heat_cam = utils.to_heatmap(cam_feat, self.depth, self.num_joints, side_out, side_out)
+            batch = true_val.size(0)
 
-            key_index = self.data_info.key_index
+            num_valid = true_val.sum()
 
-            relat_cam = utils.decode(heat_cam, self.depth_range)
+            forward = lambda micro_batch, i_micro: self.joint_forward(micro_batch, do_track, cuda_device)
 
-            relat_cam = relat_cam - relat_cam[:, key_index:key_index + 1]
+            losses = self.engine(batch_tuple, forward, dict(cam = num_valid, mat = num_valid, recon = num_valid), coefs)
 
-            spec_cam = relat_cam + true_cam[:, key_index:key_index + 1]
+            for name, loss in losses.items():
+                meter.add(name, loss, batch)
 
-            loss = self.criterion(spec_cam.view(-1, 3)[true_val.view(-1)], true_cam.view(-1, 3)[true_val.view(-1)])
+            meter.step(batch)
 
-            loss_avg += loss.item() * batch
+            self.checkpoint(epoch, i + 1, n_batches)
 
-            self.optimizer.zero_grad()
-            loss.backward()
+        meter.close()
 
-            nn.utils.clip_grad_norm_(self.list_params, self.grad_norm)
-            self.optimizer.step()
+        cam_loss_avg = meter.mean('cam')
+        mat_loss_avg = meter.mean('mat')
+        recon_loss_avg = meter.mean('recon')
 
-            total += batch
+        message = '=> train Epoch[%d]  Cam Loss: %1.4f  Mat Loss: %1.4f' % (epoch, cam_loss_avg, mat_loss_avg)
+
+        if do_track:
+            message += '  Recon Loss: %1.4f' % (recon_loss_avg)
 
-            print('| train Epoch[%d] [%d/%d]  Loss %1.4f' % (epoch, i, n_batches, loss.item()))
+        print('\n' + message + '\n')
+
+        return dict(cam_train_loss = cam_loss_avg, mat_train_loss = mat_loss_avg, recon_train_loss = recon_loss_avg)
 
-        loss_avg /= total
+
+    def cam_train(self, epoch, data_loader, cuda_device):
+        n_batches = len(data_loader) - self.resume_steps
+
+        meter = metrics.MetricAccumulator('train', epoch, n_batches, self.print_freq, self.logger)
+
+        for i, batch_tuple in enumerate(data_loader):
+
+            if i == n_batches:
+                break
+
+            true_val = batch_tuple[2]
+
+            batch = true_val.size(0)
+
+            forward = lambda micro_batch, i_micro: self.cam_forward(micro_batch, cuda_device)
+
+            losses = self.engine(batch_tuple, forward, dict(cam = true_val.sum()))
+
+            meter.add('cam', losses['cam'], batch)
+            meter.step(batch)
+
+            self.checkpoint(epoch, i + 1, n_batches)
+
+        meter.close()
+
+        loss_avg = meter.mean('cam')
 
         print('\n=> train Epoch[%d]  Cam Loss: %1.4f\n' % (epoch, loss_avg))
 
@@ -196,20 +240,26 @@ class Trainer:
         self.model.train()
         self.adapt_learn_rate(epoch)
 
+        distributed.set_epoch(data_loader, epoch)
+
+        data_loader = self.pipeline.wrap(data_loader, self.device, True)
+
         if self.joint_space:
-            return self.joint_train(epoch, data_loader, torch.device('cuda'))
+            record = self.joint_train(epoch, data_loader, self.device)
         else:
-            return self.cam_train(epoch, data_loader, torch.device('cuda'))
+            record = self.cam_train(epoch, data_loader, self.device)
+
+        self.resume_steps = 0
+
+        return record
 
 
     def joint_test(self, epoch, test_loader, cuda_device):
         n_batches = len(test_loader)
 
-        cam_loss_avg = 0
-        mat_loss_avg = 0
-        total = 0
+        meter = metrics.MetricAccumulator('test', epoch, n_batches, self.print_freq, self.logger)
 
-        side_out = (self.side_in - 1) / self.stride + 1
+        side_out = (self.side_in - 1) // self.stride + 1
 
         mat_stats = []
         cam_stats = []
@@ -217,7 +267,7 @@ class Trainer:
 
         for i, (image, true_cam, true_mat, back_rotation, true_val, intrinsics) in enumerate(test_loader):
 
-            image = image.half().to(cuda_device) if self.half_acc else image.to(cuda_device)
+            image = self.to(image, cuda_device)
 
             true_cam = true_cam.to(cuda_device)
             true_mat = true_mat.to(cuda_device)
@@ -232,15 +282,11 @@ class Trainer:
                     cam_feat = cam_feat.float()
                     mat_feat = mat_feat.float()
 
-                heat_mat = mat_utils.to_heatmap(mat_feat, self.num_joints, side_out, side_out)
-
-                heat_cam = utils.to_heatmap(cam_feat, self.depth, self.num_joints, side_out, side_out)
-
-                spec_mat = mat_utils.decode(heat_mat, self.side_in)
+                spec_mat = mat_utils.soft_argmax(mat_feat, self.num_joints, side_out, side_out, self.side_in)
 
                 key_index = self.data_info.key_index
 
-                relat_cam = utils.decode(heat_cam, self.depth_range)
+                relat_cam = utils.soft_argmax(cam_feat, self.depth, self.num_joints, side_out, side_out, self.depth_range)
 
                 relat_cam = relat_cam - relat_cam[:, key_index:key_index + 1]
 
@@ -249,12 +295,10 @@ class Trainer:
                 cam_loss = self.criterion(spec_cam.view(-1, 3)[true_val.view(-1)], true_cam.view(-1, 3)[true_val.view(-1)])
                 mat_loss = self.criterion(spec_mat.view(-1, 2)[true_val.view(-1)], true_mat.view(-1, 2)[true_val.view(-1)])
 
-            cam_loss_avg += cam_loss.item() * batch
-            mat_loss_avg += mat_loss.item() * batch
-
-            total += batch
+            meter.add('cam', cam_loss, batch)
+            meter.add('mat', mat_loss, batch)
 
-            print('| test Epoch[%d] [%d/%d]  Cam Loss: %1.4f  Mat Loss: %1.4f' % (epoch, i, n_batches, cam_loss.item(), mat_loss.item()))
+            meter.step(batch)
 
             true_val = true_val.cpu().numpy().astype(np.bool)
 
@@ -274,19 +318,21 @@ class Trainer:
             if self.do_track:
                 relat_cam = relat_cam.cpu().numpy()
 
-                deter_cam = utils.get_deter_cam(spec_mat, relat_cam, intrinsics)
+                deter_cam, deter_val = utils.get_deter_cam(spec_mat, relat_cam, intrinsics, true_val)
 
                 deter_cam = np.einsum('Bij,BCj->BCi', back_rotation, deter_cam)
 
-                det_stats.append(utils.analyze(deter_cam, true_cam, true_val, self.data_info.mirror, self.thresh))
+                det_stats.append(utils.analyze(deter_cam, true_cam, deter_val, self.data_info.mirror, self.thresh))
 
-        cam_loss_avg /= total
-        mat_loss_avg /= total
+        meter.close()
+
+        cam_loss_avg = meter.mean('cam')
+        mat_loss_avg = meter.mean('mat')
 
         record = dict(cam_test_loss = cam_loss_avg, mat_test_loss = mat_loss_avg)
 
-        record.update(mat_utils.parse_epoch(mat_stats))
-        record.update(utils.parse_epoch(cam_stats))
+        record.update(mat_utils.parse_epoch(mat_stats, distributed.all_reduce))
+        record.update(utils.parse_epoch(cam_stats, distributed.all_reduce))
 
         print('\n=> test Epoch[%d]  Cam Loss: %1.4f  Mat Loss: %1.4f\n' % (epoch, cam_loss_avg, mat_loss_avg))
 
@@ -296,7 +342,7 @@ class Trainer:
 
         if self.do_track:
 
-            track_rec = utils.parse_epoch(det_stats)
+            track_rec = utils.parse_epoch(det_stats, distributed.all_reduce)
 
             print('=>[DETER] cam_mean: %1.3f  [pck]: %1.3f  [auc]: %1.3f\n' % (track_rec['cam_mean'], track_rec['score_pck'], track_rec['score_auc']))
 
@@ -309,16 +355,15 @@ class Trainer:
     def cam_test(self, epoch, test_loader, cuda_device):
         n_batches = len(test_loader)
 
-        loss_avg = 0
-        total = 0
+        meter = metrics.MetricAccumulator('test', epoch, n_batches, self.print_freq, self.logger)
 
-        side_out = (self.side_in - 1) / self.stride + 1
+        side_out = (self.side_in - 1) // self.stride + 1
 
         cam_stats = []
 
         for i, (image, true_cam, back_rotation, true_val) in enumerate(test_loader):
 
-            image = image.to(cuda_device)
+            image = self.to(image, cuda_device)
 
             true_cam = true_cam.to(cuda_device)
             true_val = true_val.to(cuda_device)
@@ -328,11 +373,12 @@ class Trainer:
             with torch.no_grad():
                 cam_feat = self.model(image)
 
-                heat_cam = utils.to_heatmap(cam_feat, self.depth, self.num_joints, side_out, side_out)
+                if self.half_acc:
+                    cam_feat = cam_feat.float()
 
                 key_index = self.data_info.key_index
 
-                relat_cam = utils.decode(heat_cam, self.depth_range)
+                relat_cam = utils.soft_argmax(cam_feat, self.depth, self.num_joints, side_out, side_out, self.depth_range)
 
                 relat_cam = relat_cam - relat_cam[:, key_index:key_index + 1]
 
@@ -340,9 +386,7 @@ class Trainer:
 
                 loss = self.criterion(spec_cam.view(-1, 3)[true_val.view(-1)], true_cam.view(-1, 3)[true_val.view(-1)])
 
-            loss_avg += loss.item() * batch
-
-            total += batch
+            meter.add('cam', loss, batch)
 
             true_val = true_val.cpu().numpy().astype(np.bool)
 
@@ -354,12 +398,14 @@ class Trainer:
 
             cam_stats.append(utils.analyze(spec_cam, true_cam, true_val, self.data_info.mirror, self.thresh))
 
-            print('| test Epoch[%d] [%d/%d]  Cam Loss %1.4f' % (epoch, i, n_batches, loss.item()))
+            meter.step(batch)
+
+        meter.close()
 
-        loss_avg /= total
+        loss_avg = meter.mean('cam')
 
         record = dict(test_loss = loss_avg)
-        record.update(utils.parse_epoch(cam_stats))
+        record.update(utils.parse_epoch(cam_stats, distributed.all_reduce))
 
         print('\n=> test Epoch[%d]  Cam Loss: %1.4f\n' % (epoch, loss_avg))
 
@@ -371,10 +417,12 @@ class Trainer:
     def test(self, epoch, test_loader):
         self.model.eval()
 
+        test_loader = self.pipeline.wrap(test_loader, self.device, False)
+
         if self.joint_space:
-            return self.joint_test(epoch, test_loader, torch.device('cuda'))
+            return self.joint_test(epoch, test_loader, self.device)
         else:
-            return self.cam_test(epoch, test_loader, torch.device('cuda'))
+            return self.cam_test(epoch, test_loader, self.device)
 
 
     def adapt_learn_rate(self, epoch):
@@ -4,12 +4,15 @@ import queue
 import torch
 import imageio
 import threading
+import functools
 import cameralib
 import collections
+import multiprocessing
 import numpy as np
 import pyyolo
 
 from builtins import zip as xzip
+from soft_argmax import SoftArgmax
 
 def get_attention(side_in, stride, image_coords, attention):
 	'''
@@ -42,6 +45,45 @@ def get_attention(side_in, stride, image_coords, attention):
 	return radial[None, :, :]
 
 
+@functools.lru_cache()
+def get_attention_grid(side_out, device):
+	coords = torch.arange(side_out, dtype = torch.float32, device = device)
+
+	return coords.view(1, 1, -1)
+
+
+def get_attention_batch(side_in, stride, image_coords, attention, dtype = torch.float32):
+	'''
+	batched counterpart of get_attention on the device of image_coords
+	the gaussian of each joint is separable, so the sum over joints is one matmul of the per-axis profiles
+
+	Args:
+	    image_coords: (batch, num_joints, 2) tensor
+
+	Returns:
+	    (batch, 1, side_out, side_out) tensor of the given dtype
+	'''
+	side_out = (side_in - 1) // stride + 1
+
+	batch = image_coords.size(0)
+
+	if not attention:
+		return torch.ones(batch, 1, side_out, side_out, dtype = dtype, device = image_coords.device)
+
+	coords = image_coords.float() / (side_in / side_out)
+
+	grid = get_attention_grid(side_out, image_coords.device)
+
+	radial_x = torch.exp(- (grid - coords[:, :, 0:1]) ** 2 / 5.0)  # (batch, num_joints, side_out)
+	radial_y = torch.exp(- (grid - coords[:, :, 1:2]) ** 2 / 5.0)
+
+	radial = torch.bmm(radial_y.transpose(1, 2), radial_x)  # (batch, side_out, side_out)
+
+	radial = radial / torch.amax(radial.view(batch, -1), dim = -1).view(-1, 1, 1)
+
+	return radial.unsqueeze(1).to(dtype)
+
+
 def save_array(array, i_batch, last_path):
 	save_file = os.path.join(last_path, 'batch_' + str(i_batch) + '_spec.npy')
 
@@ -65,14 +107,61 @@ def save_tensor(tensor, i_batch, last_path):
 		np.save(file, tensor.cpu().numpy())
 
 
-def to_depth(image, depth_cam):
-	coord_u, coord_v = np.meshgrid(range(image.shape[1]), range(image.shape[0]))
+def get_ray_scale(depth_cam, shape):
+	coord_u, coord_v = np.meshgrid(range(shape[1]), range(shape[0]))
 
 	coords = np.stack([coord_u, coord_v], axis = -1).reshape(-1, 2)
 
-	unprojection = depth_cam.image_to_camera(coords).reshape(image.shape[0], image.shape[1], -1)
+	unprojection = depth_cam.image_to_camera(coords).reshape(shape[0], shape[1], -1)
+
+	return (1.0 / np.sqrt(np.sum(unprojection ** 2, axis = -1) + 1)).astype(np.float32)
+
+
+class RayScaleCache:
+	'''
+	LRU cache of the per-pixel factors of to_depth, which only depend on the depth camera and the image shape
+	every loader worker fills its own cache, the hit and miss counts are shared with the forked workers so that
+	the main process can report them
+	'''
+	def __init__(self, capacity):
+		self.capacity = capacity
+		self.scales = collections.OrderedDict()
+		self.hits = multiprocessing.Value('q', 0)
+		self.misses = multiprocessing.Value('q', 0)
+
+	def count(self, counter):
+		with counter.get_lock():
+			counter.value += 1
+
+	def get(self, depth_cam, shape):
+		distortion = None if depth_cam.distortion_coeffs is None else depth_cam.distortion_coeffs.tobytes()
+
+		key = (depth_cam.intrinsic_matrix.tobytes(), distortion, tuple(shape[:2]))
+
+		if key in self.scales:
+			self.count(self.hits)
+			self.scales.move_to_end(key)
+			return self.scales[key]
+
+		self.count(self.misses)
+		self.scales[key] = get_ray_scale(depth_cam, shape)
+
+		if len(self.scales) > self.capacity:
+			self.scales.popitem(last = False)
+
+		return self.scales[key]
+
+	def stats(self):
+		hits, misses = self.hits.value, self.misses.value
+
+		return dict(hits = hits, misses = misses, hit_rate = hits / max(hits + misses, 1))
+
 
-	return image / np.sqrt(np.sum(unprojection ** 2, axis = -1) + 1)
+ray_scales = RayScaleCache(64)
+
+
+def to_depth(image, depth_cam):
+	return image * ray_scales.get(depth_cam, image.shape)
 
 
 def to_bbox(det):
@@ -194,6 +283,25 @@ def decode(heatmap, depth_range):
 	return torch.stack((coord_x, coord_y, coord_z), dim = 2) * depth_range
 
 
+def soft_argmax(ausgabe, depth, num_joints, height, width, depth_range):
+	'''
+	fused to_heatmap and decode, which reads the output feature map in place and keeps no volumetric heatmap for backward
+
+	args:
+		ausgabe: (batch_size, depth x num_joints, height, width)
+
+	returns:
+		the same coordinates as decode, of shape (batch_size, num_joints, 3)
+	'''
+	logits = ausgabe.view(-1, depth, num_joints, height, width)
+
+	grid_x = torch.linspace(0.0, 2.0, width, device = ausgabe.device) * depth_range
+	grid_y = torch.linspace(0.0, 2.0, height, device = ausgabe.device) * depth_range
+	grid_z = torch.linspace(0.0, 2.0, depth, device = ausgabe.device) * depth_range
+
+	return SoftArgmax.apply(logits, 2, (4, 3, 1), (grid_x, grid_y, grid_z))
+
+
 def statistics(basic, flip, tangent, thresh):
 
 	dist = dict(
@@ -224,14 +332,24 @@ def statistics(basic, flip, tangent, thresh):
 	return dict(zip(keys, (solid, close, depth, jitter, switch, dist['basic'].size / count)))
 
 
-def parse_epoch(stats):
+def parse_epoch(stats, reduce = None):
+	'''
+	pools the statistics of all batches, weighted by their numbers of valid joints
 
+	Args:
+		reduce: optional sum of the weighted sums over processes, e.g. distributed.all_reduce
+	'''
 	keys = ('solid', 'close', 'jitter', 'depth', 'switch', 'fail')
 	keys += ('score_pck', 'score_auc', 'cam_mean', 'batch_size')
 
-	values = np.array([[patch[key] for patch in stats] for key in keys])
+	values = np.array([[patch[key] for patch in stats] for key in keys]).reshape(len(keys), -1)
+
+	sums = np.append(np.sum(values[-1] * values[:-1], axis = 1), np.sum(values[-1]))
 
-	return dict(zip(keys[:-1], np.sum(values[-1] * values[:-1], axis = 1) / np.sum(values[-1])))
+	if reduce is not None:
+		sums = reduce(sums)
+
+	return dict(zip(keys[:-1], sums[:-1] / sums[-1]))
 
 
 def analyze(spec_cam, true_cam, valid_mask, mirror, thresh):
@@ -276,63 +394,59 @@ def analyze(spec_cam, true_cam, valid_mask, mirror, thresh):
 	return stats
 
 
-def least_square(A, b, weight):
+def solve_reference(normalized, relat_cam, weight):
 	'''
-	Performs weighted least square regression
+	weighted least squares of the reference point t that projects relat_cam + t onto the normalized image coords,
+	t_x - u t_z = u z - x and t_y - v t_z = v z - y for every joint
+	the 3 x 3 normal equations are summed up joint by joint and solved by cholesky, in at least float32
+	a sample with fewer than two weighted joints, or whose normal equations fail to factorize, is not solved,
+	its reference point is left at zero and it is marked out, so that no check has to wait on the device
 
 	Args:
-		A: (num_valid x 2, 3)
-		b: (num_valid x 2,)
-		weight: (num_valid,)
-	'''
-	weight = np.tile(weight.reshape(-1, 1) ** 0.5, (1, 2))  # (num_valid, 2)
-
-	A = A * weight.reshape(-1, 1)
-	b = b * weight.reshape(-1)
-
-	return np.linalg.solve(np.dot(A.T, A), np.dot(A.T, b))
-
+		normalized: (batch_size, num_joints, 2) image coords unprojected onto the plane z = 1
+		relat_cam: (batch_size, num_joints, 3)
+		weight: (batch_size, num_joints) confidence of each joint, zero for the joints left out
 
-def get_deter_cam(spec_mat, relat_cam, intrinsics):
+	Returns:
+		(batch_size, 1, 3) reference point and (batch_size,) whether it is solved
 	'''
-	reconstructs the reference point location at test time.
+	dtype = torch.promote_types(relat_cam.dtype, torch.float32)
 
-	Args:
-		spec_mat: (batch_size, num_joints, 2) estimated image coordinates
-		relat_cam: (batch_size, num_joints, 3) estimated relative camera coordinates with respect to an unknown reference point
-		intrinsics: (batch_size, 3, 3) camera intrinsics
+	u, v = normalized.to(dtype).unbind(dim = -1)  # (batch_size, num_joints)
+	x, y, z = relat_cam.to(dtype).unbind(dim = -1)  # (batch_size, num_joints)
 
-	Returns:
-		(batch_size, num_joints, 3) estimation of camera coordinates
-	'''
-	dim_batch = spec_mat.shape[0]
-	dim_joint = spec_mat.shape[1]
+	weight = weight.to(dtype)
 
-	assert (np.sum(valid, axis = 1) != 0).all()
-	assert (np.sum(valid, axis = 1) != 1).all()
+	b_x = u * z - x
+	b_y = v * z - y
 
-	unproject = np.linalg.inv(intrinsics).transpose(0, 2, 1)
+	w_sum = weight.sum(dim = 1)
+	w_u = - (weight * u).sum(dim = 1)
+	w_v = - (weight * v).sum(dim = 1)
+	w_uv = (weight * (u * u + v * v)).sum(dim = 1)
 
-	augment = np.ones((dim_batch, dim_joint, 1))  # (batch_size, num_joints, 1)
+	zeros = torch.zeros_like(w_sum)
 
-	normalized = np.concatenate([spec_mat, augment], axis = -1)  # (batch_size, num_joints, 3)
+	normal = torch.stack([w_sum, zeros, w_u, zeros, w_sum, w_v, w_u, w_v, w_uv], dim = 1).view(-1, 3, 3)  # (batch_size, 3, 3)
 
-	normalized = np.einsum('bij,bjk->bik', normalized, unproject)[:, :, :2]  # (batch_size, num_joints, 2)
+	moment = torch.stack([(weight * b_x).sum(dim = 1), (weight * b_y).sum(dim = 1), - (weight * (u * b_x + v * b_y)).sum(dim = 1)], dim = 1)  # (batch_size, 3)
 
-	A = np.tile(np.eye(2), (dim_batch, dim_joint, 1))  # (batch_size, num_joints x 2, 2)
+	_, info = torch.linalg.cholesky_ex(normal.detach())
 
-	A = np.concatenate([A, - normalized.reshape(dim_batch, -1, 1)], axis = -1)  # (batch_size, num_joints x 2, 3)
+	solved = ((weight > 0).sum(dim = 1) > 1) & (info == 0)  # (batch_size,)
 
-	b = (normalized * relat_cam[:, :, 2:] - relat_cam[:, :, :2]).reshape(dim_batch, -1, 1)  # (batch_size, num_joints x 2, 1)
+	# the samples left out are solved against the identity, which keeps their values and gradients finite
+	normal = torch.where(solved[:, None, None], normal, torch.eye(3, dtype = dtype, device = normal.device))
+	moment = torch.where(solved[:, None], moment, torch.zeros_like(moment))
 
-	refer = np.linalg.inv(np.einsum('bij,bjk->bik', A.transpose(0, 2, 1), A))  # (batch_size, 3, 3)
+	factor, _ = torch.linalg.cholesky_ex(normal)
 
-	refer = np.einsum('bij,bjk->bik', refer, np.einsum('bij,bjk->bik', A.transpose(0, 2, 1), b))  # (batch_size, 3, 1)
+	refer = torch.cholesky_solve(moment.unsqueeze(-1), factor)  # (batch_size, 3, 1)
 
-	return relat_cam + refer.transpose(0, 2, 1)
+	return refer.transpose(1, 2), solved
 
 
-def get_recon_cam(spec_mat, relat_cam, intrinsics):
+def get_recon_cam(spec_mat, relat_cam, intrinsics, valid = None, weight = None):
 	'''
 	fully differentiable reconstruction of the reference point location at train time.
 
@@ -340,32 +454,41 @@ def get_recon_cam(spec_mat, relat_cam, intrinsics):
 		spec_mat: (batch_size, num_joints, 2) estimated image coordinates
 		relat_cam: (batch_size, num_joints, 3) estimated relative camera coordinates with respect to an unknown reference point
 		intrinsics: (batch_size, 3, 3) camera intrinsics
+		valid: (batch_size, num_joints) joints the reference point is fitted to, all by default
+		weight: (batch_size, num_joints) confidence of each joint, uniform by default
 
 	Returns:
 		(batch_size, num_joints, 3) estimation of camera coordinates
+		(batch_size, num_joints) valid joints of the samples whose reference point is solved, the rest to be left out
 	'''
-	dim_batch = spec_mat.shape[0]
-	dim_joint = spec_mat.shape[1]
+	dtype = torch.promote_types(relat_cam.dtype, torch.float32)
 
-	assert (torch.sum(valid, dim = 1) != 0).all()
-	assert (torch.sum(valid, dim = 1) != 1).all()
+	unproject = torch.inverse(intrinsics.to(dtype))  # (batch_size, 3, 3)
 
-	unproject = torch.inverse(intrinsics).permute(0, 2, 1)
+	normalized = torch.einsum('bij,bkj->bki', unproject[:, :2, :2], spec_mat.to(dtype)) + unproject[:, None, :2, 2]  # (batch_size, num_joints, 2)
 
-	augment = torch.ones((dim_batch, dim_joint, 1)).to(spec_mat.device)  # (batch_size, num_joints, 1)
+	if weight is None:
+		weight = torch.ones(spec_mat.shape[:2], dtype = dtype, device = spec_mat.device)
 
-	normalized = torch.cat([spec_mat, augment], dim = -1)  # (batch_size, num_joints, 3)
+	if valid is not None:
+		weight = weight * valid.to(dtype)
 
-	normalized = torch.einsum('bij,bjk->bik', normalized, unproject)[:, :, :2]  # (batch_size, num_joints, 2)
+	refer, solved = solve_reference(normalized, relat_cam, weight)
 
-	A = torch.eye(2).repeat((dim_batch, dim_joint, 1)).to(spec_mat.device)  # (batch_size, num_joints x 2, 2)
+	recon_val = solved[:, None] if valid is None else (valid > 0) & solved[:, None]
 
-	A = torch.cat([A, - normalized.contiguous().view(dim_batch, -1, 1)], dim = -1)  # (batch_size, num_joints x 2, 3)
+	return relat_cam + refer.to(relat_cam.dtype), recon_val.expand(spec_mat.shape[:2])
 
-	b = (normalized * relat_cam[:, :, 2:] - relat_cam[:, :, :2]).view(dim_batch, -1, 1)  # (batch_size, num_joints x 2, 1)
 
-	refer = torch.inverse(torch.einsum('bij,bjk->bik', A.permute(0, 2, 1), A))  # (batch_size, 3, 3)
+def get_deter_cam(spec_mat, relat_cam, intrinsics, valid = None, weight = None):
+	'''
+	reconstructs the reference point location at test time, the same solve as get_recon_cam on numpy arrays in float64.
+
+	Returns:
+		(batch_size, num_joints, 3) estimation of camera coordinates and (batch_size, num_joints) joints to evaluate
+	'''
+	to_tensor = lambda array: None if array is None else torch.from_numpy(np.asarray(array, dtype = np.float64))
 
-	refer = torch.einsum('bij,bjk->bik', refer, torch.einsum('bij,bjk->bik', A.permute(0, 2, 1), b))  # (batch_size, 3, 1)
+	deter_cam, deter_val = get_recon_cam(to_tensor(spec_mat), to_tensor(relat_cam), to_tensor(intrinsics), to_tensor(valid), to_tensor(weight))
 
-	return relat_cam + refer.permute(0, 2, 1)
+	return deter_cam.numpy(), deter_val.numpy()